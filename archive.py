@@ -0,0 +1,181 @@
+# archive.py
+#   reading members of tar/zip archives and compressed files in one pass
+#
+#   Archives are streamed (tar members in order, compressed data through
+#   incremental decompressors), members that are archives themselves are
+#   opened in turn, and members are named archive!member. A zip file inside
+#   a stream is spooled to a temporary file, as its directory is at its end.
+#
+import os
+import bz2
+import zlib
+import shutil
+import struct
+import tarfile
+import zipfile
+import tempfile
+from collections import deque
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+# compressed file suffix -> suffix of the decompressed file
+compressed_suffix_dict = {
+    '.gz': '', '.tgz': '.tar', '.bz2': '', '.tbz': '.tar', '.tbz2': '.tar', '.xz': '', '.txz': '.tar',
+}
+tar_suffix_set = set(['.tar', '.gem'])
+zip_suffix_set = set(['.zip', '.jar', '.war'])
+
+_read_size = 65536
+# nested zip files up to this size are spooled in memory
+_spool_size = 1<<20
+
+
+class ArchiveError(Exception):
+    pass
+
+# errors of corrupt or unsupported archives (encrypted zip members raise
+# RuntimeError, unknown zip compression methods NotImplementedError)
+_error_types = (ArchiveError, tarfile.TarError, zipfile.BadZipfile, zlib.error, struct.error,\
+        EOFError, IOError, RuntimeError, NotImplementedError)
+if lzma is not None:
+    _error_types += (lzma.LZMAError,)
+
+
+def _suffix(name):
+    return os.path.splitext(name)[1].lower()
+
+def is_archive(name):
+    '''
+    Check if a file is an archive or a compressed file by its name
+    '''
+    suffix = _suffix(name)
+    return suffix in compressed_suffix_dict or suffix in tar_suffix_set or suffix in zip_suffix_set
+
+def _decompressor(suffix):
+    if suffix in ('.gz', '.tgz'):
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    if suffix in ('.bz2', '.tbz', '.tbz2'):
+        return bz2.BZ2Decompressor()
+    if lzma is None:
+        raise ArchiveError('xz needs the lzma module (backports.lzma on Python 2)')
+    return lzma.LZMADecompressor()
+
+
+class _DecompressedFile(object):
+    '''
+    Read-only stream of data decompressed from another stream
+    '''
+
+    def __init__(self, fileobj, decompressor):
+        self._fileobj = fileobj
+        self._decompressor = decompressor
+        # decompressed chunks, the first one read from _offset on
+        self._chunks = deque()
+        self._offset = 0
+        self._size = 0
+        self._eof = False
+
+    def read(self, size=-1):
+        while not self._eof and (size < 0 or self._size < size):
+            data = self._fileobj.read(_read_size)
+            if data:
+                data = self._decompressor.decompress(data)
+            else:
+                self._eof = True
+                if hasattr(self._decompressor, 'flush'):
+                    data = self._decompressor.flush()
+            if data:
+                self._chunks.append(data)
+                self._size += len(data)
+        if size < 0 or size > self._size:
+            size = self._size
+        data_list = []
+        nleft = size
+        while nleft:
+            chunk = self._chunks[0]
+            data = chunk[self._offset:self._offset+nleft]
+            data_list.append(data)
+            nleft -= len(data)
+            self._offset += len(data)
+            if self._offset == len(chunk):
+                self._chunks.popleft()
+                self._offset = 0
+        self._size -= size
+        return ''.join(data_list)
+
+
+def iter_members(archive_path):
+    '''
+    Generate (archive!member path, size or None, read function) of regular
+    members of an archive, a member has to be read before the next one is
+    generated. Raise ArchiveError for a corrupt or unsupported archive,
+    from the generator or a read function.
+    '''
+    try:
+        with open(archive_path, 'rb') as f:
+            for member_path, size, read in _iter_archive(archive_path, os.path.basename(archive_path), f, True):
+                yield member_path, size, _checked_read(archive_path, read)
+    except _error_types as err:
+        raise ArchiveError('%s: %s' % (archive_path, err))
+
+def _checked_read(archive_path, read):
+    '''
+    Wrap the read function of a member to raise ArchiveError for corrupt
+    data found while the member is decompressed
+    '''
+    def checked_read(*args):
+        try:
+            return read(*args)
+        except _error_types as err:
+            raise ArchiveError('%s: %s' % (archive_path, err))
+    return checked_read
+
+def _spool(fileobj):
+    '''
+    Copy a stream into a seekable temporary file (in memory if small)
+    '''
+    spool_file = tempfile.SpooledTemporaryFile(_spool_size)
+    shutil.copyfileobj(fileobj, spool_file, _read_size)
+    spool_file.seek(0)
+    return spool_file
+
+def _iter_archive(path, name, fileobj, seekable):
+    suffix = _suffix(name)
+    if suffix in compressed_suffix_dict:
+        inner_name = name[:-len(suffix)] + compressed_suffix_dict[suffix]
+        stream = _DecompressedFile(fileobj, _decompressor(suffix))
+        if is_archive(inner_name):
+            for member in _iter_archive(path, inner_name, stream, False):
+                yield member
+        else:
+            yield '%s!%s' % (path, inner_name), None, stream.read
+    elif suffix in tar_suffix_set:
+        tar = tarfile.open(fileobj=fileobj, mode='r|')
+        for info in tar:
+            if not info.isfile():
+                continue
+            member_path = '%s!%s' % (path, info.name)
+            member_file = tar.extractfile(info)
+            if is_archive(info.name):
+                for member in _iter_archive(member_path, os.path.basename(info.name), member_file, False):
+                    yield member
+            else:
+                yield member_path, info.size, member_file.read
+    elif suffix in zip_suffix_set:
+        zip_file = zipfile.ZipFile(fileobj if seekable else _spool(fileobj))
+        for info in zip_file.infolist():
+            if info.filename.endswith('/'):
+                continue
+            member_path = '%s!%s' % (path, info.filename)
+            member_file = zip_file.open(info)
+            if is_archive(info.filename):
+                for member in _iter_archive(member_path, os.path.basename(info.filename), member_file, False):
+                    yield member
+            else:
+                yield member_path, info.file_size, member_file.read
@@ -0,0 +1,562 @@
+#!/usr/bin/env python
+#
+# benchmark.py
+#   micro benchmarks for ReDeBug stages
+#
+import sys
+import os
+import time
+import json
+import random
+import shutil
+import platform
+import resource
+import cPickle
+import traceback
+import tempfile
+import argparse
+import common
+import patchloader
+import sourceloader
+import reporter
+import normalizer
+import bloomvec
+import metrics
+
+
+def synthetic_function(rand, func_id):
+    '''
+    Generate a random C function
+    '''
+    lines = ['int func_%d(int a, int b)' % func_id, '{']
+    for i in range(rand.randint(6, 20)):
+        lines.append('    int v%d = a * %d + b; /* step %d */' % (i, rand.randint(1, 999), i))
+        if rand.random() < 0.2:
+            lines.append('')
+    lines += ['    return a;', '}', '']
+    return lines
+
+# line templates per language (%(n)d: a random number)
+synthetic_template_dict = {
+    common.FileExt.C: ['int v%(n)d = a * %(n)d + b; /* step %(n)d */', 'if (a > %(n)d) { b += %(n)d; } // clamp',\
+            'printf("value %%d\\n", v%(n)d);', 'c = \'\\\'\';', '/* multi-line', '   comment %(n)d */'],
+    common.FileExt.Java: ['int v%(n)d = a * %(n)d + b; /* step */', 'if (a > %(n)d) { b += %(n)d; } // clamp',\
+            'System.out.println("value " + v%(n)d);', 'String s = "quote \\" %(n)d";'],
+    common.FileExt.ShellScript: ['V%(n)d=$((A * %(n)d + B))  # step %(n)d', 'echo "value $V%(n)d"', "grep -c 'x#y' file%(n)d"],
+    common.FileExt.Python: ['v%(n)d = a * %(n)d + b  # step %(n)d', 'print("value %%d" %% v%(n)d)', "s = 'it\\'s #%(n)d'"],
+    common.FileExt.Perl: ['my $v%(n)d = $a * %(n)d + $b;  # step', 'if ($a > %(n)d) { $b += %(n)d; }', 'print "value $v%(n)d\\n";'],
+    common.FileExt.PHP: ['$v%(n)d = $a * %(n)d + $b; // step %(n)d', 'if ($a > %(n)d) { $b += %(n)d; } # clamp',\
+            "echo 'value ' . $v%(n)d; /* out */"],
+    common.FileExt.Ruby: ['v%(n)d = a * %(n)d + b  # step %(n)d', 'puts "value #{v%(n)d}"', '=begin', 'doc %(n)d', '=end'],
+}
+
+def synthetic_blocks(rand, ext, size):
+    '''
+    Generate about size bytes of source lines of a language, in blocks that
+    other lines can be inserted between (multi-line comments are not split)
+    '''
+    template_list = synthetic_template_dict[ext]
+    block_list = []
+    nbyte = 0
+    while nbyte < size:
+        i = rand.randrange(len(template_list))
+        if template_list[i] in ('/* multi-line', '=begin'):
+            block = template_list[i:i+3] if ext == common.FileExt.Ruby else template_list[i:i+2]
+        else:
+            block = [template_list[i]]
+        block = ['    ' + line % {'n': rand.randint(0, 9999)} for line in block]
+        nbyte += sum(len(line)+1 for line in block)
+        block_list.append(block)
+    return block_list
+
+def synthetic_source(rand, ext, size):
+    '''
+    Generate about size bytes of source text of a language
+    '''
+    return '\n'.join(line for block in synthetic_blocks(rand, ext, size) for line in block) + '\n'
+
+def synthetic_clone(rand, ext, clone_id):
+    '''
+    Generate 8 lines of code of a language that appear nowhere else
+    (filler lines use numbers below 10000)
+    '''
+    template_list = [template for template in synthetic_template_dict[ext]\
+            if '%(n)d' in template and ('/*' in template or not template.endswith(' */'))]
+    return ['    ' + rand.choice(template_list) % {'n': 100000*(clone_id+1) + i} for i in range(8)]
+
+def synthetic_patch(rand, func, patch_id):
+    '''
+    Generate a unified diff hunk against a C function
+    '''
+    body = [line for line in func if line]
+    start = rand.randrange(0, max(1, len(body)-6))
+    hunk = body[start:start+6]
+    diff = ['--- a/src/file%d.c' % patch_id, '+++ b/src/file%d.c' % patch_id, '@@ -1,6 +1,6 @@']
+    diff += [' ' + line for line in hunk[:3]]
+    diff += ['-' + hunk[3], '+' + hunk[3] + ' /* fixed */']
+    diff += [' ' + line for line in hunk[4:]]
+    return '\n'.join(diff) + '\n'
+
+def write_corpus(work_dir, npatch, nsource, seed=0):
+    '''
+    Write synthetic patch and source files, return their paths
+    '''
+    rand = random.Random(seed)
+    funcs = [synthetic_function(rand, i) for i in range(max(npatch, 100))]
+    patch_dir = os.path.join(work_dir, 'patches')
+    source_dir = os.path.join(work_dir, 'sources')
+    os.mkdir(patch_dir)
+    os.mkdir(source_dir)
+    patch_paths = []
+    for i in range(npatch):
+        patch_paths.append(os.path.join(patch_dir, 'p%d.diff' % i))
+        with open(patch_paths[-1], 'w') as f:
+            f.write(synthetic_patch(rand, funcs[i], i))
+    source_paths = []
+    for i in range(nsource):
+        lines = ['#include <stdio.h>', '']
+        for func_id in rand.sample(range(len(funcs)), 20):
+            lines += funcs[func_id]
+        source_paths.append(os.path.join(source_dir, 's%d.c' % i))
+        with open(source_paths[-1], 'w') as f:
+            f.write('\n'.join(lines))
+    return patch_paths, source_paths
+
+# languages of synthetic source trees and their file extensions
+suite_ext_dict = {
+    common.FileExt.C: '.c', common.FileExt.Java: '.java', common.FileExt.PHP: '.php',
+    common.FileExt.Python: '.py', common.FileExt.Ruby: '.rb',
+}
+
+def write_tree(work_dir, nfile, size, npatch, seed=0):
+    '''
+    Write a synthetic source tree of about size bytes per file and one patch
+    per clone, each clone planted in 0-3 source files of its language
+    Return (patch dir, source dir, set of (patch file name, source path))
+    '''
+    rand = random.Random(seed)
+    ext_list = sorted(suite_ext_dict)
+    patch_dir = os.path.join(work_dir, 'patches')
+    source_dir = os.path.join(work_dir, 'sources')
+    os.mkdir(patch_dir)
+    file_list = []
+    for i in range(nfile):
+        ext = ext_list[i % len(ext_list)]
+        path = os.path.join(source_dir, 'd%d' % (i % 16), 'f%d%s' % (i, suite_ext_dict[ext]))
+        file_list.append((path, ext, synthetic_blocks(rand, ext, rand.randint(size/2, size*3/2))))
+
+    clone_set = set()
+    for clone_id in range(npatch):
+        ext = ext_list[clone_id % len(ext_list)]
+        clone = synthetic_clone(rand, ext, clone_id)
+        patch_name = 'clone%d.diff' % clone_id
+        diff_path = 'src/clone%d%s' % (clone_id, suite_ext_dict[ext])
+        diff = ['--- a/' + diff_path, '+++ b/' + diff_path, '@@ -1,8 +1,8 @@']
+        diff += [' ' + line for line in clone[:4]]
+        diff += ['-' + clone[4], '+    fixed(%d);' % clone_id]
+        diff += [' ' + line for line in clone[5:]]
+        with open(os.path.join(patch_dir, patch_name), 'w') as f:
+            f.write('\n'.join(diff) + '\n')
+        candidate_list = [source_file for source_file in file_list if source_file[1] == ext]
+        for path, ext, block_list in rand.sample(candidate_list, min(len(candidate_list), rand.randint(0, 3))):
+            block_list.insert(rand.randint(0, len(block_list)), clone)
+            clone_set.add((patch_name, path))
+
+    for path, ext, block_list in file_list:
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write('\n'.join(line for block in block_list for line in block) + '\n')
+    return patch_dir, source_dir, clone_set
+
+def load_patches(patch_paths):
+    patch = patchloader.PatchLoader()
+    for patch_path in patch_paths:
+        patch._process(patch_path)
+    patch._npatch = len(patch._patch_list)
+    patch._build_index()
+    return patch
+
+def query_sources(patch, source_paths, engine):
+    '''
+    Run the query phase over source files, return (elapsed time, match dict)
+    '''
+    common.query_engine = engine
+    source = sourceloader.SourceLoader()
+    source._patch_list = patch.items()
+    source._npatch = patch.length()
+    source._ngram_index = patch.index()
+    source._ngram_count = patch.ngram_count()
+    start_time = time.time()
+    for source_path in source_paths:
+        source._process(source_path, common.FileExt.C)
+    return time.time() - start_time, source.match_items()
+
+def bench_query(args):
+    '''
+    Compare query engines as the number of patches grows
+    '''
+    print '%8s %8s %10s %10s %8s %s' % ('patches', 'sources', 'bloom(s)', 'index(s)', 'speedup', 'subset')
+    for npatch in args.patches:
+        work_dir = tempfile.mkdtemp(prefix='redebug-bench-')
+        try:
+            patch_paths, source_paths = write_corpus(work_dir, npatch, args.sources, args.seed)
+            patch = load_patches(patch_paths)
+            bloom_time, bloom_match = query_sources(patch, source_paths, 'bloom')
+            index_time, index_match = query_sources(patch, source_paths, 'index')
+            # the index is exact on n-grams, so it may only drop Bloom false positives
+            subset = all(set(index_match[p]) <= set(bloom_match[p]) for p in index_match)
+            print '%8d %8d %10.2f %10.2f %7.1fx %s' % (npatch, args.sources, bloom_time, index_time, bloom_time/max(index_time, 1e-6), subset)
+        finally:
+            shutil.rmtree(work_dir)
+
+def bench_bloom(args):
+    '''
+    Compare the per-patch Bloom membership loop and vectorized membership
+    as the number of patches grows (every source file uses a Bloom filter)
+    '''
+    if bloomvec.numpy is None:
+        print '[!] vectorized Bloom queries need the numpy module'
+        sys.exit(1)
+    common.exact_set_max = 0
+    print '%8s %8s %10s %10s %10s %8s %s' % ('patches', 'sources', 'build(s)', 'loop(s)', 'vector(s)', 'speedup', 'same')
+    for npatch in args.patches:
+        work_dir = tempfile.mkdtemp(prefix='redebug-bench-')
+        try:
+            patch_paths, source_paths = write_corpus(work_dir, npatch, args.sources, args.seed)
+            patch = load_patches(patch_paths)
+            common.bloom_vectorize = False
+            loop_time, loop_match = query_sources(patch, source_paths, 'bloom')
+            start_time = time.time()
+            bloomvec.PatchBits(patch.items()).prepare([common.FileExt.C])
+            build_time = time.time() - start_time
+            common.bloom_vectorize = True
+            vector_time, vector_match = query_sources(patch, source_paths, 'bloom')
+            common.bloom_vectorize = False
+            print '%8d %8d %10.2f %10.2f %10.2f %7.1fx %s' % (npatch, args.sources, build_time, loop_time, vector_time,\
+                    loop_time/max(vector_time, 1e-6), dict(loop_match) == dict(vector_match))
+        finally:
+            shutil.rmtree(work_dir)
+
+def bench_hash(args):
+    '''
+    Compare n-gram hash schemes on a large C file (characters per second)
+    '''
+    rand = random.Random(args.seed)
+    lines = []
+    func_id = 0
+    while sum(len(line)+1 for line in lines) < args.size * 1024 * 1024:
+        lines += synthetic_function(rand, func_id)
+        func_id += 1
+    source = sourceloader.SourceLoader()
+    norm_lines = source._normalize('\n'.join(lines), common.FileExt.C).split()
+    nchar = sum(len(line) for line in norm_lines)
+
+    elapsed = {}
+    for scheme in (1, 2):
+        common.hash_scheme = scheme
+        start_time = time.time()
+        common.build_hash_list(common.build_ngram_list(norm_lines))
+        elapsed[scheme] = time.time() - start_time
+        print '[+] hash scheme %d: %d chars, %d n-grams ... %.2fs (%.0f chars/s)' % \
+                (scheme, nchar, len(norm_lines)-common.ngram_size+1, elapsed[scheme], nchar/max(elapsed[scheme], 1e-6))
+    print '[+] speedup: %.1fx' % (elapsed[1]/max(elapsed[2], 1e-6))
+
+    # both schemes must select the same candidate pairs on a planted corpus
+    work_dir = tempfile.mkdtemp(prefix='redebug-bench-')
+    try:
+        patch_paths, source_paths = write_corpus(work_dir, 200, 20, args.seed)
+        match_dict = {}
+        for scheme in (1, 2):
+            common.hash_scheme = scheme
+            match_dict[scheme] = query_sources(load_patches(patch_paths), source_paths, 'index')[1]
+        print '[+] same matches: %s' % (dict(match_dict[1]) == dict(match_dict[2]))
+    finally:
+        shutil.rmtree(work_dir)
+
+def bench_normalize(args):
+    '''
+    Compare normalizer engines per language (MB/s)
+    '''
+    rand = random.Random(args.seed)
+    size = args.size * 1024 * 1024
+    ext_name = dict((v, k) for k, v in vars(common.FileExt).items() if not k.startswith('_'))
+    input_list = [(ext_name[ext], ext, synthetic_source(rand, ext, size)) for ext in sorted(synthetic_template_dict)]
+    # unusual shapes of C input
+    input_list.append(('long literal', common.FileExt.C, 'char *s = "' + 'x' * size + '";\n'))
+    input_list.append(('minified', common.FileExt.C, synthetic_source(rand, common.FileExt.C, size).replace('// clamp', '').replace('\n', ' ')))
+    input_list.append(('open quotes', common.FileExt.C, 'a = \'b;\n' * (args.size * 4096)))
+    # a block comment never closed: the comment regexes search to the end of
+    # the input from every opening, quadratic in its length (kept small)
+    input_list.append(('open comment', common.FileExt.C, '/* a\n' * 8000))
+
+    loader_dict = {}
+    for engine in ('regex', 'scan'):
+        settings = common.Settings(normalizer_engine=engine)
+        loader_dict[engine] = (sourceloader.SourceLoader(settings), patchloader.PatchLoader(settings))
+    print '%-14s %8s %10s %10s %8s %s' % ('input', 'MB', 'regex MB/s', 'scan MB/s', 'speedup', 'same')
+    for name, ext, text in input_list:
+        elapsed = {}
+        output = {}
+        for engine in ('regex', 'scan'):
+            source, patch = loader_dict[engine]
+            start_time = time.time()
+            output[engine] = (source._normalize(text, ext), patch._normalize(text, ext))
+            elapsed[engine] = time.time() - start_time
+        mb = 2 * len(text) / 1048576.0
+        print '%-14s %8.2f %10.2f %10.2f %7.1fx %s' % (name, mb/2, mb/max(elapsed['regex'], 1e-6), mb/max(elapsed['scan'], 1e-6),\
+                elapsed['regex']/max(elapsed['scan'], 1e-6), output['regex'] == output['scan'])
+
+class MatchCollector(object):
+    '''
+    Reporter writer keeping (patch file name, source path) of exact matches
+    '''
+
+    def __init__(self):
+        self.match_set = set()
+
+    def write_match(self, patch_id, patch_info, source_info, context):
+        for label in patch_info.labels:
+            self.match_set.add((label[1:].split(']')[0], source_info.file_path))
+
+    def close(self):
+        return len(self.match_set)
+
+class quiet(object):
+    '''
+    Silence progress output of a stage
+    '''
+
+    def __enter__(self):
+        self._stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self._stdout
+
+def dir_stats(path):
+    '''
+    Number of files and bytes under a directory
+    '''
+    size_list = [os.path.getsize(os.path.join(root, file)) for root, dirs, files in os.walk(path) for file in files]
+    return len(size_list), sum(size_list)
+
+def peak_rss():
+    '''
+    Peak resident set size of the process so far (KB)
+    '''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def run_forked(stage_list, state, out):
+    '''
+    Run the first stage in a child process forked from the state left by
+    the previous stages, and the next stages from that child in turn
+    Each child writes (stage, seconds, items, peak RSS, matches) to out
+    '''
+    if not stage_list:
+        return
+    pid = os.fork()
+    if pid:
+        os.waitpid(pid, 0)
+        return
+    status = 1
+    try:
+        name, func = stage_list[0]
+        start_time = time.time()
+        nitem = func(state)
+        seconds = time.time() - start_time
+        cPickle.dump((name, seconds, nitem, peak_rss(), state.get('match_set')), out, -1)
+        out.flush()
+        run_forked(stage_list[1:], state, out)
+        status = 0
+    except Exception:
+        traceback.print_exc()
+    finally:
+        os._exit(status)
+
+def run_suite(patch_dir, source_dir, html_path):
+    '''
+    Run patch loading, source querying and reporting stage by stage
+    A forked child process runs each stage, as the peak RSS of a process
+    never decreases: a stage would report the peak of an earlier stage or
+    run otherwise
+    Return ({stage: (seconds, items, peak RSS)}, exact matches)
+    '''
+    def load_patches(state):
+        state['patch'] = patchloader.PatchLoader()
+        return state['patch'].traverse(patch_dir)
+
+    def query_sources(state):
+        state['source'] = sourceloader.SourceLoader()
+        state['nmatch'] = state['source'].traverse(source_dir, state['patch'])
+        return dir_stats(source_dir)[0]
+
+    def write_report(state):
+        collector = MatchCollector()
+        reporter.Reporter(state['patch'], state['source'], [collector]).output(html_path)
+        state['match_set'] = collector.match_set
+        return state['nmatch']
+
+    stage_list = [('patch', load_patches), ('source', query_sources), ('report', write_report)]
+    read_fd, write_fd = os.pipe()
+    sys.stdout.flush()
+    with quiet():
+        pid = os.fork()
+        if not pid:
+            os.close(read_fd)
+            status = 1
+            try:
+                metrics.default.drain()
+                run_forked(stage_list, {}, os.fdopen(write_fd, 'wb'))
+                status = 0
+            except Exception:
+                traceback.print_exc()
+            finally:
+                os._exit(status)
+    os.close(write_fd)
+    record_list = []
+    with os.fdopen(read_fd, 'rb') as f:
+        while True:
+            try:
+                record_list.append(cPickle.load(f))
+            except EOFError:
+                break
+    os.waitpid(pid, 0)
+    if len(record_list) != len(stage_list):
+        raise RuntimeError('benchmark stage \"%s\" failed' % stage_list[len(record_list)][0])
+
+    stage_dict = dict((name, (seconds, nitem, rss)) for name, seconds, nitem, rss, match_set in record_list)
+    return stage_dict, record_list[-1][4]
+
+def compare_suite(result, baseline, tolerance):
+    '''
+    Print stage results against a baseline, return the number of regressions
+    '''
+    if result['config'] != baseline['config']:
+        print '[!] configuration differs from the baseline: %s' % \
+                ', '.join('%s %s -> %s' % (key, baseline['config'].get(key), value) for key, value in sorted(result['config'].items()) if baseline['config'].get(key) != value)
+    nregression = 0
+    print '%-8s %14s %14s %8s %12s %12s %s' % ('stage', 'items/s', 'baseline', 'change', 'peak RSS(KB)', 'baseline', 'status')
+    for stage in ('patch', 'source', 'report'):
+        r = result['stages'][stage]
+        b = baseline['stages'][stage]
+        change = r['items_per_sec']/max(b['items_per_sec'], 1e-6) - 1
+        status = []
+        if change < -tolerance:
+            status.append('SLOWER')
+        if r['peak_rss_kb'] > b['peak_rss_kb'] * (1 + tolerance):
+            status.append('MORE MEMORY')
+        nregression += len(status)
+        print '%-8s %14.1f %14.1f %+7.0f%% %12d %12d %s' % (stage, r['items_per_sec'], b['items_per_sec'], change*100,\
+                r['peak_rss_kb'], b['peak_rss_kb'], ', '.join(status) or 'ok')
+    for key in ('missed', 'unexpected'):
+        if result['correctness'][key] > baseline['correctness'][key]:
+            print '[!] %s clones: %d (baseline %d)' % (key, result['correctness'][key], baseline['correctness'][key])
+            nregression += 1
+    return nregression
+
+def bench_suite(args):
+    '''
+    Run all stages on a synthetic multi-language tree with planted clones,
+    record throughput, peak RSS and correctness, and compare to a baseline
+    '''
+    common.query_engine = args.engine
+    config = {
+        'files': args.files, 'size_kb': args.size, 'patches': args.patches, 'seed': args.seed,
+        'engine': common.query_engine, 'ngram_size': common.ngram_size, 'hash_scheme': common.hash_scheme,
+        'normalizer': common.normalizer_engine, 'python': platform.python_version(),
+    }
+    work_dir = tempfile.mkdtemp(prefix='redebug-bench-')
+    try:
+        patch_dir, source_dir, clone_set = write_tree(work_dir, args.files, args.size*1024, args.patches, args.seed)
+        html_path = os.path.join(work_dir, 'output.html')
+        best_dict = {}
+        for i in range(args.repeat):
+            stage_dict, match_set = run_suite(patch_dir, source_dir, html_path)
+            for stage, (seconds, nitem, rss) in stage_dict.items():
+                if stage not in best_dict or seconds < best_dict[stage][0]:
+                    best_dict[stage] = (seconds, nitem, rss)
+        # bytes read by loading stages, bytes written by reporting
+        stage_bytes = {'patch': dir_stats(patch_dir)[1], 'source': dir_stats(source_dir)[1],\
+                'report': os.path.getsize(html_path) if os.path.isfile(html_path) else 0}
+    finally:
+        shutil.rmtree(work_dir)
+
+    result = {'config': config, 'stages': {}}
+    print '%-8s %10s %10s %14s %10s %12s' % ('stage', 'seconds', 'items', 'items/s', 'MB/s', 'peak RSS(KB)')
+    for stage in ('patch', 'source', 'report'):
+        seconds, nitem, rss = best_dict[stage]
+        result['stages'][stage] = {
+            'seconds': seconds, 'items': nitem, 'bytes': stage_bytes[stage], 'peak_rss_kb': rss,
+            'items_per_sec': nitem/max(seconds, 1e-6), 'mb_per_sec': stage_bytes[stage]/1048576.0/max(seconds, 1e-6),
+        }
+        print '%-8s %10.2f %10d %14.1f %10.2f %12d' % (stage, seconds, nitem, nitem/max(seconds, 1e-6),\
+                stage_bytes[stage]/1048576.0/max(seconds, 1e-6), rss)
+    result['correctness'] = {
+        'expected': len(clone_set), 'found': len(match_set & clone_set),
+        'missed': len(clone_set - match_set), 'unexpected': len(match_set - clone_set),
+    }
+    print '[+] planted clones: %(expected)d, found %(found)d, missed %(missed)d, unexpected matches %(unexpected)d' % result['correctness']
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+        print '[+] baseline saved to \"%s\"' % args.save
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        nregression = compare_suite(result, baseline, args.tolerance)
+        if nregression:
+            print '[!] %d regressions against \"%s\"' % (nregression, args.compare)
+            sys.exit(1)
+        print '[+] no regressions against \"%s\"' % args.compare
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers()
+    query_parser = subparsers.add_parser('query', help='compare Bloom filter and inverted index query engines')
+    query_parser.add_argument('-p', '--patches', type=int, nargs='+', default=[100, 1000, 5000], metavar='NUM',\
+            help='numbers of patches to benchmark (default: %(default)s)')
+    query_parser.add_argument('-s', '--sources', type=int, default=50, metavar='NUM',\
+            help='number of source files (default: %(default)s)')
+    query_parser.add_argument('--seed', type=int, default=0, help='random seed (default: %(default)s)')
+    query_parser.set_defaults(func=bench_query)
+    bloom_parser = subparsers.add_parser('bloom', help='compare per-patch and vectorized (numpy) Bloom membership')
+    bloom_parser.add_argument('-p', '--patches', type=int, nargs='+', default=[1000, 10000, 100000], metavar='NUM',\
+            help='numbers of patches to benchmark (default: %(default)s)')
+    bloom_parser.add_argument('-s', '--sources', type=int, default=20, metavar='NUM',\
+            help='number of source files (default: %(default)s)')
+    bloom_parser.add_argument('--seed', type=int, default=0, help='random seed (default: %(default)s)')
+    bloom_parser.set_defaults(func=bench_bloom)
+    hash_parser = subparsers.add_parser('hash', help='compare n-gram hash schemes')
+    hash_parser.add_argument('--size', type=int, default=4, metavar='MB',\
+            help='size of the synthetic C file (default: %(default)s MB)')
+    hash_parser.add_argument('--seed', type=int, default=0, help='random seed (default: %(default)s)')
+    hash_parser.set_defaults(func=bench_hash)
+    normalize_parser = subparsers.add_parser('normalize', help='compare normalizer engines per language')
+    normalize_parser.add_argument('--size', type=int, default=2, metavar='MB',\
+            help='size of each synthetic input (default: %(default)s MB)')
+    normalize_parser.add_argument('--seed', type=int, default=0, help='random seed (default: %(default)s)')
+    normalize_parser.set_defaults(func=bench_normalize)
+    suite_parser = subparsers.add_parser('suite', help='run all stages on a synthetic tree and compare to a baseline')
+    suite_parser.add_argument('-f', '--files', type=int, default=500, metavar='NUM',\
+            help='number of source files (default: %(default)s)')
+    suite_parser.add_argument('--size', type=int, default=16, metavar='KB',\
+            help='average size of a source file (default: %(default)s KB)')
+    suite_parser.add_argument('-p', '--patches', type=int, default=200, metavar='NUM',\
+            help='number of patches, each planted in 0-3 source files (default: %(default)s)')
+    suite_parser.add_argument('-e', '--engine', choices=['index', 'bloom'], default='index',\
+            help='query engine (default: %(default)s)')
+    suite_parser.add_argument('-r', '--repeat', type=int, default=3, metavar='NUM',\
+            help='keep the best of NUM runs of each stage (default: %(default)s)')
+    suite_parser.add_argument('--save', default=None, metavar='FILE', help='save results as a JSON baseline')
+    suite_parser.add_argument('--compare', default=None, metavar='FILE', help='compare results to a JSON baseline')
+    suite_parser.add_argument('--tolerance', type=float, default=0.2, metavar='RATIO',\
+            help='allowed throughput/memory change before a regression (default: %(default)s)')
+    suite_parser.add_argument('--seed', type=int, default=0, help='random seed (default: %(default)s)')
+    suite_parser.set_defaults(func=bench_suite)
+
+    args = parser.parse_args()
+    args.func(args)
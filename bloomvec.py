@@ -0,0 +1,79 @@
+# bloomvec.py
+#   PatchBits class (Bloom filter membership of all patches of a file type
+#   at once, with numpy)
+#
+#   The Bloom hash lists of the patches of a file type are concatenated
+#   into one array with per-patch offsets. A query gathers the bits of every
+#   hash from the bit vector in one operation, and a segmented minimum over
+#   the offsets tells which patches have all of their bits set, the same
+#   patches as the per-patch loop.
+#
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class PatchBits(object):
+
+    def __init__(self, patch_list):
+        if numpy is None:
+            raise ImportError('vectorized Bloom queries need numpy')
+        self._patch_list = patch_list
+        self._ext_dict = {}
+
+    def _arrays(self, magic_ext):
+        '''
+        Concatenated hash lists of the patches of a file type
+        Return (patch ids, hashes, offsets, ids of patches without hashes)
+        '''
+        arrays = self._ext_dict.get(magic_ext)
+        if arrays is None:
+            id_list = []
+            empty_id_list = []
+            length_list = []
+            for patch_id, patch in enumerate(self._patch_list):
+                if patch.file_ext == magic_ext:
+                    if patch.hash_list:
+                        id_list.append(patch_id)
+                        length_list.append(len(patch.hash_list))
+                    else:
+                        empty_id_list.append(patch_id)
+            hash_array = numpy.fromiter((h for patch_id in id_list for h in self._patch_list[patch_id].hash_list),\
+                    dtype=numpy.uint32, count=sum(length_list))
+            offset_array = numpy.zeros(len(length_list), dtype=numpy.intp)
+            if length_list:
+                numpy.cumsum(length_list[:-1], out=offset_array[1:])
+            arrays = (numpy.array(id_list, dtype=numpy.intp), hash_array, offset_array, empty_id_list)
+            self._ext_dict[magic_ext] = arrays
+        return arrays
+
+    def prepare(self, ext_list):
+        '''
+        Build the arrays of file types ahead of queries
+        '''
+        for magic_ext in ext_list:
+            self._arrays(magic_ext)
+
+    def query(self, bit_vector, magic_ext):
+        '''
+        Query patches of a file type against a bitarray bit vector (a power
+        of two bits)
+        Return ascending ids of patches whose bits are all set
+        '''
+        id_array, hash_array, offset_array, empty_id_list = self._arrays(magic_ext)
+        if not len(id_array):
+            return list(empty_id_list)
+
+        byte_array = numpy.frombuffer(bit_vector, dtype=numpy.uint8)
+        pos_array = hash_array & numpy.uint32(len(bit_vector) - 1)
+        shift_array = (pos_array & 7).astype(numpy.uint8)
+        if bit_vector.endian() == 'big':
+            shift_array = 7 - shift_array
+        bit_array = (byte_array[pos_array >> 3] >> shift_array) & 1
+        match_array = numpy.minimum.reduceat(bit_array, offset_array)
+
+        patch_id_list = id_array[match_array.astype(bool)].tolist()
+        if empty_id_list:
+            patch_id_list = sorted(patch_id_list + empty_id_list)
+        return patch_id_list
@@ -0,0 +1,194 @@
+# classifier.py
+#   FileClassifier class (file type classification without a libmagic call per file)
+#
+#   tiers: pruned directories and oversized files are skipped before they
+#          are opened, known extensions are decided by name, then a shebang
+#          or libmagic on a small prefix decides the rest (archive members
+#          are classified the same way, read only if their name does not
+#          decide)
+#
+#   Types decided by extension are not libmagic's: libmagic calls many
+#   .c/.java/.py/.php/.rb files text/plain, depending on their contents,
+#   while they are typed by language here. Patch hunks are typed by the
+#   same extensions, so a clone is compared with the patches of its
+#   language whatever libmagic makes of the file. --classify magic keeps
+#   libmagic for sources and mimetypes for patches, as before.
+#
+import os
+import stat
+from collections import defaultdict
+import common
+import metrics
+
+# extension -> FileExt (same values as the magic sub_type mapping)
+source_ext_dict = {
+    '.c': common.FileExt.C, '.h': common.FileExt.C,
+    '.cc': common.FileExt.C, '.cpp': common.FileExt.C, '.cxx': common.FileExt.C, '.c++': common.FileExt.C,
+    '.hh': common.FileExt.C, '.hpp': common.FileExt.C, '.hxx': common.FileExt.C,
+    '.java': common.FileExt.Java,
+    '.sh': common.FileExt.ShellScript, '.bash': common.FileExt.ShellScript,
+    '.ksh': common.FileExt.ShellScript, '.zsh': common.FileExt.ShellScript,
+    '.py': common.FileExt.Python,
+    '.pl': common.FileExt.Perl, '.pm': common.FileExt.Perl,
+    '.php': common.FileExt.PHP, '.php3': common.FileExt.PHP, '.php4': common.FileExt.PHP,
+    '.php5': common.FileExt.PHP, '.phtml': common.FileExt.PHP,
+    '.rb': common.FileExt.Ruby,
+}
+
+# extensions of files that are never text
+binary_ext_set = set([
+    '.o', '.obj', '.a', '.lib', '.so', '.dylib', '.dll', '.exe', '.ko',
+    '.class', '.jar', '.war', '.pyc', '.pyo', '.elc',
+    '.png', '.jpg', '.jpeg', '.gif', '.bmp', '.ico', '.tif', '.tiff', '.pdf',
+    '.gz', '.tgz', '.bz2', '.xz', '.lz', '.zip', '.7z', '.rar', '.tar', '.deb', '.rpm', '.iso',
+    '.mp3', '.mp4', '.ogg', '.wav', '.avi', '.ttf', '.otf', '.woff', '.woff2',
+])
+
+# interpreter -> FileExt
+interpreter_dict = {
+    'sh': common.FileExt.ShellScript, 'bash': common.FileExt.ShellScript, 'dash': common.FileExt.ShellScript,
+    'ksh': common.FileExt.ShellScript, 'zsh': common.FileExt.ShellScript,
+    'python': common.FileExt.Python, 'perl': common.FileExt.Perl,
+    'php': common.FileExt.PHP, 'ruby': common.FileExt.Ruby,
+}
+
+
+class FileClassifier(object):
+
+    def __init__(self, stage='source', settings=None):
+        self._settings = settings or common.Settings()
+        self._stage = stage
+        self._count_dict = defaultdict(int)
+
+    def walk(self, path, sort=False):
+        '''
+        Generate file paths, pruning directories before they are entered
+        (in sorted order: files of a directory, then its subdirectories)
+        '''
+        if os.path.isfile(path):
+            metrics.count('files_walked_total', stage=self._stage)
+            yield path
+        elif os.path.isdir(path):
+            for root,dirs,files in os.walk(path):
+                pruned_dirs = [d for d in dirs if d in self._settings.prune_dirs]
+                if pruned_dirs:
+                    self._count_dict['pruned'] += len(pruned_dirs)
+                    metrics.count('dirs_pruned_total', len(pruned_dirs), stage=self._stage)
+                    dirs[:] = [d for d in dirs if d not in self._settings.prune_dirs]
+                if sort:
+                    dirs.sort()
+                    files = sorted(files)
+                metrics.count('files_walked_total', len(files), stage=self._stage)
+                for file in files:
+                    yield os.path.join(root, file)
+
+    def classify(self, file_path):
+        '''
+        Classify a file
+        Return (FileExt or None for non-text files, tier that decided it)
+        '''
+        if self._settings.classify_mode == 'magic':
+            magic_type = common.file_type(file_path, self._settings)
+            return self._magic_ext(magic_type), 'magic'
+
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            return None, 'special'
+        if not stat.S_ISREG(file_stat.st_mode):
+            return None, 'special'
+        if self._settings.max_file_size and file_stat.st_size > self._settings.max_file_size:
+            return None, 'size'
+        magic_ext, tier = self._classify_name(file_path)
+        if tier:
+            return magic_ext, tier
+        with open(file_path, 'rb') as f:
+            prefix = f.read(self._settings.sniff_size)
+        metrics.count('bytes_read_total', len(prefix), kind='prefix')
+        return self._classify_prefix(prefix)
+
+    def classify_buffer(self, file_path, buf):
+        '''
+        Classify file contents already in memory (file_path is only a name)
+        Return (FileExt or None for non-text files, tier that decided it)
+        '''
+        if self._settings.classify_mode == 'magic':
+            return self._magic_ext(common.buffer_type(buf, self._settings)), 'magic'
+
+        if self._settings.max_file_size and len(buf) > self._settings.max_file_size:
+            return None, 'size'
+        magic_ext, tier = self._classify_name(file_path)
+        if tier:
+            return magic_ext, tier
+        return self._classify_prefix(buf[:self._settings.sniff_size])
+
+    def classify_member(self, member_path, size, read):
+        '''
+        Classify an archive member (archive!member), reading it only when its
+        name and size do not decide (size is None if unknown)
+        Return (FileExt or None for non-text files, tier, contents or None)
+        '''
+        member_name = member_path.rsplit('!', 1)[-1]
+        if self._settings.classify_mode != 'magic':
+            if self._settings.max_file_size and size is not None and size > self._settings.max_file_size:
+                return None, 'size', None
+            magic_ext, tier = self._classify_name(member_name)
+            if tier:
+                return magic_ext, tier, None
+        contents = read()
+        metrics.count('bytes_read_total', len(contents), kind='archive')
+        magic_ext, tier = self.classify_buffer(member_name, contents)
+        return magic_ext, tier, contents
+
+    def _classify_name(self, file_path):
+        '''
+        Classify a file by its extension, tier is None if undecided
+        '''
+        ext = os.path.splitext(file_path)[1].lower()
+        if ext in source_ext_dict:
+            return source_ext_dict[ext], 'extension'
+        if ext in binary_ext_set:
+            return None, 'extension'
+        return None, None
+
+    def _classify_prefix(self, prefix):
+        '''
+        Classify a file by a shebang or libmagic on its first bytes
+        '''
+        if prefix.startswith('#!'):
+            magic_ext = self._interpreter_ext(prefix)
+            if magic_ext is not None:
+                return magic_ext, 'shebang'
+        if '\0' in prefix:
+            return None, 'content'
+        if self._settings.magic_cookie is None:
+            return common.FileExt.Text, 'content'
+        return self._magic_ext(common.buffer_type(prefix, self._settings)), 'content'
+
+    def _interpreter_ext(self, prefix):
+        '''
+        Determine a file type from a shebang line
+        '''
+        args = prefix[2:].split('\n', 1)[0].split()
+        if not args:
+            return None
+        interpreter = os.path.basename(args[0])
+        if interpreter == 'env' and len(args) > 1:
+            interpreter = os.path.basename(args[1])
+        interpreter = interpreter.rstrip('0123456789.')
+        return interpreter_dict.get(interpreter)
+
+    def _magic_ext(self, magic_type):
+        '''
+        Determine a file type based upon a MIME type (magic module)
+        '''
+        if not magic_type.startswith('text'):
+            return None
+        main_type, sub_type = magic_type.split(';')[0].strip().split('/')
+        return common.magic_file_ext(sub_type)
+
+    def count(self, tier):
+        self._count_dict[tier] += 1
+
+    def stats(self):
+        return dict(self._count_dict)
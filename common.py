@@ -5,7 +5,11 @@
 #
 import os
 import re
+import math
+import zlib
+import threading
 from collections import namedtuple
+import metrics
 
 
 # global variables
@@ -14,14 +18,70 @@ context_line = 10
 verbose_mode = False
 magic_cookie = None
 bloomfilter_size = 2097152
+bloom_hash_count = 3
 min_mn_ratio = 32
+exact_set_max = 4096
+bloom_probes = 64
+bloom_vectorize = False
+near_threshold = 0.0
+minhash_perm = 64
+query_engine = 'index'
+hash_scheme = 2
+jobs = 1
+cache_dir = None
+normalizer_version = 1
+normalizer_engine = 'scan'
+classify_mode = 'fast'
+prune_dirs = ['.git', '.svn', '.hg', '.bzr', 'CVS']
+max_file_size = 0
+sniff_size = 4096
+scan_archives = False
+prefetch_depth = 8
+prefetch_bytes = 32<<20
+dedup_mode = 'raw'
+patch_dedup = True
+shard_index = 0
+shard_count = 0
+shard_by = 'hash'
+progress_mode = True
+
+# settings of a scan (Settings attributes), the global variables above are
+# their defaults
+setting_names = ('ngram_size', 'context_line', 'verbose_mode', 'progress_mode', 'magic_cookie',
+        'bloomfilter_size', 'bloom_hash_count', 'min_mn_ratio', 'exact_set_max', 'bloom_probes',
+        'bloom_vectorize', 'near_threshold', 'minhash_perm', 'query_engine', 'hash_scheme', 'jobs', 'cache_dir', 'normalizer_engine',
+        'classify_mode', 'prune_dirs', 'max_file_size', 'sniff_size', 'scan_archives',
+        'prefetch_depth', 'prefetch_bytes', 'dedup_mode', 'patch_dedup',
+        'shard_index', 'shard_count', 'shard_by')
+
+
+class Settings(object):
+    '''
+    Settings of a scan, handed to the loaders, the reporter and what they
+    use instead of the global variables, so that scans of different settings
+    can run at the same time
+    '''
+
+    def __init__(self, **settings):
+        '''
+        settings: names in setting_names, others are taken from the global
+        variables
+        '''
+        unknown_names = set(settings) - set(setting_names)
+        if unknown_names:
+            raise TypeError('unknown settings: %s' % ', '.join(sorted(unknown_names)))
+        for name in setting_names:
+            setattr(self, name, settings.get(name, globals()[name]))
+
+    def to_dict(self):
+        return dict((name, getattr(self, name)) for name in setting_names)
 
 PatchInfo = namedtuple('PatchInfo',\
-        ['file_path', 'file_ext', 'orig_lines', 'norm_lines', 'hash_list'])
+        ['file_path', 'file_ext', 'orig_lines', 'norm_lines', 'hash_list', 'ngram_list', 'labels'])
 SourceInfo = namedtuple('SourceInfo',\
-        ['file_path', 'file_ext', 'orig_lines', 'norm_lines'])
+        ['file_path', 'file_ext', 'orig_lines', 'norm_lines', 'digest'])
 ContextInfo = namedtuple('ContextInfo',\
-        ['source_id', 'prev_context_line', 'start_line', 'end_line', 'next_context_line'])
+        ['source_id', 'prev_context_line', 'start_line', 'end_line', 'next_context_line', 'similarity', 'near'])
 
 class FileExt:
     NonText     = 0
@@ -34,6 +94,8 @@ class FileExt:
     PHP         = 7
     Ruby        = 8
 
+file_ext_name_dict = dict((value, name) for name, value in vars(FileExt).items() if not name.startswith('_'))
+
 # html escape chracters
 html_escape_dict = { '&': '&amp;', '>': '&gt;', '<': '&lt;', '"': '&quot;', '\'': '&apos;' }
 
@@ -50,14 +112,63 @@ ruby_partial_comment_regex = re.compile(r'(?P<comment>=begin.*?$|^.*?=end)|(?P<n
 whitespaces_regex = re.compile(r'[\t\x0b\x0c\r ]+')
 
 
-def file_type(file_path):
+def open_magic_cookie():
+    '''
+    Open a libmagic cookie (file-magic or python-magic module)
+    '''
+    import magic
     try:
-        return magic_cookie.from_file(file_path)
+        cookie = magic.open(magic.MAGIC_MIME)
+        cookie.load()
     except AttributeError:
-        return magic_cookie.file(file_path)
+        cookie = magic.Magic(mime=True, uncompress=True)
+    return cookie
+
+# a libmagic cookie is not safe for concurrent calls
+_magic_lock = threading.Lock()
+
+def file_type(file_path, settings=None):
+    cookie = settings.magic_cookie if settings else magic_cookie
+    with _magic_lock:
+        try:
+            return cookie.from_file(file_path)
+        except AttributeError:
+            return cookie.file(file_path)
+
+def buffer_type(buf, settings=None):
+    cookie = settings.magic_cookie if settings else magic_cookie
+    with _magic_lock:
+        try:
+            return cookie.from_buffer(buf)
+        except AttributeError:
+            return cookie.buffer(buf)
+
+def magic_file_ext(sub_type):
+    '''
+    Determine a file type based upon sub_type (magic module)
+    '''
+    if sub_type.startswith('x-c'):
+        return FileExt.C
+    elif sub_type == 'x-java':
+        return FileExt.Java
+    elif sub_type == 'x-shellscript':
+        return FileExt.ShellScript
+    elif sub_type == 'x-perl':
+        return FileExt.Perl
+    elif sub_type == 'x-python' or sub_type == 'x-script.python':
+        return FileExt.Python
+    elif sub_type == 'x-php':
+        return FileExt.PHP
+    elif sub_type == 'x-ruby':
+        return FileExt.Ruby
+    return FileExt.Text
+
+def verbose_print(text, settings=None):
+    if settings.verbose_mode if settings else verbose_mode:
+        print '%s' % text
 
-def verbose_print(text):
-    if verbose_mode:
+def progress_print(text, settings=None):
+    if settings.progress_mode if settings else progress_mode:
         print '%s' % text
 
 def fnv1a_hash(string):
@@ -91,6 +202,91 @@ def sdbm_hash(string):
         hash &= 0xFFFFFFFF
     return hash
 
+def line_hash(line):
+    '''
+    64bit line hash (CRC-32 and Adler-32)
+    '''
+    return (zlib.crc32(line) & 0xFFFFFFFF) | ((zlib.adler32(line) & 0xFFFFFFFF) << 32)
+
+def mix64(hash):
+    '''
+    splitmix64 finalizer (http://xorshift.di.unimi.it/splitmix64.c)
+    '''
+    hash = ((hash ^ (hash >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    hash = ((hash ^ (hash >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return hash ^ (hash >> 31)
+
+def build_ngram_list(norm_lines, settings=None):
+    '''
+    Build a list of n-gram keys from normalized (non-empty) lines
+
+    hash scheme 1: (fnv1a, djb2, sdbm) of the joined n-gram, each character
+                   is hashed ngram_size times by three functions
+    hash scheme 2: each line is hashed once, line hashes are combined over a
+                   rolling window (Rabin-Karp, mod 2^64) and finalized by mix64
+    '''
+    settings = settings or Settings()
+    ngram_size = settings.ngram_size
+    num_ngram = len(norm_lines) - ngram_size + 1
+    if num_ngram <= 0:
+        return []
+
+    ngram_list = []
+    if settings.hash_scheme == 1:
+        for i in range(0, num_ngram):
+            ngram = ''.join(norm_lines[i:i+ngram_size])
+            ngram_list.append((fnv1a_hash(ngram), djb2_hash(ngram), sdbm_hash(ngram)))
+        metrics.count('ngrams_hashed_total', num_ngram)
+        return ngram_list
+
+    base = 0x100000001B3
+    mask = 0xFFFFFFFFFFFFFFFF
+    base_top = pow(base, ngram_size-1, 1<<64)
+    line_hash_list = [line_hash(line) for line in norm_lines]
+    window = 0
+    for h in line_hash_list[:ngram_size]:
+        window = (window * base + h) & mask
+    ngram_list.append(mix64(window))
+    for i in range(ngram_size, len(line_hash_list)):
+        window = ((window - line_hash_list[i-ngram_size] * base_top) * base + line_hash_list[i]) & mask
+        ngram_list.append(mix64(window))
+    metrics.count('ngrams_hashed_total', num_ngram)
+    return ngram_list
+
+def build_hash_list(ngram_list, settings=None):
+    '''
+    Build a Bloom filter hash list (bloom_hash_count bit positions per n-gram)
+    hash scheme 1 keeps its fnv1a/djb2/sdbm positions for 3 hashes, other
+    positions are derived from a 64-bit n-gram hash by double hashing
+    (Kirsch-Mitzenmacher): g_i = h1 + i*h2
+    '''
+    settings = settings or Settings()
+    hash_scheme = settings.hash_scheme
+    hash_list = []
+    bit_mask = settings.bloomfilter_size - 1
+    if hash_scheme == 1 and settings.bloom_hash_count == 3:
+        for hash1, hash2, hash3 in ngram_list:
+            hash_list.append(hash1 & bit_mask)
+            hash_list.append(hash2 & bit_mask)
+            hash_list.append(hash3 & bit_mask)
+        return hash_list
+
+    index_range = range(0, settings.bloom_hash_count)
+    for ngram in ngram_list:
+        if hash_scheme == 1:
+            ngram = ngram[0] | (ngram[1] << 32)
+        h1 = ngram & 0xFFFFFFFF
+        h2 = (ngram >> 32) | 1
+        hash_list.extend([(h1 + i*h2) & bit_mask for i in index_range])
+    return hash_list
+
+def bloom_parameters(fp_rate):
+    '''
+    Bits per n-gram and number of hashes of a Bloom filter with a target
+    false-positive rate: m/n = -ln(p)/ln(2)^2, k = m/n * ln(2)
+    '''
+    mn_ratio = int(math.ceil(-math.log(fp_rate) / math.log(2)**2))
+    return mn_ratio, max(1, int(round(mn_ratio * math.log(2))))
 
 '''
 http://programmers.stackexchange.com/questions/49550/which-hashing-algorithm-is-best-for-uniqueness-and-speed
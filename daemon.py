@@ -0,0 +1,239 @@
+# daemon.py
+#   ScanDaemon class (resident scanner answering scan requests over HTTP)
+#
+#   listens on localhost (HOST:PORT or PORT) or a Unix socket (a path), and
+#   keeps patches loaded between requests, reloading them when files under
+#   the patch path change
+#
+#   A scan request names files on the daemon's machine and the answer shows
+#   their matching lines, so anyone able to connect can read source files
+#   the daemon can read: other hosts than loopback addresses need
+#   allow_remote (--serve-remote).
+#
+#   GET  /status  patches loaded, reloads
+#   POST /scan    {"paths": [source file or directory, ...]} or
+#                 {"files": [{"name": file name, "contents": text}, ...]}
+#                 -> {"results": [{"source_path", "file_ext", "candidates",
+#                                  "matches": [...]}, ...]}
+#
+import os
+import sys
+import json
+import time
+import socket
+import threading
+import SocketServer
+import BaseHTTPServer
+import common
+import archive
+import scanner
+import writer
+
+
+def patch_signature(patch_path):
+    '''
+    Paths, sizes and modification times of files under a patch path
+    '''
+    if os.path.isfile(patch_path):
+        path_list = [patch_path]
+    else:
+        path_list = [os.path.join(root, file) for root, dirs, files in os.walk(patch_path) for file in files]
+    signature = []
+    for path in sorted(path_list):
+        try:
+            path_stat = os.stat(path)
+        except OSError:
+            continue
+        signature.append((path, path_stat.st_size, path_stat.st_mtime))
+    return signature
+
+def is_loopback(host):
+    '''
+    Check if all addresses of a host are loopback addresses
+    '''
+    try:
+        addr_list = socket.getaddrinfo(host, None)
+    except socket.gaierror:
+        return False
+    return all(addr[4][0].startswith('127.') or addr[4][0] == '::1' for addr in addr_list)
+
+def result_dict(result):
+    '''
+    Convert a FileResult into JSON values
+    '''
+    match_list = []
+    for match in result.matches:
+        match_dict = match._asdict()
+        match_dict['patch'] = writer._text(match.patch)
+        match_dict['source'] = writer._text(match.source)
+        match_dict['patch_labels'] = [writer._text(label) for label in match.patch_labels]
+        match_list.append(match_dict)
+    return {
+        'source_path': writer._text(result.source_path),
+        'file_ext': common.file_ext_name_dict.get(result.file_ext),
+        'candidates': result.candidates,
+        'matches': match_list,
+    }
+
+
+class ScanDaemon(object):
+
+    def __init__(self, patch_scanner, patch_path, reload_interval=2.0):
+        self._scanner = patch_scanner
+        self._patch_path = patch_path
+        self._reload_interval = reload_interval
+        self._signature = patch_signature(patch_path)
+        self._nreload = 0
+        self._reload_error = None
+        self._loaded_time = time.time()
+        self._nrequest = 0
+        self._lock = threading.Lock()
+
+    def scanner(self):
+        return self._scanner
+
+    def status(self):
+        return {
+            'patch_path': writer._text(self._patch_path),
+            'patches': self._scanner.patch_count(),
+            'loaded_time': self._loaded_time,
+            'reloads': self._nreload,
+            'reload_error': self._reload_error,
+            'requests': self._nrequest,
+        }
+
+    def scan(self, request):
+        '''
+        Answer a scan request (a dict of paths or files)
+        '''
+        with self._lock:
+            self._nrequest += 1
+        # a reload replaces the scanner, a request keeps the one it started with
+        patch_scanner = self._scanner
+        result_list = []
+        for source_path in request.get('paths', []):
+            source_path = source_path.encode('utf-8') if isinstance(source_path, unicode) else source_path
+            if os.path.isdir(source_path) or (patch_scanner.settings()['scan_archives'] and archive.is_archive(source_path)):
+                result_list += patch_scanner.scan_tree(source_path)
+            elif os.path.exists(source_path):
+                result_list.append(patch_scanner.scan_file(source_path))
+            else:
+                raise ValueError('%s: no such file or directory' % source_path)
+        for source_file in request.get('files', []):
+            name = source_file['name'].encode('utf-8')
+            contents = source_file['contents']
+            if isinstance(contents, unicode):
+                contents = contents.encode('utf-8')
+            result_list.append(patch_scanner.scan_content(name, contents))
+        return {'results': [result_dict(result) for result in result_list]}
+
+    def reload(self):
+        '''
+        Reload patches if files under the patch path changed
+        Return True if patches were reloaded
+        '''
+        signature = patch_signature(self._patch_path)
+        if signature == self._signature:
+            return False
+        settings = self._scanner.settings()
+        try:
+            patch_scanner = scanner.Scanner(**settings)
+            npatch = patch_scanner.load_patches(self._patch_path)
+        except Exception as err:
+            # retried at the next check, reported once
+            if str(err) != self._reload_error:
+                print '[!] reloading patches failed: %s' % err
+            self._reload_error = str(err)
+            return False
+        self._signature = signature
+        self._scanner = patch_scanner
+        self._nreload += 1
+        self._reload_error = None
+        self._loaded_time = time.time()
+        print '[+] reloaded %d patches' % npatch
+        return True
+
+    def _watch(self):
+        while True:
+            time.sleep(self._reload_interval)
+            self.reload()
+
+    def serve(self, address, allow_remote=False):
+        '''
+        Serve scan requests on HOST:PORT, PORT (on localhost) or a Unix
+        socket path, until interrupted
+        allow_remote: listen on other hosts than loopback addresses
+        '''
+        if os.sep in address or not address.rsplit(':', 1)[-1].isdigit():
+            if os.path.exists(address):
+                os.remove(address)
+            server = _UnixHTTPServer(address, _ScanRequestHandler)
+        else:
+            host, port = address.rsplit(':', 1) if ':' in address else ('127.0.0.1', address)
+            if not allow_remote and not is_loopback(host):
+                raise ValueError('%s: not a loopback address, clients could read any file the daemon can read (--serve-remote)' % host)
+            server = _HTTPServer((host, int(port)), _ScanRequestHandler)
+        server.scan_daemon = self
+        if self._reload_interval > 0:
+            watcher = threading.Thread(target=self._watch)
+            watcher.daemon = True
+            watcher.start()
+        print '[+] serving %d patches on %s' % (self._scanner.patch_count(), address)
+        sys.stdout.flush()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            if isinstance(server, _UnixHTTPServer) and os.path.exists(address):
+                os.remove(address)
+
+
+class _HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class _UnixHTTPServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+class _ScanRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path == '/status':
+            self._reply(200, self.server.scan_daemon.status())
+        else:
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+
+    def do_POST(self):
+        if self.path != '/scan':
+            self._reply(404, {'error': 'unknown path %s' % self.path})
+            return
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            if not isinstance(request, dict):
+                raise ValueError('a request is a JSON object')
+            response = self.server.scan_daemon.scan(request)
+        except (ValueError, KeyError, TypeError) as err:
+            self._reply(400, {'error': str(err)})
+        except Exception as err:
+            self._reply(500, {'error': '%s: %s' % (type(err).__name__, err)})
+        else:
+            self._reply(200, response)
+
+    def _reply(self, code, body):
+        data = json.dumps(body, sort_keys=True) + '\n'
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return self.client_address[0] if self.client_address else 'unix'
+
+    def log_message(self, format, *args):
+        if self.server.scan_daemon.scanner().settings()['verbose_mode']:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format, *args)
@@ -0,0 +1,129 @@
+# gitrange.py
+#   GitRange class (files changed between two revisions of a local git repository)
+#
+import os
+import json
+import subprocess
+import common
+import textlines
+
+# git file modes of regular files
+regular_mode_set = set(['100644', '100755'])
+
+
+class GitRange(object):
+
+    def __init__(self, repo_path, old_rev, new_rev):
+        self._repo_path = repo_path
+        self._old_rev = self._rev_parse(old_rev)
+        self._new_rev = self._rev_parse(new_rev)
+        self._change_list = None
+
+    def _git(self, *args):
+        return subprocess.check_output(('git', '-C', self._repo_path) + args)
+
+    def _rev_parse(self, rev):
+        return self._git('rev-parse', '--verify', '%s^{commit}' % rev).strip()
+
+    def source_path(self, path):
+        '''
+        Path of a repository file as reported by a full scan of repo_path
+        '''
+        return os.path.join(self._repo_path, path)
+
+    def changes(self):
+        '''
+        List (status, path, new mode) of files changed between revisions,
+        status is A(dded), M(odified), D(eleted) or T(ype changed)
+        '''
+        if self._change_list is None:
+            output = self._git('diff-tree', '-r', '-z', '--no-renames', self._old_rev, self._new_rev)
+            fields = output.split('\0')
+            self._change_list = []
+            for i in range(0, len(fields)-1, 2):
+                old_mode, new_mode, old_sha, new_sha, status = fields[i].lstrip(':').split()
+                self._change_list.append((status, fields[i+1], new_mode))
+        return self._change_list
+
+    def changed_paths(self):
+        '''
+        Source paths whose previous results are stale
+        '''
+        return set(self.source_path(path) for status, path, new_mode in self.changes())
+
+    def read_files(self):
+        '''
+        Generate (source path, contents) of added or modified regular files
+        at the new revision, each blob is read once with git cat-file
+        '''
+        return self._read_paths([path for status, path, new_mode in self.changes()\
+                if status != 'D' and new_mode in regular_mode_set and '\n' not in path])
+
+    def read_sources(self, source_path_list):
+        '''
+        Generate (source path, contents) of files of the new revision given
+        by their source paths (files missing there are left out)
+        '''
+        return self._read_paths([os.path.relpath(source_path, self._repo_path) for source_path in source_path_list])
+
+    def _read_paths(self, path_list):
+        if not path_list:
+            return
+        proc = subprocess.Popen(['git', '-C', self._repo_path, 'cat-file', '--batch'],\
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            for path in path_list:
+                proc.stdin.write('%s:%s\n' % (self._new_rev, path))
+                proc.stdin.flush()
+                header = proc.stdout.readline().split()
+                if len(header) != 3 or header[1] != 'blob':
+                    # a missing object has no contents to skip
+                    continue
+                contents = proc.stdout.read(int(header[2]))
+                proc.stdout.read(1)
+                yield self.source_path(path), contents
+        finally:
+            proc.stdin.close()
+            proc.wait()
+
+
+def load_results(result_path, stale_path_set):
+    '''
+    Load JSON Lines records of a previous scan, except those of stale paths
+    '''
+    stale_path_set = set(path.decode('utf-8', 'replace') if isinstance(path, str) else path for path in stale_path_set)
+    record_list = []
+    with open(result_path, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record['source'] not in stale_path_set:
+                record_list.append(record)
+    return record_list
+
+def previous_matches(record_list, patch_list, git_range):
+    '''
+    Turn kept records into matches of the loaded patches, with source lines
+    of the new revision (the files are unchanged since the old one)
+    Return ([(patch_id, SourceInfo, ContextInfo)], records of patches no
+    longer loaded)
+    '''
+    patch_id_dict = dict((_text(p.file_path), patch_id) for patch_id, p in enumerate(patch_list))
+    kept_list = [record for record in record_list if record['patch'] in patch_id_dict]
+    source_dict = {}
+    for source_path, contents in git_range.read_sources(sorted(set(record['source'].encode('utf-8') for record in kept_list))):
+        source_dict[source_path] = common.SourceInfo(source_path, None, textlines.TextLines(text=contents), None, None)
+
+    match_list = []
+    for record in kept_list:
+        source_info = source_dict.get(record['source'].encode('utf-8'))
+        if source_info is None:
+            continue
+        context = common.ContextInfo(-1, record['context_start_line']-1, record['start_line']-1, record['end_line'],\
+                record['context_end_line'], record.get('similarity', 1.0), 'similarity' in record)
+        match_list.append((patch_id_dict[record['patch']], source_info, context))
+    return match_list, len(record_list) - len(kept_list)
+
+def _text(string):
+    return string.decode('utf-8', 'replace') if isinstance(string, str) else string
@@ -0,0 +1,64 @@
+# matcher.py
+#   LineMatcher class (Aho-Corasick automaton over normalized lines)
+#
+from collections import deque
+
+
+class LineMatcher(object):
+
+    def __init__(self):
+        self._goto = [{}]
+        self._fail = [0]
+        self._output = [[]]
+        self._length = {}
+
+    def add(self, key, lines):
+        '''
+        Add a pattern (a sequence of normalized lines)
+        '''
+        state = 0
+        for line in lines:
+            next_state = self._goto[state].get(line)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+                self._goto[state][line] = next_state
+            state = next_state
+        self._output[state].append(key)
+        self._length[key] = len(lines)
+
+    def build(self):
+        '''
+        Build failure links (breadth-first)
+        '''
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for line, next_state in self._goto[state].iteritems():
+                queue.append(next_state)
+                fail_state = self._fail[state]
+                while fail_state and line not in self._goto[fail_state]:
+                    fail_state = self._fail[fail_state]
+                self._fail[next_state] = self._goto[fail_state].get(line, 0)
+                if self._output[self._fail[next_state]]:
+                    self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+
+    def search(self, lines):
+        '''
+        Find every occurrence of every pattern in one pass
+        Return a list of (key, start index) in the order of end index
+        '''
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        match_list = []
+        state = 0
+        for i, line in enumerate(lines):
+            while state and line not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(line, 0)
+            for key in output[state]:
+                match_list.append((key, i-self._length[key]+1))
+        return match_list
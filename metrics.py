@@ -0,0 +1,159 @@
+# metrics.py
+#   Metrics class (counters and timers of a run, written as JSON or
+#   Prometheus text)
+#
+#   Counters are kept per (name, labels) in the process that updates them;
+#   worker processes hand theirs over with drain() and the main process
+#   merges them, so a metrics file covers the whole run. A traversal also
+#   collects its own counters in a registry of its own, so that its summary
+#   leaves out earlier traversals of a long-lived process.
+#
+import os
+import time
+import json
+import cProfile
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+
+METRICS_PREFIX = 'redebug_'
+
+
+class Metrics(object):
+
+    def __init__(self):
+        self._value_dict = defaultdict(int)
+
+    def count(self, name, value=1, **labels):
+        '''
+        Add value to a counter
+        '''
+        self._value_dict[(name, tuple(sorted(labels.items())))] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        '''
+        Add the elapsed time of a block to a counter (in seconds)
+        '''
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.count(name, time.time() - start_time, **labels)
+
+    def get(self, name, **labels):
+        return self._value_dict.get((name, tuple(sorted(labels.items()))), 0)
+
+    def samples(self, name):
+        '''
+        List (labels, value) of a counter
+        '''
+        return [(dict(labels), value) for (sample_name, labels), value in sorted(self._value_dict.items()) if sample_name == name]
+
+    def drain(self):
+        '''
+        Return and reset counters (to be merged by another process)
+        '''
+        value_dict = dict(self._value_dict)
+        self._value_dict.clear()
+        return value_dict
+
+    def merge(self, value_dict):
+        for key, value in value_dict.items():
+            self._value_dict[key] += value
+
+    def to_json(self):
+        sample_list = []
+        for (name, labels), value in sorted(self._value_dict.items()):
+            sample_list.append({'name': name, 'labels': dict(labels), 'value': value})
+        return json.dumps({'metrics': sample_list}, indent=2, sort_keys=True) + '\n'
+
+    def to_prometheus(self):
+        lines = []
+        last_name = None
+        for (name, labels), value in sorted(self._value_dict.items()):
+            if name != last_name:
+                lines.append('# TYPE %s%s counter' % (METRICS_PREFIX, name))
+                last_name = name
+            label_text = ','.join('%s="%s"' % (key, str(label).replace('\\', '\\\\').replace('"', '\\"')) for key, label in labels)
+            lines.append('%s%s%s %s' % (METRICS_PREFIX, name, '{%s}' % label_text if label_text else '', repr(value)))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, metrics_format='json'):
+        '''
+        Write counters to a file (json or prometheus)
+        '''
+        with open(path, 'w') as f:
+            f.write(self.to_prometheus() if metrics_format == 'prometheus' else self.to_json())
+
+
+# metrics of this process
+default = Metrics()
+# registries of the blocks being collected by each thread
+_local = threading.local()
+
+def _registry_list():
+    return [default] + getattr(_local, 'registry_list', [])
+
+def count(name, value=1, **labels):
+    '''
+    Add value to a counter of this process and of the blocks being collected
+    '''
+    for registry in _registry_list():
+        registry.count(name, value, **labels)
+
+@contextmanager
+def timer(name, **labels):
+    '''
+    Add the elapsed time of a block to a counter (in seconds)
+    '''
+    start_time = time.time()
+    try:
+        yield
+    finally:
+        count(name, time.time() - start_time, **labels)
+
+def merge(value_dict):
+    '''
+    Merge counters drained by another process
+    '''
+    for registry in _registry_list():
+        registry.merge(value_dict)
+
+@contextmanager
+def collect(registry=None):
+    '''
+    Count into a registry (a new one by default) as well within a block of
+    the calling thread, and yield the registry
+    '''
+    if registry is None:
+        registry = Metrics()
+    registry_list = _local.__dict__.setdefault('registry_list', [])
+    if registry in registry_list:
+        yield registry
+        return
+    registry_list.append(registry)
+    try:
+        yield registry
+    finally:
+        registry_list.remove(registry)
+
+@contextmanager
+def stage(name, profile_dir=None):
+    '''
+    Time a stage of a run, and profile it into profile_dir/<name>.prof
+    (only the calling process is profiled)
+    '''
+    profiler = None
+    if profile_dir:
+        if not os.path.isdir(profile_dir):
+            os.makedirs(profile_dir)
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        with timer('stage_seconds_total', stage=name):
+            yield
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(profile_dir, '%s.prof' % name))
@@ -0,0 +1,210 @@
+# minhash.py
+#   NearIndex class (MinHash/LSH candidates of near clones) and the exact
+#   similarity of a patch to its best-matching window of a source file
+#
+#   A patch hunk is compared to windows of a source file about as long as
+#   the hunk, as a whole file shares only a small fraction of its n-grams
+#   with any patch. Patches are indexed by MinHash signatures of their
+#   n-gram sets, banded into LSH tables per file type and window length (a
+#   geometric grid). A source file is permuted once and the signature of a
+#   window is the minimum of each permutation over the window, so a file
+#   costs the same whatever the number of patches, and a patch becomes a
+#   candidate when one band of a window collides with it. Candidates are
+#   verified by their exact Jaccard similarity.
+#
+#   A query handles one permutation at a time: the minima of 2^k
+#   consecutive values are built by doubling, and the minimum of a window
+#   is that of two such runs covering it, taken for all window starts at
+#   once (with numpy when it is available, giving the same values). Only
+#   the window minima of the permutations of one band are kept.
+#
+import math
+import random
+from collections import defaultdict
+import metrics
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# a Mersenne prime for permutations (a*x + b) mod prime, small enough for
+# a*x + b to stay a machine integer once keys are reduced modulo the prime
+_prime = (1 << 31) - 1
+# patches of fewer n-grams are only matched exactly
+min_ngram = 4
+# ratio of consecutive window lengths
+window_ratio = 2 ** 0.25
+# windows start every 1/window_steps of their length
+window_steps = 8
+# the LSH threshold is lowered by the similarity a window of the grid and
+# the stride can lose against the best-matching window
+lsh_slack = 0.7
+
+
+def ngram_key(ngram):
+    '''
+    64-bit key of an n-gram (hash scheme 1 n-grams are hash triples)
+    '''
+    if isinstance(ngram, tuple):
+        return ngram[0] | (ngram[1] << 32)
+    return ngram
+
+def window_length(nngram):
+    '''
+    Length of the source windows a patch of nngram n-grams is compared to
+    '''
+    return int(round(window_ratio ** round(math.log(nngram, window_ratio))))
+
+def lsh_parameters(threshold, num_perm):
+    '''
+    Bands and rows per band (bands*rows <= num_perm) of an LSH whose
+    candidate probability 1-(1-s^rows)^bands rises at threshold
+    '''
+    param_list = []
+    for rows in range(1, num_perm+1):
+        bands = num_perm / rows
+        param_list.append((abs((1.0/bands) ** (1.0/rows) - threshold), -bands*rows, bands, rows))
+    return min(param_list)[2:]
+
+def _minimum(value_list, other_list):
+    '''
+    Element-wise minimum of two sequences of the same length
+    '''
+    if numpy is not None:
+        return numpy.minimum(value_list, other_list)
+    return map(min, value_list, other_list)
+
+def best_window(patch_key_set, source_key_list, length):
+    '''
+    Window of a source key list most similar to a patch key set
+    Return (Jaccard similarity, start index) of the first best window
+    '''
+    length = min(length, len(source_key_list))
+    last_start = len(source_key_list) - length
+    # only windows holding a key of the patch are similar at all: slide over
+    # the runs of window starts within length of such keys
+    range_list = []
+    for i in [i for i, key in enumerate(source_key_list) if key in patch_key_set]:
+        start = max(0, i-length+1)
+        if range_list and start <= range_list[-1][1] + 1:
+            range_list[-1][1] = min(i, last_start)
+        else:
+            range_list.append([start, min(i, last_start)])
+    best = (0.0, 0)
+    for start, end in range_list:
+        count_dict = defaultdict(int)
+        ncommon = 0
+        for key in source_key_list[start:start+length]:
+            count_dict[key] += 1
+            if count_dict[key] == 1 and key in patch_key_set:
+                ncommon += 1
+        similarity = float(ncommon) / (len(patch_key_set) + len(count_dict) - ncommon)
+        if similarity > best[0]:
+            best = (similarity, start)
+        for j in range(start+1, end+1):
+            key = source_key_list[j-1]
+            count_dict[key] -= 1
+            if count_dict[key] == 0:
+                del count_dict[key]
+                if key in patch_key_set:
+                    ncommon -= 1
+            key = source_key_list[j+length-1]
+            count_dict[key] += 1
+            if count_dict[key] == 1 and key in patch_key_set:
+                ncommon += 1
+            similarity = float(ncommon) / (len(patch_key_set) + len(count_dict) - ncommon)
+            if similarity > best[0]:
+                best = (similarity, j)
+    return best
+
+
+class NearIndex(object):
+
+    def __init__(self, patch_list, threshold, num_perm=64, seed=0):
+        rand = random.Random(seed)
+        self._perm_list = [(rand.randint(1, _prime-1), rand.randint(0, _prime-1)) for i in range(num_perm)]
+        self._bands, self._rows = lsh_parameters(threshold * lsh_slack, num_perm)
+        # (file type, window length) -> [{band: [patch_id]}] per band
+        self._table_dict = {}
+        self._window_dict = defaultdict(set)
+        self._nindexed = 0
+        for patch_id, patch in enumerate(patch_list):
+            key_set = set(int(ngram_key(ngram) % _prime) for ngram in patch.ngram_list)
+            if len(key_set) < min_ngram:
+                continue
+            length = window_length(len(patch.ngram_list))
+            table_list = self._table_dict.get((patch.file_ext, length))
+            if table_list is None:
+                table_list = [defaultdict(list) for i in range(self._bands)]
+                self._table_dict[(patch.file_ext, length)] = table_list
+                self._window_dict[patch.file_ext].add(length)
+            signature = [min((a*key + b) % _prime for key in key_set) for a, b in self._perm_list]
+            for band, table in enumerate(table_list):
+                table[tuple(signature[band*self._rows:(band+1)*self._rows])].append(patch_id)
+            self._nindexed += 1
+
+    def stats(self):
+        '''
+        Return (indexed patches, bands, rows per band)
+        '''
+        return self._nindexed, self._bands, self._rows
+
+    def query(self, ngram_list, magic_ext):
+        '''
+        Query patches colliding with windows of a source file
+        Return ascending candidate patch ids
+        '''
+        length_set = self._window_dict.get(magic_ext)
+        if not length_set or not ngram_list:
+            return []
+        key_list = [int(ngram_key(ngram) % _prime) for ngram in ngram_list]
+        if numpy is not None:
+            key_list = numpy.array(key_list, dtype=numpy.int64)
+
+        # (LSH tables, doubling level, stride, last window start, offset of
+        # the second run of a window)
+        window_list = []
+        nlevel = 1
+        nwindow = 0
+        for length in sorted(length_set):
+            window = min(length, len(key_list))
+            stride = max(1, length / window_steps)
+            last_start = len(key_list) - window
+            level = window.bit_length() - 1
+            window_list.append((self._table_dict[(magic_ext, length)], level, stride, last_start, window - (1 << level)))
+            nlevel = max(nlevel, level + 1)
+            nwindow += last_start / stride + 1 + (1 if last_start % stride else 0)
+
+        rows = self._rows
+        candidate_set = set()
+        for band in range(self._bands):
+            minima_list = [[] for window in window_list]
+            for a, b in self._perm_list[band*rows:(band+1)*rows]:
+                if numpy is not None:
+                    value_list = (key_list * a + b) % _prime
+                else:
+                    value_list = [(a*key + b) % _prime for key in key_list]
+                # minima of 1, 2, 4, ... consecutive values
+                level_list = [value_list]
+                while len(level_list) < nlevel:
+                    half = 1 << (len(level_list) - 1)
+                    level_list.append(_minimum(value_list[:-half], value_list[half:]))
+                    value_list = level_list[-1]
+                for minima, (table_list, level, stride, last_start, shift) in zip(minima_list, window_list):
+                    value_list = level_list[level]
+                    window_minima = _minimum(value_list[:last_start+1:stride], value_list[shift:shift+last_start+1:stride])
+                    if numpy is not None:
+                        window_minima = window_minima.tolist()
+                    if last_start % stride:
+                        window_minima.append(int(min(value_list[last_start], value_list[last_start+shift])))
+                    minima.append(window_minima)
+                del level_list
+            for minima, (table_list, level, stride, last_start, shift) in zip(minima_list, window_list):
+                table = table_list[band]
+                for signature in zip(*minima):
+                    id_list = table.get(signature)
+                    if id_list:
+                        candidate_set.update(id_list)
+        metrics.count('near_windows_total', nwindow)
+        metrics.count('near_candidates_total', len(candidate_set))
+        return sorted(candidate_set)
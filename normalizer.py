@@ -0,0 +1,170 @@
+# normalizer.py
+#   single-pass normalizer engine
+#
+#   Strips comments (keeping newlines of source multi-line comments), drops
+#   whitespace except newlines and lowercases in one left-to-right scan,
+#   with the same output as the comment regexes in common.py. Plain text is
+#   skipped with a character class search, and a quote or block comment
+#   that is never closed is remembered so that later ones are not searched
+#   for again to the end of the input, which keeps the scan linear.
+#
+import re
+import string
+import common
+
+# lowercase and drop whitespaces except newlines in one translate() call
+_lower_table = string.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+_whitespaces = '\t\x0b\x0c\r '
+
+_brace_run_regex = re.compile(r'[{}]+')
+_literal_end_regex = {'\'': re.compile(r'[\\\']'), '"': re.compile(r'[\\"]')}
+
+
+class Grammar(object):
+    '''
+    Comment syntax of a language (one of the comment regexes in common.py)
+    '''
+
+    def __init__(self, special, line_comments=(), brace_comment=False, block_comment=None, partial=False):
+        self.special = re.compile(special)
+        self.line_comments = line_comments
+        self.brace_comment = brace_comment
+        self.block_comment = block_comment
+        self.partial = partial
+
+c_grammar = Grammar(r'[/\'"{}]', line_comments=('//',), brace_comment=True, block_comment=('/*', '*/'))
+c_partial_grammar = Grammar(r'[/\'"]', block_comment=('/*', '*/'), partial=True)
+shellscript_grammar = Grammar(r'[#\'"]', line_comments=('#',))
+perl_grammar = Grammar(r'[#\'"{}]', line_comments=('#',), brace_comment=True)
+php_grammar = Grammar(r'[#/\'"{}]', line_comments=('#', '//'), brace_comment=True, block_comment=('/*', '*/'))
+ruby_grammar = Grammar(r'[#=\'"]', line_comments=('#',), block_comment=('=begin', '=end'))
+ruby_partial_grammar = Grammar(r'[=\'"]', block_comment=('=begin', '=end'), partial=True)
+
+
+def _scan(text, grammar, keep_newlines, finish):
+    '''
+    Remove comments of a grammar from text in one scan
+    keep_newlines: replace a block comment with its newlines
+    finish: also drop whitespaces and lowercase kept text
+    '''
+    out = []
+    if finish:
+        append = lambda chunk: out.append(chunk.translate(_lower_table, _whitespaces))
+    else:
+        append = out.append
+    n = len(text)
+    search = grammar.special.search
+    line_comments = grammar.line_comments
+    block_open, block_close = grammar.block_comment or (None, None)
+    # a literal or block comment left open from here on is never closed
+    open_literal = {'\'': n, '"': n}
+    open_block = n
+
+    keep = 0
+    p = 0
+    if grammar.partial:
+        # ^.*?*/ (only at the start), /*.*?$ (to the end)
+        if not text.startswith(block_open):
+            q = text.find(block_close)
+            if q >= 0:
+                keep = p = q + len(block_close)
+
+    while True:
+        m = search(text, p)
+        if m is None:
+            break
+        p = m.start()
+        c = text[p]
+        end = -1
+
+        if c == '\'' or c == '"':
+            # string literal: keep as it is, but do not look inside
+            q = p + 1
+            if p < open_literal[c]:
+                literal_end = _literal_end_regex[c].search
+                while True:
+                    e = literal_end(text, q)
+                    if e is None:
+                        q = -1
+                        break
+                    q = e.start()
+                    if text[q] == c:
+                        q += 1
+                        break
+                    q += 2
+                    if q > n:
+                        q = -1
+                        break
+                if q < 0:
+                    open_literal[c] = p
+                    q = p + 1
+            p = q
+            continue
+
+        for line_comment in line_comments:
+            if text.startswith(line_comment, p):
+                end = text.find('\n', p)
+                if end < 0:
+                    end = n
+                replacement = ''
+                break
+        else:
+            if grammar.brace_comment and (c == '{' or c == '}'):
+                end = _brace_run_regex.match(text, p).end()
+                replacement = ''
+            elif block_open and text.startswith(block_open, p):
+                if grammar.partial:
+                    end = n-1 if text.endswith('\n') else n
+                    replacement = ''
+                elif p < open_block:
+                    q = text.find(block_close, p+len(block_open))
+                    if q < 0:
+                        open_block = p
+                    else:
+                        end = q + len(block_close)
+                        replacement = '\n' * text.count('\n', p, end) if keep_newlines else ''
+
+        if end < 0:
+            p += 1
+        else:
+            if keep < p:
+                append(text[keep:p])
+            if replacement:
+                out.append(replacement)
+            keep = p = end
+
+    if keep < n:
+        append(text[keep:])
+    return ''.join(out)
+
+def normalize_source(source, ext):
+    '''
+    Normalize a source file (same as SourceLoader._normalize)
+    '''
+    if ext==common.FileExt.C or ext==common.FileExt.Java:
+        return _scan(source, c_grammar, True, True)
+    elif ext==common.FileExt.ShellScript or ext==common.FileExt.Python:
+        return _scan(source, shellscript_grammar, False, True)
+    elif ext==common.FileExt.Perl:
+        return _scan(source, perl_grammar, False, True)
+    elif ext==common.FileExt.PHP:
+        return _scan(source, php_grammar, True, True)
+    elif ext==common.FileExt.Ruby:
+        return _scan(source, ruby_grammar, True, True)
+    return source.translate(_lower_table, _whitespaces)
+
+def normalize_patch(patch, ext):
+    '''
+    Normalize a patch hunk (same as PatchLoader._normalize)
+    '''
+    if ext==common.FileExt.C or ext==common.FileExt.Java:
+        return _scan(_scan(patch, c_grammar, False, False), c_partial_grammar, False, True)
+    elif ext==common.FileExt.ShellScript or ext==common.FileExt.Python:
+        return _scan(patch, shellscript_grammar, False, True)
+    elif ext==common.FileExt.Perl:
+        return _scan(patch, perl_grammar, False, True)
+    elif ext==common.FileExt.PHP:
+        return _scan(_scan(patch, php_grammar, False, False), c_partial_grammar, False, True)
+    elif ext==common.FileExt.Ruby:
+        return _scan(_scan(patch, ruby_grammar, False, False), ruby_partial_grammar, False, True)
+    return patch.translate(_lower_table, _whitespaces)
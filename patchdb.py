@@ -0,0 +1,217 @@
+# patchdb.py
+#   compiled patch database (written by --compile-patches, loaded via mmap)
+#
+#   header   : magic, format, ngram_size, hash_scheme, bloomfilter_size,
+#              bloom_hash_count, normalizer_version, patch_dedup, magic typing
+#              (--classify magic), npatch, next
+#   patches  : npatch x (meta offset/length, hash list offset/count,
+#              n-gram list offset/count, file_ext, distinct n-grams)
+#   index    : next x (file_ext, nkey, key/posting offset/id offsets, nid)
+#   data     : marshalled (file_path, orig_lines, norm_lines, labels), uint32 hash
+#              lists, uint64 n-gram lists, sorted uint64 index keys with
+#              uint32 posting offsets and patch ids
+#
+#   All integers are little-endian, whatever the host.
+#
+import os
+import mmap
+import struct
+import marshal
+import common
+
+PATCHDB_MAGIC = 'RDBPATCH'
+# 4: hunk file types from the classifier's source extensions first
+# 5: little-endian lists whatever the host, patch_dedup in the header
+# 6: hunk file types from the mimetypes module again
+# 7: hunk file types by --classify mode, recorded in the header
+PATCHDB_FORMAT = 7
+
+_header = struct.Struct('<8sIIIIIIIIII')
+_patch_entry = struct.Struct('<QIQIQIII')
+_index_entry = struct.Struct('<IIQQQI')
+
+
+def is_patchdb(path):
+    '''
+    Check if a file is a compiled patch database
+    '''
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(PATCHDB_MAGIC)) == PATCHDB_MAGIC
+
+def _pack(typecode, values):
+    '''
+    Pack a list of uint32 ('I') or uint64 ('Q') values
+    '''
+    return struct.pack('<%d%s' % (len(values), typecode), *values)
+
+def write_patchdb(path, patch_list, ngram_index, ngram_count, settings=None):
+    '''
+    Write patches and their inverted n-gram index to a compiled database
+    '''
+    settings = settings or common.Settings()
+    if settings.hash_scheme == 1:
+        raise ValueError('hash scheme 1 cannot be compiled')
+
+    data = []
+    offset = [_header.size + _patch_entry.size*len(patch_list) + _index_entry.size*len(ngram_index)]
+    def append(blob):
+        data.append(blob)
+        offset[0] += len(blob)
+        return offset[0] - len(blob)
+
+    patch_table = []
+    for patch_id, p in enumerate(patch_list):
+        meta = marshal.dumps((p.file_path, p.orig_lines, list(p.norm_lines), list(p.labels)))
+        meta_offset = append(meta)
+        hash_offset = append(_pack('I', p.hash_list))
+        ngram_offset = append(_pack('Q', p.ngram_list))
+        patch_table.append(_patch_entry.pack(meta_offset, len(meta), hash_offset, len(p.hash_list),\
+                ngram_offset, len(p.ngram_list), p.file_ext, ngram_count[patch_id]))
+
+    index_table = []
+    for file_ext in sorted(ngram_index):
+        keys = sorted(ngram_index[file_ext])
+        posting_offsets = [0]
+        patch_ids = []
+        for key in keys:
+            patch_ids.extend(ngram_index[file_ext][key])
+            posting_offsets.append(len(patch_ids))
+        keys_offset = append(_pack('Q', keys))
+        posting_offset = append(_pack('I', posting_offsets))
+        ids_offset = append(_pack('I', patch_ids))
+        index_table.append(_index_entry.pack(file_ext, len(keys), keys_offset, posting_offset, ids_offset, len(patch_ids)))
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(_header.pack(PATCHDB_MAGIC, PATCHDB_FORMAT, settings.ngram_size, settings.hash_scheme,\
+                settings.bloomfilter_size, settings.bloom_hash_count, common.normalizer_version, int(settings.patch_dedup),\
+                int(settings.classify_mode == 'magic'), len(patch_list), len(ngram_index)))
+        f.write(''.join(patch_table))
+        f.write(''.join(index_table))
+        for blob in data:
+            f.write(blob)
+    os.rename(tmp_path, path)
+
+
+class CompiledPatchList(object):
+    '''
+    Read-only sequence of PatchInfo, decoded on first access
+    '''
+
+    def __init__(self, buf, npatch):
+        self._buf = buf
+        self._npatch = npatch
+        self._patch_list = [None] * npatch
+
+    def __len__(self):
+        return self._npatch
+
+    def __iter__(self):
+        for patch_id in xrange(self._npatch):
+            yield self[patch_id]
+
+    def __getitem__(self, patch_id):
+        p = self._patch_list[patch_id]
+        if p is None:
+            if patch_id < 0:
+                patch_id += self._npatch
+            meta_offset, meta_length, hash_offset, nhash, ngram_offset, nngram, file_ext, ndistinct =\
+                    _patch_entry.unpack_from(self._buf, _header.size + _patch_entry.size*patch_id)
+            file_path, orig_lines, norm_lines, labels = marshal.loads(self._buf[meta_offset:meta_offset+meta_length])
+            hash_list = list(struct.unpack_from('<%dI' % nhash, self._buf, hash_offset))
+            ngram_list = list(struct.unpack_from('<%dQ' % nngram, self._buf, ngram_offset))
+            p = common.PatchInfo(file_path, file_ext, orig_lines, norm_lines, hash_list, ngram_list, labels)
+            self._patch_list[patch_id] = p
+        return p
+
+
+class CompiledNgramCount(object):
+    '''
+    Read-only sequence of distinct n-gram counts, read from patch entries
+    '''
+
+    def __init__(self, buf, npatch):
+        self._buf = buf
+        self._npatch = npatch
+
+    def __len__(self):
+        return self._npatch
+
+    def __getitem__(self, patch_id):
+        if not 0 <= patch_id < self._npatch:
+            raise IndexError('patch id out of range')
+        return _patch_entry.unpack_from(self._buf, _header.size + _patch_entry.size*patch_id)[7]
+
+
+class CompiledIndex(object):
+    '''
+    Read-only inverted n-gram index of one file type (sorted keys searched
+    in the mapped database, nothing is copied until a key is found)
+    '''
+
+    def __init__(self, buf, nkey, keys_offset, posting_offset, ids_offset, nid):
+        self._buf = buf
+        self._nkey = nkey
+        self._keys_offset = keys_offset
+        self._posting_offset = posting_offset
+        self._ids_offset = ids_offset
+
+    def __len__(self):
+        return self._nkey
+
+    def get(self, key, default=None):
+        lo, hi = 0, self._nkey
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if struct.unpack_from('<Q', self._buf, self._keys_offset + 8*mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self._nkey and struct.unpack_from('<Q', self._buf, self._keys_offset + 8*lo)[0] == key:
+            start, end = struct.unpack_from('<II', self._buf, self._posting_offset + 4*lo)
+            return struct.unpack_from('<%dI' % (end - start), self._buf, self._ids_offset + 4*start)
+        return default
+
+
+class PatchDB(object):
+
+    def __init__(self, path, settings=None):
+        settings = settings or common.Settings()
+        with open(path, 'rb') as f:
+            self._buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = struct.unpack_from('<8sI', self._buf, 0)
+        if magic != PATCHDB_MAGIC:
+            raise ValueError('%s: unsupported patch database format' % path)
+        if version != PATCHDB_FORMAT:
+            raise ValueError('%s: patch database format %d, compile the patches again for format %d' % (path, version, PATCHDB_FORMAT))
+        magic, version, ngram_size, hash_scheme, bloomfilter_size, bloom_hash_count, normalizer_version, patch_dedup, magic_typing, npatch, next =\
+                _header.unpack_from(self._buf, 0)
+        db_settings = (ngram_size, hash_scheme, bloomfilter_size, bloom_hash_count, normalizer_version, bool(patch_dedup),\
+                'magic' if magic_typing else 'fast')
+        if db_settings != (settings.ngram_size, settings.hash_scheme, settings.bloomfilter_size, settings.bloom_hash_count, common.normalizer_version,\
+                settings.patch_dedup, 'magic' if settings.classify_mode == 'magic' else 'fast'):
+            raise ValueError(('%s: compiled with ngram_size %d, hash_scheme %d, bloomfilter_size %d, bloom_hash_count %d, normalizer_version %d, ' +\
+                    'patch_dedup %s, classify_mode %s') % ((path,) + db_settings))
+
+        self._npatch = npatch
+        self._patch_list = CompiledPatchList(self._buf, npatch)
+        self._ngram_count = CompiledNgramCount(self._buf, npatch)
+        self._ngram_index = {}
+        index_table_offset = _header.size + _patch_entry.size*npatch
+        for i in xrange(next):
+            entry = _index_entry.unpack_from(self._buf, index_table_offset + _index_entry.size*i)
+            self._ngram_index[entry[0]] = CompiledIndex(self._buf, *entry[1:])
+
+    def items(self):
+        return self._patch_list
+
+    def length(self):
+        return self._npatch
+
+    def index(self):
+        return self._ngram_index
+
+    def ngram_count(self):
+        return self._ngram_count
@@ -7,41 +7,68 @@ import os
 import re
 import time
 import mimetypes
+from collections import defaultdict
 import common
+import patchdb
+import classifier
+import normalizer
+import minhash
+import bloomvec
+import metrics
 
 
 class PatchLoader(object):
 
-    def __init__(self):
+    def __init__(self, settings=None):
+        self._settings = settings or common.Settings()
         self._patch_list = []
         self._npatch = 0
+        self._ngram_index = {}
+        self._ngram_count = []
+        self._hunk_dict = {}
+        self._nmerged = 0
+        self._near_index = None
+        self._patch_bits = None
 
-    def traverse(self, patch_path):
+    def traverse(self, patch_path, strict=False):
         '''
         Traverse patch files
+        strict: raise ValueError for a compiled database of other settings
+        instead of reporting it
         '''
-        print '[+] traversing patch files'
+        common.progress_print('[+] traversing patch files', self._settings)
         start_time = time.time()
 
-        if os.path.isfile(patch_path):
-            magic_type = common.file_type(patch_path)
-            common.verbose_print('  [-] %s: %s' % (patch_path, magic_type))
-            if magic_type.startswith('text'):
-                main_type, sub_type = magic_type.split('/')
-                self._process(patch_path)
-        elif os.path.isdir(patch_path):
-            for root,dirs,files in os.walk(patch_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    magic_type = common.file_type(file_path)
-                    common.verbose_print('  [-] %s: %s' % (file_path, magic_type))
-                    if magic_type.startswith('text'):
-                        main_type, sub_type = magic_type.split('/')
-                        self._process(file_path)
+        if patchdb.is_patchdb(patch_path):
+            try:
+                db = patchdb.PatchDB(patch_path, self._settings)
+            except ValueError as err:
+                if strict:
+                    raise
+                common.progress_print('[!] %s' % err, self._settings)
+                return 0
+            self._patch_list = db.items()
+            self._npatch = db.length()
+            self._ngram_index = db.index()
+            self._ngram_count = db.ngram_count()
+            elapsed_time = time.time() - start_time
+            common.progress_print('[+] %d patches (compiled) ... %.1fs\n' % (self._npatch, elapsed_time), self._settings)
+            return self._npatch
+
+        file_classifier = classifier.FileClassifier('patch', self._settings)
+        # sharded scans need the same patch ids on every machine
+        for file_path in file_classifier.walk(patch_path, sort=bool(self._settings.shard_count)):
+            magic_ext, tier = file_classifier.classify(file_path)
+            common.verbose_print('  [-] %s: %s (%s)' % (file_path, magic_ext, tier), self._settings)
+            if magic_ext is not None:
+                self._process(file_path)
         self._npatch = len(self._patch_list)
+        self._build_index()
+        if self._nmerged:
+            common.progress_print('[+] %d duplicate hunks merged into %d patches' % (self._nmerged, self._npatch), self._settings)
 
         elapsed_time = time.time() - start_time
-        print '[+] %d patches ... %.1fs\n' % (self._npatch, elapsed_time)
+        common.progress_print('[+] %d patches ... %.1fs\n' % (self._npatch, elapsed_time), self._settings)
         return self._npatch
 
     def _process(self, patch_path):
@@ -51,6 +78,7 @@ class PatchLoader(object):
         patch_filename = patch_path.split('/')[-1]
         patch_file = open(patch_path, 'r')
         patch_lines = patch_file.readlines()
+        metrics.count('bytes_read_total', sum(len(line) for line in patch_lines), kind='patch')
         patch_file.close()
         magic_ext = None
         process_flag = False
@@ -63,13 +91,12 @@ class PatchLoader(object):
             if line.startswith('--- '):
                 if diff_vuln_lines:
                     diff_norm_lines = self._normalize(''.join(diff_vuln_lines), magic_ext).split()
-                    if len(diff_norm_lines) >= common.ngram_size:
-                        common.verbose_print('      %s %d (ext: %d)' % (diff_file, diff_cnt, magic_ext))
+                    if len(diff_norm_lines) >= self._settings.ngram_size:
+                        common.verbose_print('      %s %d (ext: %d)' % (diff_file, diff_cnt, magic_ext), self._settings)
                         path = '[%s] %s #%d' % (patch_filename, diff_file, diff_cnt)
-                        hash_list = self._build_hash_list(diff_norm_lines)
-                        self._patch_list.append(common.PatchInfo(path, magic_ext, ''.join(diff_orig_lines), diff_norm_lines, hash_list))
+                        self._add_patch(path, magic_ext, ''.join(diff_orig_lines), diff_norm_lines)
                     else:
-                        common.verbose_print('      %s %d (ext: %d) - skipped (%d lines)' % (diff_file, diff_cnt, magic_ext, len(diff_norm_lines)))
+                        common.verbose_print('      %s %d (ext: %d) - skipped (%d lines)' % (diff_file, diff_cnt, magic_ext, len(diff_norm_lines)), self._settings)
                     del diff_vuln_lines[:]
                     del diff_orig_lines[:]
 
@@ -91,13 +118,12 @@ class PatchLoader(object):
                 elif line.startswith('@@'):
                     if diff_vuln_lines:
                         diff_norm_lines = self._normalize(''.join(diff_vuln_lines), magic_ext).split()
-                        if len(diff_norm_lines) >= common.ngram_size:
-                            common.verbose_print('      %s %d (ext: %d)' % (diff_file, diff_cnt, magic_ext))
+                        if len(diff_norm_lines) >= self._settings.ngram_size:
+                            common.verbose_print('      %s %d (ext: %d)' % (diff_file, diff_cnt, magic_ext), self._settings)
                             path = '[%s] %s #%d' % (patch_filename, diff_file, diff_cnt)
-                            hash_list = self._build_hash_list(diff_norm_lines)
-                            self._patch_list.append(common.PatchInfo(path, magic_ext, ''.join(diff_orig_lines), diff_norm_lines, hash_list))
+                            self._add_patch(path, magic_ext, ''.join(diff_orig_lines), diff_norm_lines)
                         else:
-                            common.verbose_print('      %s %d (ext: %d) - skipped (%d lines)' % (diff_file, diff_cnt, magic_ext, len(diff_norm_lines)))
+                            common.verbose_print('      %s %d (ext: %d) - skipped (%d lines)' % (diff_file, diff_cnt, magic_ext, len(diff_norm_lines)), self._settings)
                         del diff_vuln_lines[:]
                         del diff_orig_lines[:]
                     diff_cnt += 1
@@ -119,18 +145,44 @@ class PatchLoader(object):
 
         if diff_vuln_lines:
             diff_norm_lines = self._normalize(''.join(diff_vuln_lines), magic_ext).split()
-            if len(diff_norm_lines) >= common.ngram_size:
-                common.verbose_print('      %s %d (ext: %d)' % (diff_file, diff_cnt, magic_ext))
+            if len(diff_norm_lines) >= self._settings.ngram_size:
+                common.verbose_print('      %s %d (ext: %d)' % (diff_file, diff_cnt, magic_ext), self._settings)
                 path = '[%s] %s #%d' % (patch_filename, diff_file, diff_cnt)
-                hash_list = self._build_hash_list(diff_norm_lines)
-                self._patch_list.append(common.PatchInfo(path, magic_ext, ''.join(diff_orig_lines), diff_norm_lines, hash_list))
+                self._add_patch(path, magic_ext, ''.join(diff_orig_lines), diff_norm_lines)
             else:
-                common.verbose_print('      %s %d (ext: %d) - skipped (%d lines)' % (diff_file, diff_cnt, magic_ext, len(diff_norm_lines)))
+                common.verbose_print('      %s %d (ext: %d) - skipped (%d lines)' % (diff_file, diff_cnt, magic_ext, len(diff_norm_lines)), self._settings)
+
+    def _add_patch(self, path, magic_ext, orig_lines, norm_lines):
+        '''
+        Add a hunk, or only its label to a hunk of the same file type and
+        normalized lines (stable backports, distribution patches)
+        '''
+        hunk_key = (magic_ext, tuple(norm_lines))
+        if self._settings.patch_dedup and hunk_key in self._hunk_dict:
+            p = self._patch_list[self._hunk_dict[hunk_key]]
+            common.verbose_print('      - same as %s' % p.file_path, self._settings)
+            p.labels.append(path)
+            self._nmerged += 1
+            metrics.count('patch_hunks_merged_total')
+            return
+        ngram_list = common.build_ngram_list(norm_lines, self._settings)
+        hash_list = common.build_hash_list(ngram_list, self._settings)
+        self._hunk_dict[hunk_key] = len(self._patch_list)
+        self._patch_list.append(common.PatchInfo(path, magic_ext, orig_lines, norm_lines, hash_list, ngram_list, [path]))
 
     def _normalize(self, patch, ext):
         '''
         Normalize a patch file
         '''
+        ext_name = common.file_ext_name_dict.get(ext, 'Unknown')
+        metrics.count('normalize_bytes_total', len(patch), ext=ext_name, stage='patch')
+        with metrics.timer('normalize_seconds_total', ext=ext_name, stage='patch'):
+            return self._normalize_text(patch, ext)
+
+    def _normalize_text(self, patch, ext):
+        if self._settings.normalizer_engine == 'scan':
+            return normalizer.normalize_patch(patch, ext)
+
         # Language-specific optimization
         if ext==common.FileExt.C or ext==common.FileExt.Java:
             patch = ''.join([c.group('noncomment') for c in common.c_regex.finditer(patch) if c.group('noncomment')])
@@ -151,26 +203,39 @@ class PatchLoader(object):
         # Convert into lowercases
         return patch.lower()
 
-    def _build_hash_list(self, diff_norm_lines):
+    def compile(self, db_path):
         '''
-        Build a hash list
+        Write loaded patches to a compiled patch database
         '''
-        hash_list = []
-        num_ngram = len(diff_norm_lines) - common.ngram_size + 1
-        for i in range(0, num_ngram):
-            ngram = ''.join(diff_norm_lines[i:i+common.ngram_size])
-            hash1 = common.fnv1a_hash(ngram) & (common.bloomfilter_size-1)
-            hash2 = common.djb2_hash(ngram) & (common.bloomfilter_size-1)
-            hash3 = common.sdbm_hash(ngram) & (common.bloomfilter_size-1)
-            hash_list.append(hash1)
-            hash_list.append(hash2)
-            hash_list.append(hash3)
-        return hash_list
+        common.progress_print('[+] compiling patches', self._settings)
+        start_time = time.time()
+        patchdb.write_patchdb(db_path, self._patch_list, self._ngram_index, self._ngram_count, self._settings)
+        elapsed_time = time.time() - start_time
+        common.progress_print('[+] \"%s\" ... %.1fs\n' % (db_path, elapsed_time), self._settings)
+
+    def _build_index(self):
+        '''
+        Build an inverted n-gram index (n-gram -> patch ids) per file type
+        '''
+        ngram_index = defaultdict(lambda: defaultdict(list))
+        self._ngram_count = []
+        for patch_id, patch in enumerate(self._patch_list):
+            ngram_set = set(patch.ngram_list)
+            for ngram in ngram_set:
+                ngram_index[patch.file_ext][ngram].append(patch_id)
+            self._ngram_count.append(len(ngram_set))
+        self._ngram_index = dict((ext, dict(index)) for ext, index in ngram_index.items())
 
     def _get_file_type(self, file_path):
         '''
-        Guess a file type based upon a file extension (mimetypes module)
+        Guess a file type based upon a file extension (source extensions known
+        to the classifier, then mimetypes module; mimetypes only with
+        --classify magic, as source files are then typed by libmagic)
         '''
+        if self._settings.classify_mode != 'magic':
+            ext = os.path.splitext(file_path)[1].lower()
+            if ext in classifier.source_ext_dict:
+                return classifier.source_ext_dict[ext]
         file_type, encoding = mimetypes.guess_type(file_path)
         magic_ext = None
         if file_type is None:
@@ -201,3 +266,38 @@ class PatchLoader(object):
     def length(self):
         return self._npatch
 
+    def index(self):
+        return self._ngram_index
+
+    def ngram_count(self):
+        return self._ngram_count
+
+    def near_index(self):
+        '''
+        Get the MinHash/LSH index of patches for near-clone queries (built
+        on first use, once for any number of scans)
+        '''
+        near_params = (self._settings.near_threshold, self._settings.minhash_perm)
+        if self._near_index is None or self._near_index[0] != near_params:
+            start_time = time.time()
+            near_index = minhash.NearIndex(self._patch_list, self._settings.near_threshold, self._settings.minhash_perm)
+            self._near_index = (near_params, near_index)
+            elapsed_time = time.time() - start_time
+            common.progress_print('[+] near-clone index: %d patches, %d bands of %d rows ... %.1fs' % (near_index.stats() + (elapsed_time,)), self._settings)
+        return self._near_index[1]
+
+    def patch_bits(self):
+        '''
+        Get the concatenated Bloom hash lists of patches for vectorized
+        membership queries (built on first use, once for any number of scans)
+        '''
+        bloom_params = (self._settings.hash_scheme, self._settings.bloomfilter_size, self._settings.bloom_hash_count)
+        if self._patch_bits is None or self._patch_bits[0] != bloom_params:
+            start_time = time.time()
+            patch_bits = bloomvec.PatchBits(self._patch_list)
+            patch_bits.prepare(set(p.file_ext for p in self._patch_list))
+            self._patch_bits = (bloom_params, patch_bits)
+            elapsed_time = time.time() - start_time
+            common.progress_print('[+] vectorized Bloom arrays ... %.1fs' % elapsed_time, self._settings)
+        return self._patch_bits[1]
+
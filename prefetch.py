@@ -0,0 +1,97 @@
+# prefetch.py
+#   Prefetcher class (reads upcoming files in threads while the current one
+#   is normalized and queried)
+#
+#   Files are read in order by a few threads, at most depth files and about
+#   byte_budget bytes ahead of the consumer, and handed over in order. Time
+#   the consumer blocks on a read is counted as io_wait_seconds_total.
+#
+import os
+import time
+import Queue
+import threading
+from collections import deque
+import metrics
+
+
+class _Slot(object):
+
+    def __init__(self, read_path, value):
+        self.read_path = read_path
+        self.value = value
+        self.size = 0
+        self.contents = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class Prefetcher(object):
+
+    def __init__(self, depth=8, byte_budget=32<<20, nthread=4):
+        self._depth = max(1, depth)
+        self._byte_budget = byte_budget
+        self._nthread = max(1, min(nthread, self._depth))
+
+    def read_ahead(self, item_iter):
+        '''
+        Read files of (file path or None, value) items ahead of the consumer
+        Generate (value, contents or None if nothing was read) in order, an
+        IOError of a read is raised when its item is reached
+        '''
+        work_queue = Queue.Queue()
+        thread_list = [threading.Thread(target=self._read_worker, args=(work_queue,)) for i in range(self._nthread)]
+        for thread in thread_list:
+            thread.daemon = True
+            thread.start()
+
+        item_iter = iter(item_iter)
+        pending = deque()
+        nbyte = 0
+        try:
+            while True:
+                # the first pending file is read whatever its size
+                while len(pending) < self._depth and (not pending or nbyte < self._byte_budget):
+                    try:
+                        read_path, value = next(item_iter)
+                    except StopIteration:
+                        break
+                    slot = _Slot(read_path, value)
+                    if read_path is None:
+                        slot.done.set()
+                    else:
+                        try:
+                            slot.size = os.path.getsize(read_path)
+                        except OSError:
+                            pass
+                        nbyte += slot.size
+                        work_queue.put(slot)
+                    pending.append(slot)
+                if not pending:
+                    break
+
+                slot = pending.popleft()
+                if not slot.done.is_set():
+                    start_time = time.time()
+                    # a timeout keeps the wait interruptible
+                    while not slot.done.wait(0.1):
+                        pass
+                    metrics.count('io_wait_seconds_total', time.time() - start_time)
+                nbyte -= slot.size
+                if slot.error:
+                    raise slot.error
+                yield slot.value, slot.contents
+        finally:
+            for thread in thread_list:
+                work_queue.put(None)
+
+    def _read_worker(self, work_queue):
+        while True:
+            slot = work_queue.get()
+            if slot is None:
+                return
+            try:
+                with open(slot.read_path, 'r') as f:
+                    slot.contents = f.read()
+            except IOError as err:
+                slot.error = err
+            slot.done.set()
@@ -8,10 +8,15 @@ import sys
 import os
 import re
 import time
+import atexit
 import common
-import patchloader
-import sourceloader
-import reporter
+import writer
+import gitrange
+import metrics
+import scanner
+import daemon
+import shard
+import bloomvec
 
 try:
     import argparse
@@ -33,63 +38,296 @@ def parse_args():
     parser.add_argument('-c', '--context',\
             action='store', dest='context_line', type=int, default=10, metavar='NUM',\
             help='print NUM lines of context (default: %(default)s)')
+    parser.add_argument('-e', '--engine',\
+            action='store', dest='query_engine', choices=['index', 'bloom'], default='index',\
+            help='query patches with an inverted n-gram index or Bloom filters (default: %(default)s)')
+    parser.add_argument('--hash-scheme',\
+            action='store', dest='hash_scheme', type=int, choices=[1, 2], default=2, metavar='NUM',\
+            help='n-gram hash scheme: 1 (per n-gram fnv1a/djb2/sdbm) or 2 (rolling line hashes) (default: %(default)s)')
+    parser.add_argument('--bloom-k',\
+            action='store', dest='bloom_hash_count', type=int, default=common.bloom_hash_count, metavar='NUM',\
+            help='derive NUM Bloom filter bit positions from each n-gram hash (default: %(default)s)')
+    parser.add_argument('--bloom-size',\
+            action='store', dest='bloomfilter_size', type=int, default=common.bloomfilter_size, metavar='BITS',\
+            help='use Bloom filters of at most BITS bits, a power of two (default: %(default)s)')
+    parser.add_argument('--bloom-fp',\
+            action='store', dest='bloom_fp_rate', type=float, default=None, metavar='RATE',\
+            help='choose bits per n-gram and --bloom-k for a target false-positive rate per n-gram')
+    parser.add_argument('--vectorize',\
+            action='store_true', dest='bloom_vectorize', default=False,\
+            help='test Bloom filter bits of all patches at once with numpy (default: %(default)s)')
+    parser.add_argument('--near',\
+            action='store', dest='near_threshold', type=float, default=0.0, metavar='JACCARD',\
+            help='also report near clones: source windows whose n-grams have a Jaccard similarity of at least JACCARD with a patch, found by MinHash/LSH')
+    parser.add_argument('--minhash',\
+            action='store', dest='minhash_perm', type=int, default=common.minhash_perm, metavar='NUM',\
+            help='use NUM MinHash permutations for --near (default: %(default)s)')
+    parser.add_argument('--normalizer',\
+            action='store', dest='normalizer_engine', choices=['scan', 'regex'], default='scan',\
+            help='normalize with a single-pass scanner or the comment regexes (default: %(default)s)')
+    parser.add_argument('-j', '--jobs',\
+            action='store', dest='jobs', type=int, default=1, metavar='NUM',\
+            help='query source files in NUM processes (default: %(default)s)')
+    parser.add_argument('--cache',\
+            action='store', dest='cache_dir', default=None, metavar='DIR',\
+            help='cache normalized and hashed source files in DIR (default: %(default)s)')
+    parser.add_argument('--classify',\
+            action='store', dest='classify_mode', choices=['fast', 'magic'], default='fast',\
+            help='classify files by extension/shebang/prefix or by libmagic on every file (default: %(default)s)')
+    parser.add_argument('--prune',\
+            action='store', dest='prune_dirs', default=','.join(common.prune_dirs), metavar='DIRS',\
+            help='comma-separated directory names not to traverse (default: %(default)s)')
+    parser.add_argument('--max-size',\
+            action='store', dest='max_file_size', type=int, default=0, metavar='BYTES',\
+            help='skip files larger than BYTES, 0 for no limit (default: %(default)s)')
+    parser.add_argument('--archives',\
+            action='store_true', dest='scan_archives', default=False,\
+            help='scan members of tar/zip archives and gzip/bzip2/xz files, nested ones too (default: %(default)s)')
+    parser.add_argument('--prefetch',\
+            action='store', dest='prefetch_depth', type=int, default=common.prefetch_depth, metavar='FILES',\
+            help='read up to FILES source files ahead in threads while one is queried (without -j or --cache), 0 to read in line (default: %(default)s)')
+    parser.add_argument('--prefetch-bytes',\
+            action='store', dest='prefetch_bytes', type=int, default=common.prefetch_bytes, metavar='BYTES',\
+            help='read ahead at most about BYTES (default: %(default)s)')
+    parser.add_argument('--dedup',\
+            action='store', dest='dedup_mode', choices=['off', 'raw', 'normalized'], default=common.dedup_mode,\
+            help='query and verify files of identical original or normalized contents once, reporting every copy (default: %(default)s)')
+    parser.add_argument('--no-patch-dedup',\
+            action='store_false', dest='patch_dedup', default=True,\
+            help='keep hunks of identical normalized lines in different patches apart instead of reporting them once with all their labels')
+    parser.add_argument('--stream',\
+            action='store_true', dest='stream_mode', default=False,\
+            help='verify and report each source file as soon as it is queried (default: %(default)s)')
+    parser.add_argument('-o', '--output',\
+            action='store', dest='html_path', default='output.html', metavar='FILE',\
+            help='write an HTML report to FILE (default: %(default)s)')
+    parser.add_argument('--jsonl',\
+            action='store', dest='jsonl_path', default=None, metavar='FILE',\
+            help='write each exact match to FILE as JSON Lines as soon as it is found')
+    parser.add_argument('--sarif',\
+            action='store', dest='sarif_path', default=None, metavar='FILE',\
+            help='write exact matches to FILE in SARIF 2.1.0 as soon as they are found')
+    parser.add_argument('--record-context',\
+            action='store_true', dest='record_context', default=False,\
+            help='include source lines in JSON Lines/SARIF records (default: %(default)s)')
+    parser.add_argument('--shard',\
+            action='store', dest='shard', default=None, metavar='I/N',\
+            help='scan only shard I of N of the source files (walked in sorted order), to be merged with shard.py')
+    parser.add_argument('--shard-by',\
+            action='store', dest='shard_by', choices=['hash', 'size'], default='hash',\
+            help='assign files to shards by a hash of their relative paths or balancing total sizes (default: %(default)s)')
+    parser.add_argument('--partial',\
+            action='store', dest='partial_path', default=None, metavar='FILE',\
+            help='write exact matches with their context lines to FILE, a partial result to be merged with shard.py')
+    parser.add_argument('--git-range',\
+            action='store', dest='git_range', default=None, metavar='OLD..NEW',\
+            help='only scan files added or modified between two revisions of the git repository source_path')
+    parser.add_argument('--previous',\
+            action='store', dest='previous_path', default=None, metavar='FILE',\
+            help='JSON Lines results of the OLD revision, whose matches in unchanged files are reported again (with --git-range)')
+    parser.add_argument('--compile-patches',\
+            action='store', dest='patchdb_path', default=None, metavar='FILE',\
+            help='compile patches into a database FILE to be used as patch_path, and exit')
+    parser.add_argument('--serve',\
+            action='store', dest='serve_address', default=None, metavar='ADDRESS',\
+            help='keep patches loaded and answer JSON scan requests on [HOST:]PORT or a Unix socket path')
+    parser.add_argument('--serve-remote',\
+            action='store_true', dest='serve_remote', default=False,\
+            help='with --serve, allow a HOST other than a loopback address (clients can read any file the daemon can read)')
+    parser.add_argument('--reload-interval',\
+            action='store', dest='reload_interval', type=float, default=2.0, metavar='SECONDS',\
+            help='with --serve, reload patches changed on disk every SECONDS, 0 to never reload (default: %(default)s)')
+    parser.add_argument('--metrics',\
+            action='store', dest='metrics_path', default=None, metavar='FILE',\
+            help='write counters and timers of the run to FILE at exit')
+    parser.add_argument('--metrics-format',\
+            action='store', dest='metrics_format', choices=['json', 'prometheus'], default='json',\
+            help='format of the metrics file (default: %(default)s)')
+    parser.add_argument('--profile',\
+            action='store', dest='profile_dir', default=None, metavar='DIR',\
+            help='write cProfile statistics of each stage to DIR/<stage>.prof (main process only)')
     parser.add_argument('-v', '--verbose',\
             action='store_true', dest='verbose_mode', default=False,\
             help='enable verbose mode (default: %(default)s)')
     # positional arguments
-    parser.add_argument('patch_path', action='store', help='path to patch files (in unified diff format)')
-    parser.add_argument('source_path', action='store', help='path to source files')
+    parser.add_argument('patch_path', action='store', help='path to patch files (in unified diff format) or a compiled patch database')
+    parser.add_argument('source_path', action='store', nargs='?', help='path to source files')
 
     try:
         args = parser.parse_args()
-        common.ngram_size = args.ngram_size
-        common.context_line = args.context_line
-        common.verbose_mode = args.verbose_mode
-        return args.patch_path, args.source_path
+        settings = {
+            'ngram_size': args.ngram_size,
+            'context_line': args.context_line,
+            'query_engine': args.query_engine,
+            'hash_scheme': args.hash_scheme,
+            'bloom_hash_count': args.bloom_hash_count,
+            'bloomfilter_size': args.bloomfilter_size,
+            'bloom_vectorize': args.bloom_vectorize,
+            'near_threshold': args.near_threshold,
+            'minhash_perm': args.minhash_perm,
+            'normalizer_engine': args.normalizer_engine,
+            'jobs': args.jobs,
+            'cache_dir': args.cache_dir,
+            'classify_mode': args.classify_mode,
+            'prune_dirs': [d for d in args.prune_dirs.split(',') if d],
+            'max_file_size': args.max_file_size,
+            'scan_archives': args.scan_archives,
+            'prefetch_depth': args.prefetch_depth,
+            'prefetch_bytes': args.prefetch_bytes,
+            'dedup_mode': args.dedup_mode,
+            'patch_dedup': args.patch_dedup,
+            'shard_by': args.shard_by,
+            'verbose_mode': args.verbose_mode,
+            'progress_mode': args.serve_address is None,
+        }
+        if args.bloom_fp_rate is not None:
+            if not 0 < args.bloom_fp_rate < 1:
+                parser.error('--bloom-fp expects a rate between 0 and 1')
+            settings['min_mn_ratio'], settings['bloom_hash_count'] = common.bloom_parameters(args.bloom_fp_rate)
+        if not 0 <= args.near_threshold <= 1:
+            parser.error('--near expects a similarity between 0 and 1')
+        if args.minhash_perm < 1:
+            parser.error('--minhash expects a positive number')
+        if args.bloom_vectorize and bloomvec.numpy is None:
+            parser.error('--vectorize needs the numpy module')
+        if args.shard:
+            try:
+                settings['shard_index'], settings['shard_count'] = shard.parse_shard(args.shard)
+            except ValueError as err:
+                parser.error('--shard: %s' % err)
+            if args.git_range:
+                parser.error('--shard cannot be used with --git-range')
+        if args.git_range:
+            # changed files are read from git one at a time
+            if args.jobs > 1 or args.cache_dir:
+                parser.error('--git-range cannot be used with --jobs or --cache')
+            if args.prefetch_depth != common.prefetch_depth or args.prefetch_bytes != common.prefetch_bytes:
+                parser.error('--git-range cannot be used with --prefetch or --prefetch-bytes')
+            # changed files are listed by git, not walked
+            if args.scan_archives or args.prune_dirs != ','.join(common.prune_dirs):
+                parser.error('--git-range cannot be used with --archives or --prune')
+        if args.prefetch_depth < 0 or args.prefetch_bytes < 0:
+            parser.error('--prefetch and --prefetch-bytes expect non-negative numbers')
+        if args.bloom_hash_count < 1:
+            parser.error('--bloom-k expects a positive number')
+        if args.bloomfilter_size < 1024 or args.bloomfilter_size > 1<<32 or args.bloomfilter_size & (args.bloomfilter_size-1):
+            parser.error('--bloom-size expects a power of two between 1024 and 2^32')
+        if args.source_path is None and args.patchdb_path is None and args.serve_address is None:
+            parser.error('too few arguments')
+        if args.git_range and '..' not in args.git_range:
+            parser.error('--git-range expects OLD..NEW')
+        if args.previous_path and not args.git_range:
+            parser.error('--previous requires --git-range')
+        if args.serve_remote and not args.serve_address:
+            parser.error('--serve-remote requires --serve')
+        return args, settings
     except IOError, msg:
         parser.error(str(msg))
 
+def write_metrics(start_time, metrics_path, metrics_format):
+    '''
+    Write metrics of the run (registered to run at exit)
+    '''
+    metrics.count('run_seconds_total', time.time() - start_time)
+    metrics.default.write(metrics_path, metrics_format)
+
 
 if __name__ == '__main__':
 
     # parse arguments
     start_time = time.time()
-    patch_path, source_path = parse_args()
-    common.verbose_print('[-] ngram_size   : %d' % common.ngram_size)
-    common.verbose_print('[-] context_line : %d' % common.context_line)
-    common.verbose_print('[-] verbose_mode : %s' % common.verbose_mode)
-    common.verbose_print('[-] patch_path   : %s' % patch_path)
-    common.verbose_print('[-] source_path  : %s' % source_path)
+    args, settings = parse_args()
+    if args.verbose_mode:
+        print '[-] ngram_size   : %d' % settings['ngram_size']
+        print '[-] context_line : %d' % settings['context_line']
+        print '[-] query_engine : %s' % settings['query_engine']
+        print '[-] hash_scheme  : %d' % settings['hash_scheme']
+        print '[-] bloom filter : %d bits, %d bits per n-gram, k=%d' % (settings['bloomfilter_size'],\
+                settings.get('min_mn_ratio', common.min_mn_ratio), settings['bloom_hash_count'])
+        print '[-] bloom_vector : %s' % settings['bloom_vectorize']
+        print '[-] near_clones  : %.2f, %d permutations' % (settings['near_threshold'], settings['minhash_perm'])
+        print '[-] normalizer   : %s' % settings['normalizer_engine']
+        print '[-] jobs         : %d' % settings['jobs']
+        print '[-] cache_dir    : %s' % settings['cache_dir']
+        print '[-] classify_mode: %s' % settings['classify_mode']
+        print '[-] prune_dirs   : %s' % ','.join(settings['prune_dirs'])
+        print '[-] max_file_size: %d' % settings['max_file_size']
+        print '[-] scan_archives: %s' % settings['scan_archives']
+        print '[-] prefetch     : %d files, %d bytes' % (settings['prefetch_depth'], settings['prefetch_bytes'])
+        print '[-] dedup_mode   : %s' % settings['dedup_mode']
+        print '[-] patch_dedup  : %s' % settings['patch_dedup']
+        print '[-] shard        : %s (%s)' % (args.shard, settings['shard_by'])
+        print '[-] stream_mode  : %s' % args.stream_mode
+        print '[-] git_range    : %s' % args.git_range
+        print '[-] verbose_mode : %s' % args.verbose_mode
+        print '[-] patch_path   : %s' % args.patch_path
+        print '[-] source_path  : %s' % args.source_path
 
-    # initialize a magic cookie pointer
-    try:
-        common.magic_cookie = magic.open(magic.MAGIC_MIME)
-        common.magic_cookie.load()
-    except AttributeError:
-        common.magic_cookie = magic.Magic(mime=True, uncompress=True)
-    common.verbose_print('[-] initialized magic cookie\n')
+    # a scanner with a libmagic cookie
+    patch_scanner = scanner.Scanner(**settings)
+    if args.verbose_mode:
+        print '[-] initialized magic cookie\n'
+    if args.metrics_path:
+        atexit.register(write_metrics, start_time, args.metrics_path, args.metrics_format)
 
     # traverse patch files
-    patch = patchloader.PatchLoader()
-    npatch = patch.traverse(patch_path)
-    if npatch == 0:
-        print('[!] no patch to be queried')
+    try:
+        with metrics.stage('patch', args.profile_dir):
+            npatch = patch_scanner.load_patches(args.patch_path)
+    except ValueError as err:
+        print('[!] %s' % err)
         sys.exit(1)
+    if args.patchdb_path:
+        try:
+            with metrics.stage('compile', args.profile_dir):
+                patch_scanner.compile(args.patchdb_path)
+        except ValueError as err:
+            print('[!] %s' % err)
+            sys.exit(1)
+        sys.exit(0)
+    if args.serve_address:
+        try:
+            daemon.ScanDaemon(patch_scanner, args.patch_path, args.reload_interval).serve(args.serve_address, args.serve_remote)
+        except ValueError as err:
+            print('[!] %s' % err)
+            sys.exit(1)
+        sys.exit(0)
+
+    # machine-readable outputs
+    writer_list = []
+    if args.jsonl_path:
+        writer_list.append(writer.JsonLinesWriter(args.jsonl_path, args.record_context))
+    if args.sarif_path:
+        writer_list.append(writer.SarifWriter(args.sarif_path, args.record_context))
+    if args.partial_path:
+        writer_list.append(shard.PartialWriter(args.partial_path, args.source_path,\
+                settings.get('shard_index', 0), settings.get('shard_count', 1), settings['shard_by'], npatch))
 
-    # traverse source files
-    source = sourceloader.SourceLoader()
-    nmatch = source.traverse(source_path, patch)
-    if nmatch == 0:
+    # files changed in a revision range, previous results of unchanged files
+    git_range = None
+    previous_list = []
+    if args.git_range:
+        old_rev, new_rev = args.git_range.split('..', 1)
+        git_range = gitrange.GitRange(args.source_path, old_rev, new_rev)
+        if args.previous_path:
+            record_list = gitrange.load_results(args.previous_path, git_range.changed_paths())
+            previous_list, ndropped = gitrange.previous_matches(record_list, patch_scanner.patches(), git_range)
+            print '[+] %d previous matches kept, %d of patches no longer loaded dropped\n' % (len(previous_list), ndropped)
+
+    # traverse source files and generate a report
+    try:
+        nmatch, exact_nmatch = patch_scanner.report(args.source_path, args.html_path, writer_list,\
+                git_range, args.stream_mode, args.profile_dir, previous_list)
+    except IOError as err:
+        # a source file changed between its query and the report
+        print('[!] %s' % err)
+        sys.exit(1)
+    if nmatch == 0 and not args.stream_mode and not previous_list:
         print('[!] no match to be checked')
         sys.exit(1)
-
-    # generate a report
-    report = reporter.Reporter(patch, source)
-    exact_nmatch = report.output()
     if exact_nmatch == 0:
         print('[!] no exact match found')
         sys.exit(1)
 
     elapsed_time = time.time() - start_time
     print '[+] %d matches given %d patches ... %.1fs' % (exact_nmatch, npatch, elapsed_time)
-
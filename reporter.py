@@ -3,60 +3,173 @@
 #
 # Jiyong Jang, 2012
 #
+import os
 import time
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 import common
 import patchloader
 import sourceloader
+import matcher
+import minhash
+import metrics
+
+# verified source contents kept for later copies when source files are
+# verified one at a time (the least recently used are dropped)
+verified_max = 1024
 
 
 class Reporter(object):
 
-    def __init__(self, patch, source):
+    def __init__(self, patch, source, writer_list=None, previous_list=None, settings=None):
+        self._settings = settings or common.Settings()
         self._patch_list = patch.items()
         self._npatch = patch.length()
         self._source_list = source.items()
         self._nsource = source.length()
         self._match_dict = source.match_items()
         self._context_dict = defaultdict(list)
+        self._out = None
+        self._outfile = None
+        self._exact_nmatch = 0
+        self._ncandidate = 0
+        self._nrejected = 0
+        self._verified_dict = OrderedDict()
+        self._start_time = 0
+        self._writer_list = writer_list or []
+        # counters of this report (metrics.default covers the process)
+        self._metrics = metrics.Metrics()
+        # matches kept from a previous scan: [(patch_id, SourceInfo, ContextInfo)]
+        self._previous_list = previous_list or []
 
     def _exact_match(self):
         '''
         Exact-matching test to catch Bloom filters errors
         '''
-        print '[+] performing an exact matching test'
+        common.progress_print('[+] performing an exact matching test', self._settings)
         start_time = time.time()
         exact_nmatch = 0
 
+        # verify all candidate patches of a source file at once
+        source_dict = defaultdict(set)
         for patch_id, source_id_list in self._match_dict.items():
-            patch_norm_lines = self._patch_list[patch_id].norm_lines
-            patch_norm_length = len(patch_norm_lines)
             for source_id in source_id_list:
-                source_norm_lines = self._source_list[source_id].norm_lines
-                source_norm_length = len(source_norm_lines)
+                source_dict[source_id].add(patch_id)
+        exact_dict = {}
+        for source_id, patch_id_set in source_dict.items():
+            context_dict = self._verify_once(self._source_list[source_id], source_id, sorted(patch_id_set))
+            for patch_id, context_list in context_dict.items():
+                exact_dict[(patch_id, source_id)] = context_list
+            self._count_candidates(len(patch_id_set), len(context_dict))
 
-                for i in range(0, (source_norm_length-patch_norm_length+1)):
-                    patch_line = 0
-                    source_line = i
-                    while patch_norm_lines[patch_line] == source_norm_lines[source_line]:
-                        patch_line += 1
-                        source_line += 1
+        for patch_id, source_id_list in self._match_dict.items():
+            for source_id in source_id_list:
+                for context in exact_dict.get((patch_id, source_id), ()):
+                    common.verbose_print('  [-] exact match - %s : %s (line #%d)' % (self._patch_list[patch_id].file_path, self._source_list[source_id].file_path, context.start_line+1), self._settings)
+                    self._context_dict[patch_id].append(context)
+                    self._write_record(patch_id, self._source_list[source_id], context)
+                    exact_nmatch += 1
 
-                        if patch_line == patch_norm_length:
-                            common.verbose_print('  [-] exact match - %s : %s (line #%d)' % (self._patch_list[patch_id].file_path, self._source_list[source_id].file_path, i+1))
-                            self._context_dict[patch_id].append(common.ContextInfo(source_id, max(0, i-common.context_line), i, source_line, min(source_line+common.context_line, source_norm_length-1)))
-                            exact_nmatch += 1
-                            break
+        self._print_dedup_stats()
+        self._print_near_stats()
+        elapsed_time = time.time() - start_time
+        common.progress_print('[+] %d exact matches, %d of %d possible matches rejected ... %.1fs\n' % (exact_nmatch, self._nrejected, self._ncandidate, elapsed_time), self._settings)
+        return exact_nmatch
 
-                        while source_line<source_norm_length-patch_norm_length and source_norm_lines[source_line]=='':
-                            source_line += 1
+    def _verify_once(self, source_info, source_id, patch_id_list):
+        '''
+        Find exact matches once per distinct source contents (digest), and
+        fan them out to other files of the same contents
+        '''
+        verify_key = (source_info.digest, source_info.file_ext, tuple(patch_id_list))
+        if source_info.digest is not None and verify_key in self._verified_dict:
+            context_dict, elapsed_time = self._verified_dict.pop(verify_key)
+            self._verified_dict[verify_key] = (context_dict, elapsed_time)
+            self._count('dedup_verify_hits_total')
+            self._count('dedup_saved_seconds_total', elapsed_time, stage='verify')
+            return dict((patch_id, [context._replace(source_id=source_id) for context in context_list])\
+                    for patch_id, context_list in context_dict.items())
+        start_time = time.time()
+        context_dict = self._find_exact_matches(source_info, source_id, patch_id_list)
+        if self._settings.near_threshold:
+            context_dict.update(self._find_near_matches(source_info, source_id,\
+                    [patch_id for patch_id in patch_id_list if patch_id not in context_dict]))
+        if source_info.digest is not None:
+            self._verified_dict[verify_key] = (context_dict, time.time() - start_time)
+        return context_dict
 
-                        if source_line == source_norm_length-patch_norm_length:
-                            break
+    def _find_exact_matches(self, source_info, source_id, patch_id_list):
+        '''
+        Find exact matches of patches in a source file with an Aho-Corasick
+        automaton over normalized lines. Blank source lines are skipped
+        within a match, with the same window boundaries as a line-by-line
+        comparison from every start line.
+        Return a dict of patch_id -> [ContextInfo]
+        '''
+        source_norm_lines = source_info.norm_lines
+        source_norm_length = len(source_norm_lines)
+        line_pos = [i for i, line in enumerate(source_norm_lines) if line]
 
-        elapsed_time = time.time() - start_time
-        print '[+] %d exact matches ... %.1fs\n' % (exact_nmatch, elapsed_time)
-        return exact_nmatch
+        line_matcher = matcher.LineMatcher()
+        for patch_id in patch_id_list:
+            line_matcher.add(patch_id, self._patch_list[patch_id].norm_lines)
+        line_matcher.build()
+
+        context_dict = defaultdict(list)
+        for patch_id, j in line_matcher.search([source_norm_lines[i] for i in line_pos]):
+            patch_norm_length = len(self._patch_list[patch_id].norm_lines)
+            last_start = source_norm_length - patch_norm_length
+            if line_pos[j] > last_start:
+                continue
+            # blank lines are skipped only before last_start, and a match
+            # that reaches last_start through skipping is given up
+            is_match = True
+            for k in range(1, patch_norm_length):
+                next_line = line_pos[j+k-1] + 1
+                if next_line < last_start:
+                    if line_pos[j+k] >= last_start:
+                        is_match = False
+                        break
+                elif next_line == last_start or line_pos[j+k] != next_line:
+                    is_match = False
+                    break
+            if not is_match:
+                continue
+
+            start_line = line_pos[j]
+            end_line = line_pos[j+patch_norm_length-1] + 1
+            context_dict[patch_id].append(common.ContextInfo(source_id, max(0, start_line-self._settings.context_line), start_line, end_line, min(end_line+self._settings.context_line, source_norm_length-1), 1.0, False))
+        return context_dict
+
+    def _find_near_matches(self, source_info, source_id, patch_id_list):
+        '''
+        Find near clones of patches in a source file: the window of
+        non-blank normalized lines whose n-grams are most similar to those
+        of a patch (Jaccard), if at least near_threshold
+        Return a dict of patch_id -> [ContextInfo] (one best window)
+        '''
+        context_dict = {}
+        if not patch_id_list:
+            return context_dict
+        source_norm_lines = source_info.norm_lines
+        source_norm_length = len(source_norm_lines)
+        line_pos = [i for i, line in enumerate(source_norm_lines) if line]
+        key_list = [minhash.ngram_key(ngram) for ngram in common.build_ngram_list([source_norm_lines[i] for i in line_pos], self._settings)]
+        if not key_list:
+            return context_dict
+
+        for patch_id in patch_id_list:
+            ngram_list = self._patch_list[patch_id].ngram_list
+            key_set = set(minhash.ngram_key(ngram) for ngram in ngram_list)
+            if len(key_set) < minhash.min_ngram:
+                continue
+            similarity, j = minhash.best_window(key_set, key_list, len(ngram_list))
+            if similarity < self._settings.near_threshold:
+                continue
+            start_line = line_pos[j]
+            end_line = line_pos[min(j + len(ngram_list), len(key_list)) + self._settings.ngram_size - 2] + 1
+            context_dict[patch_id] = [common.ContextInfo(source_id, max(0, start_line-self._settings.context_line), start_line, end_line,\
+                    min(end_line+self._settings.context_line, source_norm_length-1), round(similarity, 3), True)]
+        return context_dict
 
     def _html_escape(self, string):
         '''
@@ -69,13 +182,135 @@ class Reporter(object):
         Perform an exact matching test and generate a report
         '''
         exact_nmatch = self._exact_match()
+        source_context_dict = defaultdict(list)
+        for patch_id, context_list in self._context_dict.items():
+            source_context_dict[patch_id] = [(self._source_list[context.source_id], context) for context in context_list]
+        for patch_id, source_info, context in self._previous_list:
+            self._write_record(patch_id, source_info, context)
+            source_context_dict[patch_id].append((source_info, context))
+            exact_nmatch += 1
+        self._close_writers()
         if exact_nmatch == 0:
             return exact_nmatch
 
-        print '[+] generating a report'
+        common.progress_print('[+] generating a report', self._settings)
         start_time = time.time()
 
+        self.write_html(outfile, exact_nmatch, sorted(source_context_dict.items()))
+
+        elapsed_time = time.time() - start_time
+        common.progress_print('[+] \"%s\" ... %.1fs\n' % (outfile, elapsed_time), self._settings)
+        return exact_nmatch
+
+    def write_html(self, outfile, exact_nmatch, patch_context_list):
+        '''
+        Write an HTML report of [(patch_id, [(SourceInfo, ContextInfo)])]
+        '''
         out = open(outfile, 'w')
+        self._write_head(out)
+        self._write_count(out, exact_nmatch)
+        for patch_id, source_context_list in patch_context_list:
+            self._write_patch(out, patch_id, source_context_list)
+        self._write_tail(out)
+        out.close()
+        self._count('report_bytes_total', os.path.getsize(outfile), format='html')
+
+    def open(self, outfile='output.html'):
+        '''
+        Start a streaming report: each possible match is verified and
+        written by add_source(), and nothing is kept after that
+        '''
+        self._outfile = outfile
+        self._out = open(outfile, 'w')
+        self._exact_nmatch = 0
+        self._start_time = time.time()
+        self._write_head(self._out)
+
+    def add_source(self, source_info, source_id, patch_id_list):
+        '''
+        Verify possible matches of a source file and write exact matches
+        '''
+        context_dict = self.verify(source_info, source_id, patch_id_list)
+        for patch_id in sorted(context_dict):
+            self._write_patch(self._out, patch_id, [(source_info, context) for context in context_dict[patch_id]])
+            self._exact_nmatch += len(context_dict[patch_id])
+        self._out.flush()
+
+    def verify(self, source_info, source_id, patch_id_list):
+        '''
+        Verify possible matches of a source file and hand exact matches over
+        to writers
+        Return a dict of patch_id -> [ContextInfo]
+        '''
+        patch_id_list = sorted(set(patch_id_list))
+        context_dict = self._verify_once(source_info, source_id, patch_id_list)
+        while len(self._verified_dict) > verified_max:
+            self._verified_dict.popitem(last=False)
+        self._count_candidates(len(patch_id_list), len(context_dict))
+        for patch_id in sorted(context_dict):
+            for context in context_dict[patch_id]:
+                common.verbose_print('  [-] exact match - %s : %s (line #%d)' % (self._patch_list[patch_id].file_path, source_info.file_path, context.start_line+1), self._settings)
+                self._write_record(patch_id, source_info, context)
+        return context_dict
+
+    def close(self):
+        '''
+        Finish a streaming report
+        '''
+        for patch_id, source_info, context in self._previous_list:
+            self._write_patch(self._out, patch_id, [(source_info, context)])
+            self._write_record(patch_id, source_info, context)
+            self._exact_nmatch += 1
+        self._write_count(self._out, self._exact_nmatch)
+        self._write_tail(self._out)
+        self._out.close()
+        self._count('report_bytes_total', os.path.getsize(self._outfile), format='html')
+        self._out = None
+        self._close_writers()
+        self._print_dedup_stats()
+        self._print_near_stats()
+        elapsed_time = time.time() - self._start_time
+        common.progress_print('[+] %d exact matches, %d of %d possible matches rejected, \"%s\" ... %.1fs\n' %\
+                (self._exact_nmatch, self._nrejected, self._ncandidate, self._outfile, elapsed_time), self._settings)
+        return self._exact_nmatch
+
+    def _print_dedup_stats(self):
+        nhit = self._metrics.get('dedup_verify_hits_total')
+        if nhit:
+            common.progress_print('[+] dedup: %d copies verified once, %.2fs saved' % \
+                    (nhit, self._metrics.get('dedup_saved_seconds_total', stage='verify')), self._settings)
+
+    def _print_near_stats(self):
+        if self._settings.near_threshold:
+            common.progress_print('[+] %d of the matches are near clones (similarity %.2f or more)' % \
+                    (self._metrics.get('near_matches_total'), self._settings.near_threshold), self._settings)
+
+    def _count(self, name, value=1, **labels):
+        metrics.count(name, value, **labels)
+        self._metrics.count(name, value, **labels)
+
+    def _count_candidates(self, ncandidate, nmatched):
+        self._ncandidate += ncandidate
+        self._nrejected += ncandidate - nmatched
+        self._count('candidate_pairs_total', ncandidate)
+        self._count('exact_rejections_total', ncandidate - nmatched)
+
+    def _write_record(self, patch_id, source_info, context):
+        '''
+        Hand an exact match over to machine-readable writers
+        '''
+        self._count('exact_matches_total')
+        if context.near:
+            self._count('near_matches_total')
+        for writer in self._writer_list:
+            writer.write_match(patch_id, self._patch_list[patch_id], source_info, context)
+
+    def _close_writers(self):
+        for writer in self._writer_list:
+            writer.close()
+        self._writer_list = []
+
+    def _write_head(self, out):
         # html head - css, javascript
         out.write("""
 <!DOCTYPE html>
@@ -105,76 +340,72 @@ class Reporter(object):
 </head>
 <body>
 <div style="width: 100%; margin: 0px auto">""")
+
+    def _write_count(self, out, exact_nmatch):
         # unpatched code clones
         out.write("""
     <b># <i>unpatched code clones:</i> <font style="color:red">%d</font></b>""" % exact_nmatch)
 
-        for patch_id, context_list in self._context_dict.items():
-            p = self._patch_list[patch_id]
-            out.write("""
+    def _write_patch(self, out, patch_id, source_context_list):
+        p = self._patch_list[patch_id]
+        out.write("""
     <div class="container">
         <br />""")
-            # patch info
-            out.write("""
+        # patch info
+        out.write("""
         <div class="patch">
             <div class="filepath">%s</div>
             <div class="codechunk">%s</div>
-        </div>""" % (p.file_path, p.orig_lines))
+        </div>""" % ('<br />'.join(p.labels), p.orig_lines))
 
-            for context in context_list:
-                s = self._source_list[context.source_id]
-                # source info - prev_context
-                out.write("""
+        for s, context in source_context_list:
+            # source info - prev_context
+            out.write("""
         <div class="source">
             <div class="filepath">%s</div>
             <div style="display: none">
-                <div class="linenumber">""" % s.file_path)
+                <div class="linenumber">""" % (s.file_path if not context.near else '%s (similarity %.2f)' % (s.file_path, context.similarity)))
 
-                for i in range(context.prev_context_line, context.start_line):
-                    out.write("""
+            for i in range(context.prev_context_line, context.start_line):
+                out.write("""
                 %d<br />""" % (i+1))
 
-                out.write("""
+            out.write("""
                 </div>
                 <div class="codechunk">%s</div>
             </div><a href="javascript:;" onclick="togglePrev(this);">+ show +</a>""" % self._html_escape('\n'.join(s.orig_lines[context.prev_context_line:context.start_line])))
-                # source info
-                out.write("""
+            # source info
+            out.write("""
             <div>
                 <div class="linenumber">""")
 
-                for i in range(context.start_line, context.end_line):
-                    out.write("""
+            for i in range(context.start_line, context.end_line):
+                out.write("""
                 %d<br />""" % (i+1))
 
-                out.write("""
+            out.write("""
                 </div>
                 <div class="codechunk">%s</div>
             </div>""" % self._html_escape('\n'.join(s.orig_lines[context.start_line:context.end_line])))
-                # source info - next_context
-                out.write("""
+            # source info - next_context
+            out.write("""
             <a href="javascript:;" onclick="toggleNext(this);">+ show +</a><div style="display: none">
                 <div class="linenumber">""")
 
-                for i in range(context.end_line, context.next_context_line):
-                    out.write("""
+            for i in range(context.end_line, context.next_context_line):
+                out.write("""
                 %d<br />""" % (i+1))
 
-                out.write("""
+            out.write("""
                 </div>
                 <div class="codechunk">%s</div>
             </div>
         </div>""" % self._html_escape('\n'.join(s.orig_lines[context.end_line:context.next_context_line])))
-            out.write("""
+        out.write("""
     </div>""")
 
+    def _write_tail(self, out):
         out.write("""
 </div>
 </body>
 </html>""")
-        out.close()
-
-        elapsed_time = time.time() - start_time
-        print '[+] \"%s\" ... %.1fs\n' % (outfile, elapsed_time)
-        return exact_nmatch
-
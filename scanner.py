@@ -0,0 +1,184 @@
+# scanner.py
+#   Scanner class (scans with their own settings and a patch set loaded once)
+#
+#   A Scanner hands its settings (common.Settings) to the loaders and the
+#   reporter of its calls instead of the global variables in common.py, so
+#   scanners of different settings can run in one process at the same time
+#   and patches are parsed once for any number of scans.
+#
+from collections import namedtuple
+import common
+import archive
+import patchloader
+import sourceloader
+import reporter
+import metrics
+
+# line numbers are 1-based and inclusive (same as JSON Lines records)
+Match = namedtuple('Match',\
+        ['patch_id', 'patch', 'source', 'start_line', 'end_line', 'context_start_line', 'context_end_line', 'patch_labels', 'similarity', 'near'])
+# candidates: patch ids of possible matches, matches: exact matches
+FileResult = namedtuple('FileResult',\
+        ['source_path', 'file_ext', 'candidates', 'matches'])
+
+
+class _ResultCollector(object):
+    '''
+    Reporter stand-in for SourceLoader: verifies possible matches of each
+    source file into a FileResult
+    '''
+
+    def __init__(self, patch_list, verifier):
+        self._patch_list = patch_list
+        self._verifier = verifier
+        self.result_list = []
+
+    def add_source(self, source_info, source_id, patch_id_list):
+        context_dict = self._verifier.verify(source_info, source_id, patch_id_list)
+        match_list = []
+        for patch_id in sorted(context_dict):
+            p = self._patch_list[patch_id]
+            for context in context_dict[patch_id]:
+                match_list.append(Match(patch_id, p.file_path, source_info.file_path, context.start_line + 1,\
+                        context.end_line, context.prev_context_line + 1, context.next_context_line, list(p.labels), context.similarity, context.near))
+        self.result_list.append(FileResult(source_info.file_path, source_info.file_ext, sorted(set(patch_id_list)), match_list))
+
+
+class Scanner(object):
+
+    def __init__(self, patch_path=None, **settings):
+        '''
+        settings: names in common.setting_names, others are left at their
+        defaults (progress output is off)
+        '''
+        self._settings = common.Settings(**dict({'progress_mode': False}, **settings))
+        if 'magic_cookie' not in settings:
+            try:
+                self._settings.magic_cookie = common.open_magic_cookie()
+            except ImportError:
+                if self._settings.classify_mode == 'magic':
+                    raise
+        self._patch = None
+        if patch_path is not None:
+            self.load_patches(patch_path)
+
+    def settings(self):
+        return self._settings.to_dict()
+
+    def load_patches(self, patch_path):
+        '''
+        Load (or reload) patch files or a compiled patch database
+        Return the number of patches
+        '''
+        patch = patchloader.PatchLoader(self._settings)
+        if patch.traverse(patch_path, strict=True) == 0:
+            raise ValueError('%s: no patch to be queried' % patch_path)
+        self._patch = patch
+        return patch.length()
+
+    def patch_count(self):
+        return self._patch.length() if self._patch else 0
+
+    def patches(self):
+        '''
+        Return the loaded patches (PatchInfo by patch id)
+        '''
+        self._check_patch()
+        return self._patch.items()
+
+    def compile(self, db_path):
+        '''
+        Compile loaded patches into a database
+        '''
+        self._patch.compile(db_path)
+
+    def _check_patch(self):
+        if self._patch is None:
+            raise ValueError('no patch loaded')
+
+    def scan_file(self, source_path):
+        '''
+        Scan a source file, or the members of an archive with scan_archives
+        (as scan_tree does)
+        Return a FileResult (file_ext is None for a non-text file or an
+        archive, whose members are the sources of its matches)
+        '''
+        self._check_patch()
+        source, collector = self._source_loader()
+        magic_ext = None
+        for magic_ext, tier, result in source._query_path(source_path):
+            if result:
+                source._add_source(*result)
+        if self._settings.scan_archives and archive.is_archive(source_path):
+            return FileResult(source_path, None, sorted(set(patch_id for r in collector.result_list for patch_id in r.candidates)),\
+                    [m for r in collector.result_list for m in r.matches])
+        return collector.result_list[0] if collector.result_list else FileResult(source_path, magic_ext, [], [])
+
+    def scan_content(self, source_path, contents):
+        '''
+        Scan file contents in memory (source_path only names the file)
+        Return a FileResult (file_ext is None for non-text contents)
+        '''
+        self._check_patch()
+        source, collector = self._source_loader()
+        magic_ext, tier = source._classifier.classify_buffer(source_path, contents)
+        if magic_ext is not None:
+            result = source._query_content(source_path, magic_ext, contents)
+            if result:
+                source._add_source(*result)
+        return collector.result_list[0] if collector.result_list else FileResult(source_path, magic_ext, [], [])
+
+    def scan_tree(self, source_path):
+        '''
+        Scan source files under a path
+        Return FileResults of files with possible matches, in walk order
+        '''
+        self._check_patch()
+        source, collector = self._source_loader()
+        source.traverse(source_path, self._patch, collector)
+        return collector.result_list
+
+    def _source_loader(self):
+        source = sourceloader.SourceLoader(self._settings)
+        collector = _ResultCollector(self._patch.items(), reporter.Reporter(self._patch, source, settings=self._settings))
+        source._set_patch(self._patch, collector)
+        return source, collector
+
+    def report(self, source_path, html_path, writer_list=None, git_range=None, stream=False, profile_dir=None, previous_list=None):
+        '''
+        Scan source files (or files changed in git_range) and write an HTML
+        report, all at the end or one source file at a time (stream)
+        previous_list: matches kept from a previous scan, reported as well
+        Return (possible matches, exact matches)
+        '''
+        self._check_patch()
+        if git_range:
+            # changed files are read from git one at a time, not walked
+            unsupported_list = [name for name, is_set in (('jobs', self._settings.jobs > 1), ('cache_dir', self._settings.cache_dir),\
+                    ('shard_count', self._settings.shard_count), ('scan_archives', self._settings.scan_archives),\
+                    ('prune_dirs', self._settings.prune_dirs != common.prune_dirs)) if is_set]
+            if unsupported_list:
+                raise ValueError('git_range cannot be used with %s' % ', '.join(unsupported_list))
+        source = sourceloader.SourceLoader(self._settings)
+        if stream:
+            report = reporter.Reporter(self._patch, source, writer_list, previous_list, self._settings)
+            report.open(html_path)
+            with metrics.stage('source', profile_dir):
+                if git_range:
+                    nmatch = source.traverse_git(git_range, self._patch, report)
+                else:
+                    nmatch = source.traverse(source_path, self._patch, report)
+                return nmatch, report.close()
+
+        with metrics.stage('source', profile_dir):
+            if git_range:
+                nmatch = source.traverse_git(git_range, self._patch)
+            else:
+                nmatch = source.traverse(source_path, self._patch)
+        if nmatch == 0 and not previous_list:
+            for w in writer_list or []:
+                w.close()
+            return nmatch, 0
+        report = reporter.Reporter(self._patch, source, writer_list, previous_list, self._settings)
+        with metrics.stage('report', profile_dir):
+            return nmatch, report.output(html_path)
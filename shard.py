@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+#
+# shard.py
+#   sharded scans: shard selection of a source walk, partial result files,
+#   and merging partial results into one report
+#
+#   A shard I/N walks source_path in sorted order and keeps the files of
+#   shard I, by a hash of their relative paths or size-balanced over the
+#   whole walk, so every machine picks the same files. Each shard writes a
+#   partial result file (JSON Lines, text as latin-1 to keep bytes), and the
+#   partial results of all shards are merged into the report an unsharded
+#   run of the sorted walk would write:
+#
+#   $ python redebug.py --shard 0/4 --partial part0.jsonl patches/ src/
+#   ...
+#   $ python shard.py -o output.html --jsonl output.jsonl part*.jsonl
+#
+import sys
+import os
+import json
+import time
+import heapq
+import hashlib
+import argparse
+import common
+import reporter
+import writer
+import metrics
+
+PARTIAL_FORMAT = 1
+
+
+def parse_shard(text):
+    '''
+    Parse I/N (0 <= I < N)
+    Return (I, N)
+    '''
+    try:
+        shard_index, shard_count = [int(n) for n in text.split('/')]
+    except ValueError:
+        raise ValueError('a shard is I/N')
+    if not 0 <= shard_index < shard_count:
+        raise ValueError('a shard I/N needs 0 <= I < N')
+    return shard_index, shard_count
+
+def relative_path(file_path, source_path):
+    '''
+    Path of a source file (or archive!member) relative to source_path
+    '''
+    top_path, sep, member = file_path.partition('!')
+    if os.path.isdir(source_path):
+        top_path = os.path.relpath(top_path, source_path)
+    else:
+        top_path = os.path.basename(top_path)
+    return top_path + sep + member
+
+def walk_key(rel_path):
+    '''
+    Sort key of the sorted walk order (files of a directory before its
+    subdirectories), archive members keep their order
+    '''
+    name_list = rel_path.partition('!')[0].split(os.sep)
+    return [(1, name) for name in name_list[:-1]] + [(0, name_list[-1])]
+
+def _hash_shard(rel_path, shard_count):
+    return int(hashlib.md5(rel_path).hexdigest()[:8], 16) % shard_count
+
+def select(path_iter, source_path, shard_index, shard_count, shard_by='hash'):
+    '''
+    Generate paths of a walk that belong to a shard
+    '''
+    if shard_by == 'hash':
+        for file_path in path_iter:
+            selected = _hash_shard(relative_path(file_path, source_path), shard_count) == shard_index
+            metrics.count('shard_files_total', shard='selected' if selected else 'other')
+            if selected:
+                yield file_path
+        return
+
+    # size-balanced: largest files first, each to the least loaded shard
+    path_list = list(path_iter)
+    size_list = []
+    for file_path in path_list:
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            size = 0
+        size_list.append((-size, relative_path(file_path, source_path), file_path))
+    shard_heap = [(0, 0, i) for i in range(shard_count)]
+    selected_set = set()
+    for neg_size, rel_path, file_path in sorted(size_list):
+        load, nfile, i = heapq.heappop(shard_heap)
+        if i == shard_index:
+            selected_set.add(file_path)
+        heapq.heappush(shard_heap, (load - neg_size, nfile + 1, i))
+    for file_path in path_list:
+        selected = file_path in selected_set
+        metrics.count('shard_files_total', shard='selected' if selected else 'other')
+        if selected:
+            yield file_path
+
+
+def _text(string):
+    return string.decode('latin-1')
+
+def _bytes(text):
+    return text.encode('latin-1')
+
+
+class PartialWriter(object):
+    '''
+    Reporter writer of a partial result file: a shard header, each patch
+    once, each exact match with its context lines, and an end record
+    '''
+
+    def __init__(self, path, source_path, shard_index, shard_count, shard_by, npatch):
+        self._source_path = source_path
+        self._out = open(path, 'w')
+        self._patch_id_set = set()
+        self._nrecord = 0
+        self._write({'type': 'shard', 'format': PARTIAL_FORMAT, 'shard': shard_index, 'shards': shard_count,\
+                'shard_by': shard_by, 'patches': npatch, 'source_path': _text(source_path or '')})
+
+    def _write(self, record):
+        self._out.write(json.dumps(record, sort_keys=True) + '\n')
+
+    def write_match(self, patch_id, patch_info, source_info, context):
+        if patch_id not in self._patch_id_set:
+            self._patch_id_set.add(patch_id)
+            self._write({'type': 'patch', 'patch_id': patch_id, 'patch': _text(patch_info.file_path),\
+                    'file_ext': patch_info.file_ext, 'labels': [_text(label) for label in patch_info.labels],\
+                    'html': _text(patch_info.orig_lines)})
+        self._write({'type': 'match', 'patch_id': patch_id, 'source': _text(source_info.file_path),\
+                'rel': _text(relative_path(source_info.file_path, self._source_path)), 'file_ext': source_info.file_ext,\
+                'context': [context.prev_context_line, context.start_line, context.end_line, context.next_context_line],\
+                'similarity': context.similarity, 'near': context.near,\
+                'lines': [_text(line) for line in source_info.orig_lines[context.prev_context_line:context.next_context_line]]})
+        self._out.flush()
+        self._nrecord += 1
+
+    def close(self):
+        self._write({'type': 'end', 'matches': self._nrecord})
+        metrics.count('report_bytes_total', self._out.tell(), format='partial')
+        self._out.close()
+        return self._nrecord
+
+
+class _ContextLines(object):
+    '''
+    Source lines of a context window (first_line: line number of lines[0])
+    '''
+
+    def __init__(self, first_line, lines):
+        self._first_line = first_line
+        self._lines = lines
+
+    def __getitem__(self, key):
+        return self._lines[max(0, key.start - self._first_line):max(0, key.stop - self._first_line)]
+
+
+class _ResultSet(object):
+    '''
+    Patches or source files of merged results, read by Reporter
+    '''
+
+    def __init__(self, items):
+        self._items = items
+
+    def items(self):
+        return self._items
+
+    def length(self):
+        return len(self._items)
+
+    def match_items(self):
+        return {}
+
+
+def load_partial(partial_path):
+    '''
+    Load a partial result file
+    Return (shard header, {patch_id: patch record}, [match record])
+    '''
+    header = None
+    patch_dict = {}
+    match_list = []
+    end = None
+    with open(partial_path) as f:
+        for line in f:
+            record = json.loads(line)
+            if header is None:
+                if record.get('type') != 'shard' or record.get('format') != PARTIAL_FORMAT:
+                    raise ValueError('%s: not a partial result file' % partial_path)
+                header = record
+            elif record['type'] == 'patch':
+                patch_dict[record['patch_id']] = record
+            elif record['type'] == 'match':
+                match_list.append(record)
+            elif record['type'] == 'end':
+                end = record
+    if header is None or end is None or end['matches'] != len(match_list):
+        raise ValueError('%s: incomplete partial result file' % partial_path)
+    return header, patch_dict, match_list
+
+def merge(partial_path_list, html_path, writer_list=None):
+    '''
+    Merge partial results of the shards of a scan into one report, in the
+    sorted walk order
+    Return (patches, exact matches)
+    '''
+    common.progress_print('[+] merging %d partial results' % len(partial_path_list))
+    start_time = time.time()
+
+    first_header = None
+    shard_set = set()
+    patch_dict = {}
+    match_list = []
+    for partial_path in partial_path_list:
+        header, partial_patch_dict, partial_match_list = load_partial(partial_path)
+        if first_header is None:
+            first_header = header
+        elif [header[key] for key in ('shards', 'shard_by', 'patches')] !=\
+                [first_header[key] for key in ('shards', 'shard_by', 'patches')]:
+            raise ValueError('%s: shards of another scan' % partial_path)
+        if header['shard'] in shard_set:
+            raise ValueError('%s: shard %d/%d given twice' % (partial_path, header['shard'], header['shards']))
+        shard_set.add(header['shard'])
+        for patch_id, record in partial_patch_dict.items():
+            if patch_id in patch_dict and patch_dict[patch_id]['patch'] != record['patch']:
+                raise ValueError('%s: shards of another patch set' % partial_path)
+            patch_dict[patch_id] = record
+        match_list += partial_match_list
+
+    missing_list = sorted(set(range(first_header['shards'])) - shard_set)
+    if missing_list:
+        common.progress_print('[!] missing shards: %s' % ', '.join('%d/%d' % (i, first_header['shards']) for i in missing_list))
+
+    patch_info_dict = {}
+    for patch_id, record in patch_dict.items():
+        patch_info_dict[patch_id] = common.PatchInfo(_bytes(record['patch']), record['file_ext'], _bytes(record['html']),\
+                None, None, None, [_bytes(label) for label in record['labels']])
+    # a stable sort keeps the order of contexts of a file within its shard
+    match_list.sort(key=lambda record: walk_key(_bytes(record['rel'])))
+    source_list = []
+    context_dict = dict((patch_id, []) for patch_id in sorted(set(record['patch_id'] for record in match_list)))
+    for record in match_list:
+        prev_context_line, start_line, end_line, next_context_line = record['context']
+        source_info = common.SourceInfo(_bytes(record['source']), record['file_ext'],\
+                _ContextLines(prev_context_line, [_bytes(line) for line in record['lines']]), None, None)
+        context = common.ContextInfo(len(source_list), prev_context_line, start_line, end_line, next_context_line,\
+                record.get('similarity', 1.0), record.get('near', False))
+        source_list.append(source_info)
+        context_dict[record['patch_id']].append(context)
+
+    report = reporter.Reporter(_ResultSet(patch_info_dict), _ResultSet(source_list))
+    for patch_id, context_list in context_dict.items():
+        for context in context_list:
+            for w in writer_list or []:
+                w.write_match(patch_id, patch_info_dict[patch_id], source_list[context.source_id], context)
+    for w in writer_list or []:
+        w.close()
+    if match_list:
+        report.write_html(html_path, len(match_list), [(patch_id, [(source_list[context.source_id], context) for context in context_list])\
+                for patch_id, context_list in context_dict.items()])
+
+    elapsed_time = time.time() - start_time
+    common.progress_print('[+] %d exact matches of %d shards, \"%s\" ... %.1fs\n' % (len(match_list), len(shard_set), html_path, elapsed_time))
+    return first_header['patches'], len(match_list)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='merge partial results of sharded scans (redebug.py --shard --partial) into one report')
+    parser.add_argument('-o', '--output', action='store', dest='html_path', default='output.html', metavar='FILE',\
+            help='write an HTML report to FILE (default: %(default)s)')
+    parser.add_argument('--jsonl', action='store', dest='jsonl_path', default=None, metavar='FILE',\
+            help='write exact matches to FILE as JSON Lines')
+    parser.add_argument('--sarif', action='store', dest='sarif_path', default=None, metavar='FILE',\
+            help='write exact matches to FILE in SARIF 2.1.0')
+    parser.add_argument('--record-context', action='store_true', dest='record_context', default=False,\
+            help='include source lines in JSON Lines/SARIF records (default: %(default)s)')
+    parser.add_argument('partial_path', nargs='+', help='partial result files of the shards')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    writer_list = []
+    if args.jsonl_path:
+        writer_list.append(writer.JsonLinesWriter(args.jsonl_path, args.record_context))
+    if args.sarif_path:
+        writer_list.append(writer.SarifWriter(args.sarif_path, args.record_context))
+    try:
+        npatch, exact_nmatch = merge(args.partial_path, args.html_path, writer_list)
+    except (ValueError, IOError) as err:
+        print('[!] %s' % err)
+        sys.exit(1)
+    if exact_nmatch == 0:
+        print('[!] no exact match found')
+        sys.exit(1)
+    elapsed_time = time.time() - start_time
+    print '[+] %d matches given %d patches ... %.1fs' % (exact_nmatch, npatch, elapsed_time)
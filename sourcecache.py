@@ -0,0 +1,119 @@
+# sourcecache.py
+#   SourceCache class (on-disk cache of normalized and hashed source files)
+#
+import os
+import time
+import struct
+import marshal
+import hashlib
+import tempfile
+import common
+import metrics
+
+CACHE_FORMAT = 2
+
+
+class SourceCache(object):
+
+    def __init__(self, cache_dir, settings=None):
+        self._settings = settings or common.Settings()
+        self._cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _version(self):
+        '''
+        Everything a cached entry depends on besides the file contents
+        '''
+        return (CACHE_FORMAT, common.normalizer_version, self._settings.hash_scheme, self._settings.ngram_size)
+
+    def _entry_path(self, source_path):
+        key = hashlib.sha1(os.path.abspath(source_path)).hexdigest()
+        return os.path.join(self._cache_dir, key[:2], key[2:])
+
+    def get(self, source_path, magic_ext):
+        '''
+        Look up a source file normalized as magic_ext (path + size + mtime,
+        content digest fallback)
+        Return (digest, norm_lines, ngram_list) or None, digest is the SHA-1
+        of the original contents
+        '''
+        entry_path = self._entry_path(source_path)
+        try:
+            with open(entry_path, 'rb') as f:
+                entry = marshal.load(f)
+        except (IOError, EOFError, ValueError, TypeError):
+            metrics.count('cache_lookups_total', result='miss')
+            return None
+        if entry['version'] != self._version() or entry['path'] != os.path.abspath(source_path) or\
+                entry['file_ext'] != magic_ext:
+            metrics.count('cache_lookups_total', result='miss')
+            return None
+
+        try:
+            source_stat = os.stat(source_path)
+            if (entry['size'], entry['mtime']) != (source_stat.st_size, source_stat.st_mtime):
+                with open(source_path, 'r') as f:
+                    source_orig_lines = f.read()
+            else:
+                source_orig_lines = None
+        except (IOError, OSError):
+            # deleted or unreadable since the walk, left to an uncached read
+            metrics.count('cache_lookups_total', result='miss')
+            return None
+        if source_orig_lines is not None:
+            if entry['digest'] != hashlib.sha1(source_orig_lines).hexdigest():
+                metrics.count('cache_lookups_total', result='miss')
+                return None
+            # same contents, refresh size and mtime
+            self._write(entry_path, dict(entry, size=source_stat.st_size, mtime=source_stat.st_mtime))
+
+        metrics.count('cache_lookups_total', result='hit')
+        return (entry['digest'], entry['norm'], self._load_ngram_list(entry['ngram']))
+
+    def put(self, source_path, magic_ext, source_orig_lines, source_norm_lines, ngram_list):
+        '''
+        Store a source file normalized and hashed as magic_ext
+        '''
+        try:
+            source_stat = os.stat(source_path)
+        except OSError:
+            return
+        if source_stat.st_mtime >= time.time() - 2:
+            # a racily modified file could keep its size and mtime
+            return
+        self._write(self._entry_path(source_path), {
+            'version': self._version(),
+            'path': os.path.abspath(source_path),
+            'file_ext': magic_ext,
+            'size': source_stat.st_size,
+            'mtime': source_stat.st_mtime,
+            'digest': hashlib.sha1(source_orig_lines).hexdigest(),
+            'norm': source_norm_lines,
+            'ngram': self._dump_ngram_list(ngram_list)})
+
+    def _dump_ngram_list(self, ngram_list):
+        if self._settings.hash_scheme == 1:
+            return ngram_list
+        # fixed-width 64-bit keys, whatever the size of a C long
+        return struct.pack('<%dQ' % len(ngram_list), *ngram_list)
+
+    def _load_ngram_list(self, ngram):
+        if self._settings.hash_scheme == 1:
+            return ngram
+        return list(struct.unpack('<%dQ' % (len(ngram) / 8), ngram))
+
+    def _write(self, entry_path, entry):
+        '''
+        Write an entry atomically (workers may share a cache directory)
+        '''
+        entry_dir = os.path.dirname(entry_path)
+        if not os.path.isdir(entry_dir):
+            try:
+                os.makedirs(entry_dir)
+            except OSError:
+                pass
+        fd, tmp_path = tempfile.mkstemp(dir=entry_dir)
+        with os.fdopen(fd, 'wb') as f:
+            marshal.dump(entry, f)
+        os.rename(tmp_path, entry_path)
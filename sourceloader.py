@@ -7,8 +7,20 @@ import sys
 import os
 import re
 import time
+import hashlib
+import random
+import multiprocessing
 from collections import defaultdict
 import common
+import sourcecache
+import classifier
+import archive
+import prefetch
+import textlines
+import shard
+import bloomvec
+import normalizer
+import metrics
 
 try:
     import bitarray
@@ -17,67 +29,374 @@ except ImportError as err:
     sys.exit(-1)
 
 
+# SourceLoader shared with worker processes (inherited by fork, not pickled)
+_worker_loader = None
+
+def _init_worker():
+    # counters inherited by fork are already counted in the main process
+    metrics.default.drain()
+
+def _query_worker(source_path):
+    return list(_worker_loader._query_path(source_path)), metrics.default.drain()
+
+
 class SourceLoader(object):
 
-    def __init__(self):
+    def __init__(self, settings=None):
+        self._settings = settings or common.Settings()
         self._patch_list = []
         self._npatch = 0
         self._source_list = []
         self._nsource = 0
         self._match_dict = defaultdict(list)
         self._nmatch = 0
-        self._bit_vector = bitarray.bitarray(common.bloomfilter_size)
+        self._bit_vector_dict = {}
+        self._patch_bits = None
+        self._near_index = None
+        self._random = random.Random(0)
+        self._ngram_index = {}
+        self._ngram_count = []
+        self._blob_dict = {}
+        self._classifier = classifier.FileClassifier(settings=self._settings)
+        self._reporter = None
+        self._cache = None
+        self._metrics = metrics.Metrics()
+        if self._settings.cache_dir:
+            self._cache = sourcecache.SourceCache(self._settings.cache_dir, self._settings)
 
-    def traverse(self, source_path, patch):
+    def traverse(self, source_path, patch, reporter=None):
         '''
         Traverse source files
+        With a reporter, possible matches are handed over to the reporter
+        as soon as they are found instead of being kept
+        '''
+        common.progress_print('[+] traversing source files', self._settings)
+        start_time = time.time()
+        with metrics.collect() as self._metrics:
+            self._set_patch(patch, reporter)
+
+            if self._settings.jobs > 1:
+                self._traverse_parallel(source_path)
+            elif self._settings.prefetch_depth > 0 and not self._cache:
+                self._traverse_prefetch(source_path)
+            else:
+                for file_path in self._walk(source_path):
+                    for magic_ext, tier, result in self._query_path(file_path):
+                        self._count(magic_ext, tier)
+                        if result:
+                            self._add_source(*result)
+
+            if self._settings.shard_count:
+                common.progress_print('[+] shard %d/%d (%s): %d of %d files' % (self._settings.shard_index, self._settings.shard_count, self._settings.shard_by,\
+                        self._metrics.get('shard_files_total', shard='selected'), sum(n for labels, n in self._metrics.samples('shard_files_total'))), self._settings)
+            common.progress_print('[+] classified files: %s' % ', '.join('%d %s' % (n, tier) for tier, n in sorted(self._classifier.stats().items())), self._settings)
+            if self._cache:
+                common.progress_print('[+] cache: %d hits, %d misses' % (self._metrics.get('cache_lookups_total', result='hit'),\
+                        self._metrics.get('cache_lookups_total', result='miss')), self._settings)
+            if self._settings.query_engine == 'bloom':
+                self._print_membership_stats()
+            if self._settings.dedup_mode != 'off':
+                self._print_dedup_stats()
+            common.progress_print('[+] I/O wait %.2fs, compute %.2fs' % (self._metrics.get('io_wait_seconds_total'),\
+                    self._metrics.get('compute_seconds_total')), self._settings)
+            elapsed_time = time.time() - start_time
+        common.progress_print('[+] %d possible matches ... %.1fs\n' % (self._nmatch, elapsed_time), self._settings)
+        return self._nmatch
+
+    def traverse_git(self, git_range, patch, reporter=None):
+        '''
+        Traverse source files added or modified in a git revision range
         '''
-        print '[+] traversing source files'
+        common.progress_print('[+] traversing source files changed in the revision range', self._settings)
         start_time = time.time()
+        with metrics.collect() as self._metrics:
+            self._set_patch(patch, reporter)
+
+            for file_path, source_orig_lines in git_range.read_files():
+                metrics.count('bytes_read_total', len(source_orig_lines), kind='git')
+                magic_ext, tier = self._classifier.classify_buffer(file_path, source_orig_lines)
+                common.verbose_print('  [-] %s: %s (%s)' % (file_path, magic_ext, tier), self._settings)
+                self._count(magic_ext, tier)
+                if magic_ext is not None:
+                    result = self._query_content(file_path, magic_ext, source_orig_lines)
+                    if result:
+                        self._add_source(*result)
+
+            common.progress_print('[+] %d changed files' % len(git_range.changes()), self._settings)
+            common.progress_print('[+] classified files: %s' % ', '.join('%d %s' % (n, tier) for tier, n in sorted(self._classifier.stats().items())), self._settings)
+            elapsed_time = time.time() - start_time
+        common.progress_print('[+] %d possible matches ... %.1fs\n' % (self._nmatch, elapsed_time), self._settings)
+        return self._nmatch
+
+    def _set_patch(self, patch, reporter):
         self._patch_list = patch.items()
         self._npatch = patch.length()
+        self._ngram_index = patch.index()
+        self._ngram_count = patch.ngram_count()
+        self._reporter = reporter
+        self._patch_bits = None
+        self._near_index = patch.near_index() if self._settings.near_threshold else None
+        if self._settings.query_engine == 'bloom' and self._settings.bloom_vectorize:
+            # kept by the patch loader for any number of scans, built before
+            # worker processes are forked
+            self._patch_bits = patch.patch_bits()
 
-        if os.path.isfile(source_path):
-            magic_type = common.file_type(source_path)
-            common.verbose_print('  [-] %s: %s' % (source_path, magic_type))
-            if magic_type.startswith('text'):
-                main_type, sub_type = magic_type.split('/')
-                magic_ext = self._get_file_type(sub_type)
-                self._process(source_path, magic_ext)
-        elif os.path.isdir(source_path):
-            for root,dirs,files in os.walk(source_path):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    magic_type = common.file_type(file_path)
-                    common.verbose_print('  [-] %s: %s' % (file_path, magic_type))
-                    if magic_type.startswith('text'):
-                        main_type, sub_type = magic_type.split('/')
-                        magic_ext = self._get_file_type(sub_type)
-                        self._process(file_path, magic_ext)
-
-        elapsed_time = time.time() - start_time
-        print '[+] %d possible matches ... %.1fs\n' % (self._nmatch, elapsed_time)
-        return self._nmatch
+    def _traverse_parallel(self, source_path):
+        '''
+        Query source files in worker processes, merge results in walk order
+        '''
+        global _worker_loader
+        _worker_loader = self
+        # walked here rather than by the pool's feeder thread, so that walk
+        # and shard counters reach the registry of this traversal
+        path_list = list(self._walk(source_path))
+        pool = multiprocessing.Pool(self._settings.jobs, _init_worker)
+        try:
+            for result_list, value_dict in pool.imap(_query_worker, path_list, chunksize=16):
+                metrics.merge(value_dict)
+                for magic_ext, tier, result in result_list:
+                    self._count(magic_ext, tier)
+                    if result:
+                        self._add_source(*result)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+            _worker_loader = None
+
+    def _walk(self, source_path):
+        '''
+        Generate source file paths (of a shard, in sorted order, if sharded)
+        '''
+        if self._settings.shard_count:
+            return shard.select(self._classifier.walk(source_path, sort=True), source_path,\
+                    self._settings.shard_index, self._settings.shard_count, self._settings.shard_by)
+        return self._classifier.walk(source_path)
+
+    def _query_path(self, source_path):
+        '''
+        Classify and query a source file, or each member of an archive
+        Generate (magic_ext, tier, possible match or None)
+        '''
+        if self._settings.scan_archives and archive.is_archive(source_path):
+            for item in self._query_archive(source_path):
+                yield item
+            return
+        magic_ext, tier = self._classify(source_path)
+        result = None
+        if magic_ext is not None:
+            result = self._query_file(source_path, magic_ext)
+        yield magic_ext, tier, result
+
+    def _query_archive(self, archive_path):
+        '''
+        Query archive members as they are streamed, each read at most once
+        '''
+        metrics.count('archives_total')
+        try:
+            for member_path, size, read in archive.iter_members(archive_path):
+                magic_ext, tier, contents = self._classifier.classify_member(member_path, size, read)
+                common.verbose_print('  [-] %s: %s (%s)' % (member_path, magic_ext, tier), self._settings)
+                metrics.count('archive_members_total')
+                result = None
+                if magic_ext is not None:
+                    if contents is None:
+                        contents = read()
+                        metrics.count('bytes_read_total', len(contents), kind='archive')
+                    result = self._query_content(member_path, magic_ext, contents)
+                yield magic_ext, tier, result
+        except archive.ArchiveError as err:
+            common.progress_print('[!] %s' % err, self._settings)
+            yield None, 'archive-error', None
+
+    def _traverse_prefetch(self, source_path):
+        '''
+        Query source files in walk order while a read-ahead stage reads the
+        upcoming text files
+        '''
+        reader = prefetch.Prefetcher(self._settings.prefetch_depth, self._settings.prefetch_bytes)
+        for (file_path, magic_ext, tier), source_orig_lines in reader.read_ahead(self._read_ahead_items(source_path)):
+            if tier is None:
+                result_iter = self._query_path(file_path)
+            else:
+                result = None
+                if magic_ext is not None:
+                    metrics.count('bytes_read_total', len(source_orig_lines), kind='source')
+                    result = self._query_file(file_path, magic_ext, source_orig_lines)
+                result_iter = [(magic_ext, tier, result)]
+            for magic_ext, tier, result in result_iter:
+                self._count(magic_ext, tier)
+                if result:
+                    self._add_source(*result)
+
+    def _read_ahead_items(self, source_path):
+        '''
+        Generate (path to read or None, (path, magic_ext, tier)), archives
+        are left to _query_path (tier None)
+        '''
+        for file_path in self._walk(source_path):
+            if self._settings.scan_archives and archive.is_archive(file_path):
+                yield None, (file_path, None, None)
+                continue
+            magic_ext, tier = self._classify(file_path)
+            yield (file_path if magic_ext is not None else None), (file_path, magic_ext, tier)
+
+    def _classify(self, source_path):
+        '''
+        Determine a file type of a text file, None otherwise
+        '''
+        magic_ext, tier = self._classifier.classify(source_path)
+        common.verbose_print('  [-] %s: %s (%s)' % (source_path, magic_ext, tier), self._settings)
+        return magic_ext, tier
+
+    def _count(self, magic_ext, tier):
+        self._classifier.count(tier)
+        metrics.count('files_classified_total', tier=tier)
+        if magic_ext is None:
+            metrics.count('files_skipped_total', tier=tier)
 
     def _process(self, source_path, magic_ext):
         '''
         Normalize a source file and build a Bloom filter for queries
         '''
-        source_file = open(source_path, 'r')
-        source_orig_lines = source_file.read()
-        source_file.close()
+        result = self._query_file(source_path, magic_ext)
+        if result:
+            self._add_source(*result)
 
-        source_norm_lines = self._normalize(source_orig_lines, magic_ext)
-        if self._query_bloomfilter(source_norm_lines, magic_ext):
-            source_norm_lines = re.split('\n', source_norm_lines)
-            source_orig_lines = re.split('\n', source_orig_lines)
-            self._source_list.append(common.SourceInfo(source_path, magic_ext, source_orig_lines, source_norm_lines))
-            self._nsource += 1
+    def _query_file(self, source_path, magic_ext, source_orig_lines=None):
+        '''
+        Normalize and query a source file (its contents if already read)
+        Return (source_path, magic_ext, patch_id_list, orig_lines, norm_lines,
+        digest) for a possible match, None otherwise (orig_lines maps the file
+        again to read only the lines reported, checked against the digest)
+        '''
+        cached = None
+        if source_orig_lines is None and self._cache:
+            cached = self._cache.get(source_path, magic_ext)
+        if cached:
+            digest, source_norm_lines, ngram_list = cached
+        else:
+            if source_orig_lines is None:
+                source_orig_lines = self._read(source_path)
+            digest = hashlib.sha1(source_orig_lines).hexdigest()
+            source_norm_lines = ngram_list = None
+        return self._query_blob(source_path, magic_ext, textlines.TextLines(file_path=source_path, digest=digest), source_orig_lines,\
+                digest if self._settings.dedup_mode == 'raw' else None, source_norm_lines, ngram_list, self._cache)
+
+    def _read(self, source_path):
+        '''
+        Read a source file, counting the time as I/O wait
+        '''
+        with metrics.timer('io_wait_seconds_total'):
+            source_file = open(source_path, 'r')
+            source_orig_lines = source_file.read()
+            source_file.close()
+        metrics.count('bytes_read_total', len(source_orig_lines), kind='source')
+        return source_orig_lines
+
+    def _query_content(self, source_path, magic_ext, source_orig_lines):
+        '''
+        Normalize and query file contents already in memory
+        '''
+        digest = None
+        if self._settings.dedup_mode == 'raw':
+            digest = hashlib.sha1(source_orig_lines).hexdigest()
+        return self._query_blob(source_path, magic_ext, textlines.TextLines(text=source_orig_lines), source_orig_lines, digest)
+
+    def _query_blob(self, source_path, magic_ext, source_lines, source_orig_lines, digest=None,\
+            source_norm_lines=None, ngram_list=None, cache=None):
+        '''
+        Normalize and query contents once per distinct digest (of original
+        or normalized contents, by dedup_mode): later copies take over the
+        result of the first
+        Return _add_source() arguments for a possible match, None otherwise
+        '''
+        start_time = time.time()
+        if self._settings.dedup_mode != 'off':
+            metrics.count('dedup_files_total')
+        if (magic_ext, digest) not in self._blob_dict:
+            if source_norm_lines is None:
+                with metrics.timer('compute_seconds_total'):
+                    source_norm_lines = self._normalize(source_orig_lines, magic_ext)
+                    ngram_list = common.build_ngram_list(source_norm_lines.split(), self._settings)
+                if cache:
+                    cache.put(source_path, magic_ext, source_orig_lines, source_norm_lines, ngram_list)
+            if self._settings.dedup_mode == 'normalized':
+                # copies are normalized anyway, only queries are saved
+                digest = hashlib.sha1(source_norm_lines).hexdigest()
+                start_time = time.time()
+
+        blob_key = (magic_ext, digest)
+        if digest is not None and blob_key in self._blob_dict:
+            patch_id_list, blob_norm_lines, elapsed_time = self._blob_dict[blob_key]
+            common.verbose_print('      - same contents as a file already queried', self._settings)
+            metrics.count('dedup_hits_total')
+            metrics.count('dedup_saved_seconds_total', elapsed_time, stage='query')
+            if source_norm_lines is None and patch_id_list:
+                source_norm_lines = blob_norm_lines
+                if source_norm_lines is None:
+                    with metrics.timer('compute_seconds_total'):
+                        source_norm_lines = self._normalize(source_orig_lines, magic_ext)
+        else:
+            with metrics.timer('compute_seconds_total'):
+                patch_id_list = self._query(ngram_list, magic_ext)
+            if digest is not None:
+                # the text of a possible match is shared with later copies
+                # only when all possible matches are kept anyway: a reporter
+                # verifies them as they come, and copies normalize their own
+                keep_text = patch_id_list and not self._reporter
+                self._blob_dict[blob_key] = (patch_id_list, source_norm_lines if keep_text else None, time.time() - start_time)
+        if not patch_id_list:
+            return None
+        return (source_path, magic_ext, patch_id_list, source_lines, source_norm_lines, digest)
+
+    def _query(self, ngram_list, magic_ext):
+        if not ngram_list:
+            common.verbose_print('      - skipped (fewer than %d lines)' % self._settings.ngram_size, self._settings)
+            return []
+        if self._settings.query_engine == 'index':
+            patch_id_list = self._query_index(ngram_list, magic_ext)
+        else:
+            patch_id_list = self._query_bloomfilter(ngram_list, magic_ext)
+        if self._near_index:
+            # near clones are possible matches too, exact matches are verified first
+            near_id_list = self._near_index.query(ngram_list, magic_ext)
+            common.verbose_print('      - %d near-clone candidates' % len(near_id_list), self._settings)
+            patch_id_list = sorted(set(patch_id_list).union(near_id_list))
+        return patch_id_list
+
+    def _add_source(self, source_path, magic_ext, patch_id_list, source_orig_lines, source_norm_lines, digest=None):
+        '''
+        Record a possible match
+        '''
+        for patch_id in patch_id_list:
+            common.verbose_print('      - match (patch #%d : source #%d)' % (patch_id, self._nsource), self._settings)
+            self._nmatch += 1
+        source_norm_lines = re.split('\n', source_norm_lines)
+        source_info = common.SourceInfo(source_path, magic_ext, source_orig_lines, source_norm_lines, digest)
+        if self._reporter:
+            self._reporter.add_source(source_info, self._nsource, patch_id_list)
+        else:
+            for patch_id in patch_id_list:
+                self._match_dict[patch_id].append(self._nsource)
+            self._source_list.append(source_info)
+        self._nsource += 1
 
     def _normalize(self, source, ext):
         '''
         Normalize a source file
         '''
+        ext_name = common.file_ext_name_dict.get(ext, 'Unknown')
+        metrics.count('normalize_bytes_total', len(source), ext=ext_name, stage='source')
+        with metrics.timer('normalize_seconds_total', ext=ext_name, stage='source'):
+            return self._normalize_text(source, ext)
+
+    def _normalize_text(self, source, ext):
+        if self._settings.normalizer_engine == 'scan':
+            return normalizer.normalize_source(source, ext)
+
         # Language-specific optimization
         if ext==common.FileExt.C or ext==common.FileExt.Java:
             norm_lines = []
@@ -122,82 +441,140 @@ class SourceLoader(object):
         # Convert into lowercases
         return source.lower()
 
-    def _query_bloomfilter(self, source_norm_lines, magic_ext):
-        source_norm_lines = source_norm_lines.split()
-        if len(source_norm_lines) < common.ngram_size:
-            common.verbose_print('      - skipped (%d lines)' % len(source_norm_lines))
-            return False
+    def _query_bloomfilter(self, ngram_list, magic_ext):
+        '''
+        Query patches with a membership structure sized to the file: an exact
+        n-gram set for small files, a right-sized Bloom filter otherwise
+        '''
+        if len(ngram_list) <= self._settings.exact_set_max:
+            common.verbose_print('      - exact set (%d n-grams)' % len(ngram_list), self._settings)
+            metrics.count('bloom_structures_total', structure='set')
+            return self._query_ngram_set(set(ngram_list), magic_ext)
 
-        self._bit_vector.setall(0)
-        num_ngram = len(source_norm_lines) - common.ngram_size + 1
-        is_vuln_source = False
+        bit_vector = self._get_bit_vector(len(ngram_list))
+        max_ngram = len(bit_vector)/self._settings.min_mn_ratio
+        common.verbose_print('      - Bloom filter (%d n-grams, %d bits)' % (len(ngram_list), len(bit_vector)), self._settings)
+        metrics.count('bloom_structures_total', structure='bloom', bits=len(bit_vector))
+
+        bit_mask = len(bit_vector) - 1
+        source_hash_list = common.build_hash_list(ngram_list, self._settings)
+        patch_id_list = []
         num_ngram_processed = 0
-        for i in range(0, num_ngram):
-            if num_ngram_processed > common.bloomfilter_size/common.min_mn_ratio:
-                common.verbose_print('      - split Bloom filters (%d n-grams)' % num_ngram_processed)
-                for patch_id in range(0, self._npatch):
-                    if magic_ext == self._patch_list[patch_id].file_ext:
-                        hash_list = self._patch_list[patch_id].hash_list
-                        is_match = True
-                        for h in hash_list:
-                            if not self._bit_vector[h]:
-                                is_match = False
-                                break
-                        if is_match:
-                            is_vuln_source = True
-                            self._match_dict[patch_id].append(self._nsource)
-                            common.verbose_print('      - match (patch #%d : source #%d)' % (patch_id, self._nsource))
-                            self._nmatch += 1
+        hash_count = self._settings.bloom_hash_count
+        for i in range(0, len(source_hash_list), hash_count):
+            if num_ngram_processed > max_ngram:
+                common.verbose_print('      - split Bloom filters (%d n-grams)' % num_ngram_processed, self._settings)
+                metrics.count('bloom_splits_total')
+                patch_id_list += self._query_bit_vector(bit_vector, magic_ext)
                 num_ngram_processed = 0
-                self._bit_vector.setall(0)
-
-            ngram = ''.join(source_norm_lines[i:i+common.ngram_size])
-            hash1 = common.fnv1a_hash(ngram) & (common.bloomfilter_size-1)
-            hash2 = common.djb2_hash(ngram) & (common.bloomfilter_size-1)
-            hash3 = common.sdbm_hash(ngram) & (common.bloomfilter_size-1)
-            self._bit_vector[hash1] = 1
-            self._bit_vector[hash2] = 1
-            self._bit_vector[hash3] = 1
+                bit_vector.setall(0)
+
+            for h in source_hash_list[i:i+hash_count]:
+                bit_vector[h & bit_mask] = 1
             num_ngram_processed += 1
 
+        patch_id_list += self._query_bit_vector(bit_vector, magic_ext)
+        self._probe_bit_vector(bit_vector)
+        return patch_id_list
+
+    def _query_bit_vector(self, bit_vector, magic_ext):
+        if self._settings.bloom_vectorize:
+            return self._get_patch_bits().query(bit_vector, magic_ext)
+        bit_mask = len(bit_vector) - 1
+        patch_id_list = []
         for patch_id in range(0, self._npatch):
             if magic_ext == self._patch_list[patch_id].file_ext:
                 hash_list = self._patch_list[patch_id].hash_list
                 is_match = True
                 for h in hash_list:
-                    if not self._bit_vector[h]:
+                    if not bit_vector[h & bit_mask]:
                         is_match = False
                         break
                 if is_match:
-                    is_vuln_source = True
-                    self._match_dict[patch_id].append(self._nsource)
-                    common.verbose_print('      - match (patch #%d : source #%d)' % (patch_id, self._nsource))
-                    self._nmatch += 1
-
-        return is_vuln_source
-
-    def _get_file_type(self, sub_type):
-        '''
-        Determine a file type based upon sub_type (magic module)
-        '''
-        magic_ext = None
-        if sub_type.startswith('x-c'):
-            magic_ext = common.FileExt.C
-        elif sub_type == 'x-java':
-            magic_ext = common.FileExt.Java
-        elif sub_type == 'x-shellscript':
-            magic_ext = common.FileExt.ShellScript
-        elif sub_type == 'x-perl':
-            magic_ext = common.FileExt.Perl
-        elif sub_type == 'x-python':
-            magic_ext = common.FileExt.Python
-        elif sub_type == 'x-php':
-            magic_ext = common.FileExt.PHP
-        elif sub_type == 'x-ruby':
-            magic_ext = common.FileExt.Ruby
-        else:
-            magic_ext = common.FileExt.Text
-        return magic_ext
+                    patch_id_list.append(patch_id)
+        return patch_id_list
+
+    def _get_patch_bits(self):
+        '''
+        Get concatenated patch hash lists for vectorized Bloom queries
+        '''
+        if self._patch_bits is None:
+            self._patch_bits = bloomvec.PatchBits(self._patch_list)
+        return self._patch_bits
+
+    def _query_ngram_set(self, ngram_set, magic_ext):
+        patch_id_list = []
+        for patch_id in range(0, self._npatch):
+            if magic_ext == self._patch_list[patch_id].file_ext:
+                is_match = True
+                for ngram in self._patch_list[patch_id].ngram_list:
+                    if ngram not in ngram_set:
+                        is_match = False
+                        break
+                if is_match:
+                    patch_id_list.append(patch_id)
+        return patch_id_list
+
+    def _get_bit_vector(self, num_ngram):
+        '''
+        Get a cleared bit vector of min_mn_ratio bits per n-gram (a power of
+        two, at most bloomfilter_size)
+        '''
+        size = 1 << max(10, (num_ngram*self._settings.min_mn_ratio - 1).bit_length())
+        size = min(size, self._settings.bloomfilter_size)
+        bit_vector = self._bit_vector_dict.get(size)
+        if bit_vector is None:
+            bit_vector = bitarray.bitarray(size)
+            self._bit_vector_dict[size] = bit_vector
+        bit_vector.setall(0)
+        return bit_vector
+
+    def _probe_bit_vector(self, bit_vector):
+        '''
+        Measure the false-positive rate with random n-grams
+        '''
+        bit_mask = len(bit_vector) - 1
+        for i in range(self._settings.bloom_probes):
+            if self._settings.hash_scheme == 1:
+                ngram = (self._random.getrandbits(32), self._random.getrandbits(32), self._random.getrandbits(32))
+            else:
+                ngram = self._random.getrandbits(64)
+            if all(bit_vector[h & bit_mask] for h in common.build_hash_list([ngram], self._settings)):
+                metrics.count('bloom_false_positives_total')
+        metrics.count('bloom_probes_total', self._settings.bloom_probes)
+
+    def _print_dedup_stats(self):
+        nfile = self._metrics.get('dedup_files_total')
+        ndistinct = nfile - self._metrics.get('dedup_hits_total')
+        common.progress_print('[+] dedup: %d files, %d distinct contents (%.2fx), %.2fs of queries saved' % \
+                (nfile, ndistinct, float(nfile)/max(ndistinct, 1), self._metrics.get('dedup_saved_seconds_total', stage='query')), self._settings)
+
+    def _print_membership_stats(self):
+        nset = self._metrics.get('bloom_structures_total', structure='set')
+        bloom_list = sorted((labels['bits'], n) for labels, n in self._metrics.samples('bloom_structures_total') if labels['structure'] == 'bloom')
+        common.progress_print('[+] membership: %d exact sets, %d Bloom filters (%s)' % \
+                (nset, sum(n for size, n in bloom_list), ', '.join('%d x %d bits' % (n, size) for size, n in bloom_list)), self._settings)
+        nprobe = self._metrics.get('bloom_probes_total')
+        if nprobe:
+            nfalse_positive = self._metrics.get('bloom_false_positives_total')
+            common.progress_print('[+] measured false-positive rate: %.2e (%d/%d probes)' % \
+                    (float(nfalse_positive)/nprobe, nfalse_positive, nprobe), self._settings)
+
+    def _query_index(self, ngram_list, magic_ext):
+        '''
+        Query the inverted n-gram index: a patch is a candidate when all of
+        its n-grams appear in the source file
+        '''
+        ngram_index = self._ngram_index.get(magic_ext)
+        if not ngram_index:
+            return []
+
+        hit_count = defaultdict(int)
+        for ngram in set(ngram_list):
+            for patch_id in ngram_index.get(ngram, ()):
+                hit_count[patch_id] += 1
+
+        return [patch_id for patch_id in sorted(hit_count) if hit_count[patch_id] == self._ngram_count[patch_id]]
 
     def items(self):
         return self._source_list
@@ -0,0 +1,137 @@
+# test_gitrange.py
+#   --git-range scans of a throwaway git repository against full scans
+#
+#   python -m unittest test_gitrange
+#
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+import gitrange
+import scanner
+
+redebug_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'redebug.py')
+
+# vulnerable hunk planted in source files
+clone_lines = [
+    'int check_length(char *buf, int len)',
+    '{',
+    '    if (len > MAX_LENGTH)',
+    '        return -1;',
+    '    memcpy(shared_buffer, buf, len);',
+    '    shared_length = len;',
+    '    return 0;',
+    '}',
+]
+
+
+def filler_lines(name, count):
+    return ['int %s_%d(int x) { return x * %d + %d; }' % (name, i, i, len(name)) for i in range(count)]
+
+def has_git():
+    try:
+        subprocess.check_output(['git', '--version'])
+    except (OSError, subprocess.CalledProcessError):
+        return False
+    return True
+
+
+@unittest.skipUnless(has_git(), 'git is not available')
+class GitRangeTest(unittest.TestCase):
+
+    def setUp(self):
+        self._work_dir = tempfile.mkdtemp(prefix='redebug-test-')
+        patch_dir = os.path.join(self._work_dir, 'patches')
+        os.mkdir(patch_dir)
+        diff = ['--- a/src/check.c', '+++ b/src/check.c', '@@ -1,8 +1,8 @@']
+        diff += [' ' + line for line in clone_lines[:4]]
+        diff += ['-' + clone_lines[4], '+    memcpy(shared_buffer, buf, len > 0 ? len : 0);']
+        diff += [' ' + line for line in clone_lines[5:]]
+        self._write(os.path.join('patches', 'check.diff'), diff)
+        os.mkdir(os.path.join(self._work_dir, 'repo'))
+        self._git('init', '-q')
+        self._git('config', 'user.name', 'test')
+        self._git('config', 'user.email', 'test@example.com')
+
+    def tearDown(self):
+        shutil.rmtree(self._work_dir)
+
+    def _write(self, path, lines):
+        with open(os.path.join(self._work_dir, path), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def _write_source(self, name, lines):
+        self._write(os.path.join('repo', name), lines)
+
+    def _git(self, *args):
+        return subprocess.check_output(('git', '-C', os.path.join(self._work_dir, 'repo')) + args)
+
+    def _commit(self, message):
+        self._git('add', '-A')
+        self._git('commit', '-q', '-m', message)
+        return self._git('rev-parse', 'HEAD').strip()
+
+    def _redebug(self, *args):
+        proc = subprocess.Popen([sys.executable, redebug_path] + list(args), cwd=self._work_dir,\
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        return proc.returncode, output
+
+    def _scan(self, name, *args):
+        '''
+        Scan the repository, return the set of (patch, source, start, end)
+        '''
+        jsonl_path = os.path.join(self._work_dir, name + '.jsonl')
+        returncode, output = self._redebug('--jsonl', jsonl_path, '-o', os.path.join(self._work_dir, name + '.html'),\
+                *(list(args) + ['patches', 'repo']))
+        self.assertEqual(returncode, 0, output)
+        with open(jsonl_path) as f:
+            return jsonl_path, set((r['patch'], r['source'], r['start_line'], r['end_line']) for r in map(json.loads, f))
+
+    def test_range_matches_full_scan(self):
+        # clones are followed by a hunk's length of lines, as the exact
+        # matching test gives up on windows reaching the last start line
+        self._write_source('kept.c', filler_lines('kept', 10) + clone_lines + filler_lines('kept_tail', 5))
+        self._write_source('shifted.c', clone_lines + filler_lines('shifted', 10))
+        self._write_source('fixed.c', filler_lines('fixed', 6) + clone_lines + filler_lines('fixed_tail', 10))
+        self._write_source('clean.c', filler_lines('clean', 12))
+        self._write_source('moved.c', filler_lines('moved', 3) + clone_lines + filler_lines('moved_tail', 10))
+        self._write_source('gone.c', clone_lines + filler_lines('gone', 10))
+        old_rev = self._commit('old')
+        old_path, old_set = self._scan('old')
+        self.assertEqual(set(source for patch, source, start, end in old_set),\
+                set(os.path.join('repo', name) for name in ('kept.c', 'shifted.c', 'fixed.c', 'moved.c', 'gone.c')))
+
+        # added, modified (match moved, dropped and gained), renamed and deleted
+        self._write_source('added.c', filler_lines('added', 2) + clone_lines + filler_lines('added_tail', 10))
+        self._write_source('shifted.c', filler_lines('shifted_head', 7) + clone_lines + filler_lines('shifted', 10))
+        self._write_source('fixed.c', filler_lines('fixed', 6))
+        self._write_source('clean.c', filler_lines('clean', 12) + clone_lines + filler_lines('clean_tail', 10))
+        self._git('mv', 'moved.c', 'renamed.c')
+        self._git('rm', '-q', 'gone.c')
+        new_rev = self._commit('new')
+
+        range_path, range_set = self._scan('range', '--git-range', '%s..%s' % (old_rev, new_rev), '--previous', old_path)
+        full_path, full_set = self._scan('full')
+        self.assertEqual(range_set, full_set)
+        self.assertEqual(set(source for patch, source, start, end in full_set),\
+                set(os.path.join('repo', name) for name in ('kept.c', 'shifted.c', 'clean.c', 'renamed.c', 'added.c')))
+
+    def test_unsupported_options(self):
+        self._write_source('kept.c', clone_lines)
+        rev = self._commit('old')
+        for option_list in (['--archives'], ['--prune', 'vendor'], ['-j', '2'], ['--shard', '0/2']):
+            returncode, output = self._redebug(*(option_list + ['--git-range', '%s..%s' % (rev, rev), 'patches', 'repo']))
+            self.assertEqual(returncode, 2, output)
+            self.assertIn('cannot be used with', output)
+        git_range = gitrange.GitRange(os.path.join(self._work_dir, 'repo'), rev, rev)
+        for settings in ({'scan_archives': True}, {'prune_dirs': ['vendor']}, {'jobs': 2}):
+            patch_scanner = scanner.Scanner(os.path.join(self._work_dir, 'patches'), **settings)
+            self.assertRaises(ValueError, patch_scanner.report, None, os.path.join(self._work_dir, 'output.html'), git_range=git_range)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+# textlines.py
+#   TextLines class (lines of a source file, split only where they are read)
+#
+#   The text is a file or a string already in memory. Line start offsets
+#   are indexed up to the last line asked for, and only lines that are
+#   sliced become strings, so a candidate file costs an offset array rather
+#   than a list of every line. A file is mapped only while it is indexed or
+#   sliced (a mapping holds a file descriptor), and checked against the
+#   digest of the contents that were queried when it is mapped again after
+#   a change of size or mtime. Lines are the same as re.split('\n', text).
+#
+import os
+import mmap
+import array
+import hashlib
+from contextlib import contextmanager
+import metrics
+
+
+class TextLines(object):
+
+    def __init__(self, text=None, file_path=None, digest=None):
+        '''
+        text: contents in memory, or file_path: a file mapped when lines are
+        read, digest: SHA-1 of the file contents that were queried
+        '''
+        self._text = text
+        self._file_path = file_path
+        self._digest = digest
+        # size and mtime of the file when its digest was last checked
+        self._file_stat = None
+        self._line_start = array.array('L', [0])
+        self._scan_pos = 0
+        self._indexed = False
+
+    @contextmanager
+    def _buffer(self):
+        '''
+        Yield the text, a file mapped for the duration of the block
+        Raise IOError if the file is no longer the one queried
+        '''
+        if self._text is not None:
+            yield self._text
+            return
+        with open(self._file_path, 'rb') as f:
+            file_stat = os.fstat(f.fileno())
+            text = ''
+            if file_stat.st_size:
+                text = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if self._digest is not None and (file_stat.st_size, file_stat.st_mtime) != self._file_stat:
+                    if hashlib.sha1(text).hexdigest() != self._digest:
+                        raise IOError('%s: changed since it was queried' % self._file_path)
+                    self._file_stat = (file_stat.st_size, file_stat.st_mtime)
+                yield text
+            finally:
+                if file_stat.st_size:
+                    text.close()
+
+    def _index_to(self, nline, text):
+        '''
+        Index line starts until nline lines are known or the text ends
+        '''
+        line_start = self._line_start
+        pos = self._scan_pos
+        while len(line_start) < nline and not self._indexed:
+            pos = text.find('\n', pos)
+            if pos < 0:
+                self._indexed = True
+                break
+            pos += 1
+            line_start.append(pos)
+        self._scan_pos = pos
+
+    def __len__(self):
+        if not self._indexed:
+            with self._buffer() as text:
+                self._index_to(float('inf'), text)
+        return len(self._line_start)
+
+    def _line(self, i, text):
+        end = self._line_start[i+1] - 1 if i+1 < len(self._line_start) else len(text)
+        return text[self._line_start[i]:end]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop = key.start or 0, key.stop
+            if key.step is None and start >= 0 and stop is not None and stop >= 0:
+                with self._buffer() as text:
+                    # one more line start marks where the last line ends
+                    self._index_to(stop + 1, text)
+                    stop = min(stop, len(self._line_start))
+                    metrics.count('source_lines_decoded_total', max(0, stop - start))
+                    return [self._line(i, text) for i in range(start, stop)]
+            start, stop, step = key.indices(len(self))
+            with self._buffer() as text:
+                metrics.count('source_lines_decoded_total', len(range(start, stop, step)))
+                return [self._line(i, text) for i in range(start, stop, step)]
+        if key < 0:
+            key += len(self)
+        with self._buffer() as text:
+            self._index_to(key + 2, text)
+            if not 0 <= key < len(self._line_start):
+                raise IndexError('line index out of range')
+            return self._line(key, text)
+
+    def __iter__(self):
+        return iter(self[:len(self)])
+
+    def __getstate__(self):
+        # a mapped file is mapped again where it is unpickled
+        if self._file_path is not None:
+            return {'file_path': self._file_path, 'digest': self._digest}
+        return {'text': self._text}
+
+    def __setstate__(self, state):
+        self.__init__(state.get('text'), state.get('file_path'), state.get('digest'))
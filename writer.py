@@ -0,0 +1,143 @@
+# writer.py
+#   JsonLinesWriter and SarifWriter classes (machine-readable match records)
+#
+#   Records are written and flushed one exact match at a time, so results
+#   can be consumed while a scan is still running.
+#
+import os
+import json
+import urllib
+import metrics
+
+
+def _text(string):
+    '''
+    Decode bytes for JSON (source files are not necessarily UTF-8)
+    '''
+    if isinstance(string, str):
+        return string.decode('utf-8', 'replace')
+    return string
+
+def artifact_location(path):
+    '''
+    SARIF artifact location of a source path: a relative URI reference
+    against SRCROOT (the working directory), a file URI if absolute
+    '''
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    if os.path.isabs(path):
+        return {'uri': 'file://' + urllib.pathname2url(path)}
+    return {'uri': urllib.pathname2url(path), 'uriBaseId': SarifWriter.uri_base_id}
+
+def match_record(patch_id, patch_info, source_info, context, with_context=False):
+    '''
+    Build a match record (line numbers are 1-based and inclusive)
+    '''
+    record = {
+        'patch_id': patch_id,
+        'patch': _text(patch_info.file_path),
+        'source': _text(source_info.file_path),
+        'start_line': context.start_line + 1,
+        'end_line': context.end_line,
+        'context_start_line': context.prev_context_line + 1,
+        'context_end_line': context.next_context_line,
+    }
+    if context.near:
+        # a near clone (Jaccard similarity of n-grams)
+        record['similarity'] = context.similarity
+    if len(patch_info.labels) > 1:
+        # the same hunk in other patches
+        record['patch_labels'] = [_text(label) for label in patch_info.labels]
+    if with_context:
+        orig_lines = source_info.orig_lines
+        record['context'] = {
+            'before': [_text(line) for line in orig_lines[context.prev_context_line:context.start_line]],
+            'match': [_text(line) for line in orig_lines[context.start_line:context.end_line]],
+            'after': [_text(line) for line in orig_lines[context.end_line:context.next_context_line]],
+        }
+    return record
+
+
+class JsonLinesWriter(object):
+
+    def __init__(self, path, with_context=False):
+        self._path = path
+        self._with_context = with_context
+        self._out = open(path, 'w')
+        self._nrecord = 0
+
+    def write_match(self, patch_id, patch_info, source_info, context):
+        self.write_record(match_record(patch_id, patch_info, source_info, context, self._with_context))
+
+    def write_record(self, record):
+        self._out.write(json.dumps(record, sort_keys=True) + '\n')
+        self._out.flush()
+        self._nrecord += 1
+
+    def close(self):
+        metrics.count('report_bytes_total', self._out.tell(), format='jsonl')
+        self._out.close()
+        return self._nrecord
+
+
+class SarifWriter(object):
+
+    rule_id = 'unpatched-code-clone'
+    uri_base_id = 'SRCROOT'
+
+    def __init__(self, path, with_context=False):
+        self._path = path
+        self._with_context = with_context
+        self._out = open(path, 'w')
+        self._nrecord = 0
+        driver = {
+            'name': 'ReDeBug',
+            'informationUri': 'https://github.com/dbrumley/redebug',
+            'rules': [{
+                'id': self.rule_id,
+                'shortDescription': {'text': 'Unpatched code clone'},
+                'fullDescription': {'text': 'Source code matches the vulnerable side of a security patch'},
+            }],
+        }
+        # leave the results array open, results are appended as found
+        base_uri = 'file://' + urllib.pathname2url(os.path.join(os.getcwd(), ''))
+        self._out.write('{"version": "2.1.0", "$schema": "https://json.schemastore.org/sarif-2.1.0.json", '\
+                '"runs": [{"tool": %s, "originalUriBaseIds": %s, "results": [' % (json.dumps({'driver': driver}, sort_keys=True),\
+                json.dumps({self.uri_base_id: {'uri': base_uri}}, sort_keys=True)))
+        self._out.flush()
+
+    def write_match(self, patch_id, patch_info, source_info, context):
+        record = match_record(patch_id, patch_info, source_info, context, self._with_context)
+        region = {'startLine': record['start_line'], 'endLine': record['end_line']}
+        context_region = {'startLine': record['context_start_line'], 'endLine': record['context_end_line']}
+        if self._with_context:
+            region['snippet'] = {'text': '\n'.join(record['context']['match'])}
+            context_region['snippet'] = {'text': '\n'.join(record['context']['before'] + record['context']['match'] + record['context']['after'])}
+        result = {
+            'ruleId': self.rule_id,
+            'level': 'warning',
+            'message': {'text': 'Unpatched code clone of %s' % record['patch']},
+            'locations': [{
+                'physicalLocation': {
+                    'artifactLocation': artifact_location(source_info.file_path),
+                    'region': region,
+                    'contextRegion': context_region,
+                },
+            }],
+            'properties': {'patch': record['patch'], 'patchId': patch_id},
+        }
+        if 'patch_labels' in record:
+            result['properties']['patchLabels'] = record['patch_labels']
+        if 'similarity' in record:
+            result['properties']['similarity'] = record['similarity']
+        if self._nrecord:
+            self._out.write(',')
+        self._out.write(json.dumps(result, sort_keys=True))
+        self._out.flush()
+        self._nrecord += 1
+
+    def close(self):
+        self._out.write(']}]}\n')
+        metrics.count('report_bytes_total', self._out.tell(), format='sarif')
+        self._out.close()
+        return self._nrecord